@@ -0,0 +1,71 @@
+import time
+
+from storage import DIGEST_CHANGES, update_row
+
+# Сколько имен показывать в сводке, остальные сворачиваются в "и еще N"
+MAX_NAMES = 20
+
+
+def _names_text(names):
+    shown = ', '.join(names[:MAX_NAMES])
+    if len(names) > MAX_NAMES:
+        shown += f" и еще {len(names) - MAX_NAMES}"
+    return shown
+
+
+class AdminDigest:
+    # Накапливает изменения состава цикла за окно и отдает одну сводку для админов
+    # вместо сообщения на каждое нажатие "участвую"/"не участвую".
+    # Изменения лежат в хранилище (digest_changes: uuid -> пространство, состояние на начало
+    # окна и текущее): их пишет процесс, обработавший нажатие, а сводку собирает лидер
+
+    def __init__(self, storage):
+        self.storage = storage
+        # Начало окна по пространствам - только у того, кто отправляет сводки
+        self._window_started = {}
+
+    def record(self, user_uuid, tenant, was_member, is_member):
+        # Запоминаем состояние пользователя на начало окна и текущее
+        def change(previous):
+            initial = previous['initial'] if previous else was_member
+            return {'tenant': tenant, 'initial': initial, 'current': is_member}
+
+        update_row(self.storage, DIGEST_CHANGES, user_uuid, change)
+
+    def pending(self):
+        # {пространство: {uuid: запись изменения}}
+        grouped = {}
+        for user_uuid, change in self.storage.load(DIGEST_CHANGES).items():
+            grouped.setdefault(change['tenant'], {})[user_uuid] = change
+        return grouped
+
+    def skip(self, tenant):
+        # Окно прошло без изменений - следующая сводка считает время с этого момента
+        self._window_started[tenant] = time.monotonic()
+
+    def build(self, tenant, changes, current_count, name_of):
+        # Возвращает текст сводки по изменениям из pending() и закрывает окно; None, если чистых
+        # изменений не было. Запись, которую успели изменить после чтения, остается до следующей сводки
+        for user_uuid, change in changes.items():
+            if self.storage.get(DIGEST_CHANGES, user_uuid) == change:
+                self.storage.delete(DIGEST_CHANGES, user_uuid)
+        now = time.monotonic()
+        minutes = max(1, round((now - self._window_started.get(tenant, now)) / 60))
+        self._window_started[tenant] = now
+
+        joined = [user_uuid for user_uuid, change in changes.items() if change['current'] and not change['initial']]
+        left = [user_uuid for user_uuid, change in changes.items() if change['initial'] and not change['current']]
+        if not joined and not left:
+            return None
+
+        net = len(joined) - len(left)
+        lines = [
+            f"За последние {minutes} мин. в цикле {'+' if net >= 0 else ''}{net} "
+            f"(вступили: {len(joined)}, вышли: {len(left)}).",
+            f"На данный момент в текущем цикле {current_count} пользователей."
+        ]
+        if joined:
+            lines.append(f"Вступили: {_names_text([name_of(user_uuid) for user_uuid in joined])}")
+        if left:
+            lines.append(f"Вышли: {_names_text([name_of(user_uuid) for user_uuid in left])}")
+        return '\n'.join(lines)
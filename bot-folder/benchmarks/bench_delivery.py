@@ -0,0 +1,59 @@
+# Рассылка объявлений о парах: последовательная отправка против DeliveryPipeline
+# на локальном фейковом Bot API с задержкой ответа и лимитом 30 сообщений в секунду.
+# Запуск: python benchmarks/bench_delivery.py [количество сообщений] [задержка, с]
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from telegram import Bot
+from telegram.request import HTTPXRequest
+
+from delivery import DeliveryPipeline
+from fake_bot_api import FakeBotApi
+
+
+def make_messages(count):
+    return [{'key': f'user-{i}', 'chat_id': 100000 + i, 'text': f'Пара #{i // 2}'} for i in range(count)]
+
+
+async def sequential(bot, messages):
+    started = time.perf_counter()
+    for message in messages:
+        await bot.send_message(chat_id=message['chat_id'], text=message['text'])
+    return time.perf_counter() - started
+
+
+async def run(count, latency):
+    api = FakeBotApi(latency=latency, global_rate=30).start()
+    bot = Bot('123:bench', base_url=api.base_url, request=HTTPXRequest(connection_pool_size=64))
+    try:
+        await bot.initialize()
+        messages = make_messages(count)
+
+        # Последовательный вариант без лимитера упирается в 429, поэтому меряем его на 30 сообщениях
+        sample = messages[:30]
+        sequential_time = await sequential(bot, sample)
+        await asyncio.sleep(1)
+
+        pipeline = DeliveryPipeline(concurrency=32)
+        report = await pipeline.deliver(bot, messages)
+
+        print(f"Сообщений: {count}, задержка API: {latency * 1000:.0f} мс")
+        print(f"Последовательно: {sequential_time / len(sample) * 1000:.1f} мс на сообщение "
+              f"(оценка для {count}: {sequential_time / len(sample) * count:.1f} с)")
+        print(f"DeliveryPipeline: {report.elapsed:.1f} с, {report.sent / report.elapsed:.1f} сообщ./с")
+        print(report.summary())
+        print(f"Ответов 429 от API: {api.rate_limited}")
+    finally:
+        await bot.shutdown()
+        api.stop()
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    latency = float(sys.argv[2]) if len(sys.argv) > 2 else 0.1
+    asyncio.run(run(count, latency))
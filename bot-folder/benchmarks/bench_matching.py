@@ -0,0 +1,69 @@
+# Подбор пар на больших циклах: время MatchingEngine и число повторных встреч
+# по сравнению с прежним random.shuffle. Перед замером прогоняются несколько циклов,
+# чтобы накопилась история встреч.
+# Запуск: python benchmarks/bench_matching.py [участников] [циклов истории]
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from matching import MatchingEngine, PairHistory
+
+POSITIONS = ['Разработчик', 'Аналитик', 'Дизайнер', 'Менеджер', 'Тестировщик', 'HR']
+
+
+def shuffle_pairs(participants, rng):
+    order = list(participants)
+    rng.shuffle(order)
+    return [(order[i], order[i + 1]) for i in range(0, len(order) - 1, 2)]
+
+
+def count_repeats(groups, history):
+    return sum(
+        1 for group in groups
+        for i in range(len(group)) for j in range(i + 1, len(group))
+        if history.count(group[i], group[j])
+    )
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    cycles = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    rng = random.Random(42)
+    participants = [str(uuid.UUID(int=rng.getrandbits(128))) for _ in range(count)]
+    positions = {user_uuid: rng.choice(POSITIONS) for user_uuid in participants}
+
+    # Небольшой пул, чтобы повторы в случайном подборе были заметны
+    pool = participants[:40]
+    history = PairHistory()
+    engine = MatchingEngine(history, prefer_cross_position=True, seed=1)
+    for _ in range(cycles):
+        for group in engine.match(pool, positions).groups:
+            for i in range(len(group)):
+                for j in range(i + 1, len(group)):
+                    history.add(group[i], group[j])
+
+    baseline = shuffle_pairs(pool, rng)
+    result = engine.match(pool, positions)
+    print(f"Пул из {len(pool)} после {cycles} циклов: повторов random.shuffle = {count_repeats(baseline, history)}, "
+          f"MatchingEngine = {result.repeats}")
+
+    # Детерминированность при одинаковом seed
+    first = MatchingEngine(history, seed=7).match(pool, positions).groups
+    second = MatchingEngine(history, seed=7).match(pool, positions).groups
+    print(f"Одинаковый seed дает одинаковые пары: {first == second}")
+
+    started = time.perf_counter()
+    result = MatchingEngine(history, prefer_cross_position=True, seed=1).match(participants, positions)
+    elapsed = time.perf_counter() - started
+    sizes = sorted({len(group) for group in result.groups})
+    same_position = sum(1 for group in result.groups if positions[group[0]] == positions[group[1]])
+    print(f"Участников: {count}, групп: {len(result.groups)} (размеры {sizes}), "
+          f"одинаковая должность: {same_position}, время: {elapsed:.3f} с")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+# Время холодного старта: прежняя двойная загрузка JSON с полным логом содержимого,
+# одна загрузка из JSON через хранилище и загрузка из бинарного снимка.
+# Запуск: python benchmarks/bench_startup.py [количество пользователей]
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cycle_registry import CycleRegistry
+from matching import PairHistory
+from snapshot import SNAPSHOT_DATASETS, read_snapshot, storage_fingerprint, write_snapshot
+from storage import JsonStorage, load_data, save_data
+from user_repo import UserRepository, records_in_place
+from write_behind import WriteBehindStorage
+
+LEGACY_FILES = ('user_data', 'cycle_users', 'not_cycle_users', 'feedback_data')
+
+
+def make_state(directory, count):
+    users = {}
+    cycle_users = {}
+    for i in range(count):
+        user_uuid = str(uuid.uuid4())
+        users[user_uuid] = {
+            'id': 100000000 + i,
+            'email': f'user{i}@company.com',
+            'name': f'Пользователь {i}',
+            'position': 'Разработчик'
+        }
+        if i % 2:
+            cycle_users[user_uuid] = 100000000 + i
+    uuids = list(users)
+    pairs = {f'{uuids[i]}|{uuids[i + 1]}': 1 for i in range(0, count - 1, 2)}
+    for name, data in (('user_data', users), ('cycle_users', cycle_users), ('not_cycle_users', {}),
+                       ('feedback_data', {}), ('pair_history', pairs)):
+        save_data(data, os.path.join(directory, f'{name}.json'))
+
+
+def legacy_start(directory):
+    # Как было: загрузка при импорте и повторно в main(), каждый раз с полным содержимым в логе
+    for _ in range(2):
+        for name in LEGACY_FILES:
+            data = load_data(os.path.join(directory, f'{name}.json'), {})
+            str(data)
+
+
+def load_state(storage):
+    # Как boot.load_state: кэш хранилища после загрузки держит те же UserRecord
+    users = UserRepository(storage.load('user_data'))
+    storage.adopt('user_data', users.data)
+    registry = CycleRegistry(storage)
+    registry.load()
+    storage.load('feedback_data')
+    PairHistory(storage.load('pair_history'))
+    return users
+
+
+def json_start(directory):
+    storage = WriteBehindStorage(JsonStorage(directory), interval=60)
+    load_state(storage)
+    return storage
+
+
+def snapshot_start(directory, path):
+    datasets = read_snapshot(path, storage_fingerprint('json', directory))
+    assert datasets is not None, 'снимок не принят'
+    records_in_place(datasets['user_data'])
+    storage = WriteBehindStorage(JsonStorage(directory), interval=60)
+    storage.prime(datasets)
+    load_state(storage)
+    return storage
+
+
+def measure(func):
+    started = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - started
+    if result is not None:
+        result.close()
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    directory = tempfile.mkdtemp(prefix='coffee-startup-')
+    make_state(directory, count)
+    path = os.path.join(directory, 'coffee.snapshot')
+
+    storage = WriteBehindStorage(JsonStorage(directory), interval=60)
+    datasets = {dataset: storage.load(dataset) for dataset in SNAPSHOT_DATASETS}
+    storage.close()
+    write_snapshot(path, datasets, storage_fingerprint('json', directory))
+
+    legacy = measure(lambda: legacy_start(directory))
+    single = measure(lambda: json_start(directory))
+    binary = measure(lambda: snapshot_start(directory, path))
+
+    print(f"Пользователей: {count}")
+    print(f"Двойная загрузка JSON с логом: {legacy:.2f} с")
+    print(f"Одна загрузка JSON:            {single:.2f} с")
+    print(f"Бинарный снимок:               {binary:.2f} с")
+
+
+if __name__ == '__main__':
+    main()
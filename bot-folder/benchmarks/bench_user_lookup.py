@@ -0,0 +1,55 @@
+# Сравнение поиска пользователя по telegram id: линейный обход user_data против индекса
+# Запуск: python benchmarks/bench_user_lookup.py [количество пользователей]
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_repo import UserRepository
+
+
+def make_users(count):
+    users = {}
+    for i in range(count):
+        users[str(uuid.uuid4())] = {
+            'id': 100000000 + i,
+            'email': f'user{i}@company.com',
+            'name': f'Пользователь {i}',
+            'position': 'Разработчик'
+        }
+    return users
+
+
+def linear_lookup(users, telegram_id):
+    for uuid_key, user_info in users.items():
+        if user_info.get('id') == telegram_id:
+            return uuid_key
+    return None
+
+
+def bench(func, ids):
+    started = time.perf_counter()
+    for telegram_id in ids:
+        func(telegram_id)
+    return (time.perf_counter() - started) / len(ids)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    users = make_users(count)
+    repo = UserRepository(users)
+    ids = [100000000 + random.randrange(count) for _ in range(1000)]
+
+    linear = bench(lambda telegram_id: linear_lookup(users, telegram_id), ids)
+    indexed = bench(repo.find_by_telegram_id, ids)
+
+    print(f"Пользователей: {count}")
+    print(f"Линейный обход: {linear * 1e6:.1f} мкс на поиск")
+    print(f"Индекс:         {indexed * 1e6:.3f} мкс на поиск")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Память под профили пользователей: словари из json.loads (как раньше) против UserRecord
+# со __slots__ и интернированными должностями, доменами почты и пространствами.
+# Запуск: python benchmarks/bench_user_memory.py [количество пользователей]
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from user_repo import UserRecord, records_in_place
+
+POSITIONS = ('Разработчик', 'Аналитик', 'Дизайнер', 'Менеджер проектов', 'Тестировщик', 'HR', 'Маркетолог')
+DOMAINS = ('company.com', 'company.by', 'partner.io')
+
+
+def make_payload(count):
+    # Профили в формате user_data.json; строки из файла у каждого профиля свои, как после json.loads
+    random.seed(1)
+    users = {}
+    for i in range(count):
+        users[str(uuid.uuid4())] = {
+            'id': 100000000 + i,
+            'email': f'user{i}@{random.choice(DOMAINS)}',
+            'name': f'Пользователь {i}',
+            'position': random.choice(POSITIONS),
+            'tenant': 'default',
+            'last_seen': '2026-10-01',
+        }
+    return json.dumps(users, ensure_ascii=False)
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, current, peak, elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    payload = make_payload(count)
+
+    dicts, dict_bytes, dict_peak, dict_seconds = measure(lambda: json.loads(payload))
+    # Как при загрузке в UserRepository: словари из json.loads становятся UserRecord и освобождаются
+    records, record_bytes, record_peak, record_seconds = measure(
+        lambda: {key: UserRecord.from_dict(info) for key, info in json.loads(payload).items()})
+    # Как при загрузке из снимка: замена на месте, словари освобождаются по одному
+    _, _, inplace_peak, inplace_seconds = measure(lambda: records_in_place(json.loads(payload)))
+
+    # Формат на диске не меняется
+    for user_uuid, info in dicts.items():
+        assert records[user_uuid].to_dict() == info, user_uuid
+
+    sample = next(iter(records.values()))
+    print(f"Пользователей: {count}")
+    print(f"Словари:    {dict_bytes / count:7.1f} байт на профиль, пик {dict_peak / 2 ** 20:6.1f} МБ, "
+          f"{dict_seconds:.3f} с")
+    print(f"UserRecord: {record_bytes / count:7.1f} байт на профиль, "
+          f"пик {record_peak / 2 ** 20:6.1f} МБ, {record_seconds:.3f} с")
+    print(f"UserRecord на месте: пик {inplace_peak / 2 ** 20:6.1f} МБ, {inplace_seconds:.3f} с")
+    print(f"Размер объекта: dict {sys.getsizeof(next(iter(dicts.values())))} байт, "
+          f"UserRecord {sys.getsizeof(sample)} байт")
+
+
+if __name__ == '__main__':
+    main()
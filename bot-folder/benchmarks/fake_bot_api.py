@@ -0,0 +1,286 @@
+# Локальная замена Bot API для бенчмарков: принимает запросы вида /bot<token>/<method>
+# и отвечает как Telegram, умеет добавлять задержку и отвечать 429 при превышении лимита.
+# Для нагрузочного теста отдает синтетические апдейты через getUpdates и считает
+# время от постановки апдейта в очередь до ответа бота в тот же чат.
+# Запуск отдельным процессом: python benchmarks/fake_bot_api.py [порт]
+import email.parser
+import email.policy
+import json
+import sys
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'CoffeeBot', 'username': 'coffee_bot'}
+
+# Методы, которыми бот отвечает пользователю - по ним считается задержка ответа
+REPLY_METHODS = ('sendMessage', 'sendPhoto', 'sendDocument')
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}'}
+
+
+def message_update(update_id, user_id, text):
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id, user_id, data):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'from': _user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': update_id,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'from': BOT_USER,
+                'text': '...',
+            },
+        },
+    }
+
+
+def parse_params(content_type, body):
+    if not body:
+        return {}
+    if content_type.startswith('application/json'):
+        return json.loads(body)
+    if content_type.startswith('multipart/form-data'):
+        message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+            f'Content-Type: {content_type}\r\n\r\n'.encode() + body
+        )
+        params = {}
+        for part in message.iter_parts():
+            name = part.get_param('name', header='content-disposition')
+            if part.get_filename():
+                params[name] = {'filename': part.get_filename(), 'size': len(part.get_payload(decode=True) or b'')}
+            else:
+                params[name] = part.get_content()
+        return params
+    return {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FakeBotApi:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, global_rate=None):
+        self.latency = latency
+        self.global_rate = global_rate
+        self.calls = Counter()
+        self.sent = []
+        self.rate_limited = 0
+        self.replies = 0
+        self.reply_latencies = []
+        self._lock = threading.Lock()
+        self._updates = deque()
+        self._updates_ready = threading.Condition(self._lock)
+        self._update_id = 0
+        self._pushed_at = {}
+        self._window = 0
+        self._window_count = 0
+        self._message_id = 0
+        self._file_id = 0
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}/bot'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _over_limit(self):
+        if not self.global_rate:
+            return False
+        with self._lock:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window = window
+                self._window_count = 0
+            self._window_count += 1
+            if self._window_count > self.global_rate:
+                self.rate_limited += 1
+                return True
+        return False
+
+    def _next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    # Очередь апдейтов
+
+    def push(self, kind, user_id, payload):
+        with self._lock:
+            self._update_id += 1
+            if kind == 'message':
+                update = message_update(self._update_id, user_id, payload)
+            else:
+                update = callback_update(self._update_id, user_id, payload)
+            self._updates.append(update)
+            self._pushed_at[user_id] = time.monotonic()
+            self._updates_ready.notify_all()
+
+    def push_step(self, kind, first_user, count, template):
+        # Один шаг сценария для пользователей first_user..first_user+count-1,
+        # в шаблоне {n} заменяется на номер пользователя
+        for user_id in range(first_user, first_user + count):
+            self.push(kind, user_id, template.replace('{n}', str(user_id)))
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._updates and self._updates[0]['update_id'] < offset:
+                self._updates.popleft()
+            while not self._updates:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                self._updates_ready.wait(remaining)
+            return [self._updates[i] for i in range(min(limit, len(self._updates)))]
+
+    def _record_reply(self, chat_id):
+        with self._lock:
+            self.replies += 1
+            pushed_at = self._pushed_at.pop(chat_id, None)
+            if pushed_at is not None:
+                self.reply_latencies.append(time.monotonic() - pushed_at)
+
+    def stats(self):
+        with self._lock:
+            latencies = list(self.reply_latencies)
+            return {
+                'calls': dict(self.calls),
+                'replies': self.replies,
+                'pending_updates': len(self._updates),
+                'rate_limited': self.rate_limited,
+                'reply_p50': percentile(latencies, 0.5),
+                'reply_p99': percentile(latencies, 0.99),
+            }
+
+    def reset_latencies(self):
+        with self._lock:
+            self.reply_latencies = []
+
+    # Методы Bot API
+
+    def handle(self, method, params):
+        self.calls[method] += 1
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self.get_updates(int(params.get('offset') or 0), int(params.get('limit') or 100),
+                                    float(params.get('timeout') or 0))
+        if method in REPLY_METHODS:
+            chat_id = int(params.get('chat_id', 0))
+            self._record_reply(chat_id)
+            message = {
+                'message_id': self._next_message_id(),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+            }
+            if method == 'sendMessage':
+                self.sent.append((chat_id, params.get('text')))
+                message['text'] = params.get('text', '')
+            elif method == 'sendPhoto':
+                with self._lock:
+                    self._file_id += 1
+                    file_id = f'photo-{self._file_id}'
+                message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512}]
+            else:
+                message['document'] = {'file_id': f'doc-{message["message_id"]}', 'file_unique_id': f'doc-{message["message_id"]}'}
+            return message
+        return True
+
+    def control(self, path, params):
+        if path == '/control/step':
+            self.push_step(params['kind'], int(params['first_user']), int(params['count']), params['template'])
+            return {'ok': True}
+        if path == '/control/stats':
+            return self.stats()
+        if path == '/control/reset':
+            self.reset_latencies()
+            return {'ok': True}
+        return None
+
+    def _handler_class(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                params = parse_params(self.headers.get('Content-Type', ''), body)
+
+                if self.path.startswith('/control/'):
+                    result = api.control(self.path, params)
+                    self._reply(200 if result is not None else 404, result or {'ok': False})
+                    return
+
+                method = self.path.rsplit('/', 1)[-1]
+                if api.latency and method != 'getUpdates':
+                    time.sleep(api.latency)
+                if method in REPLY_METHODS and api._over_limit():
+                    self._reply(429, {
+                        'ok': False,
+                        'error_code': 429,
+                        'description': 'Too Many Requests: retry after 1',
+                        'parameters': {'retry_after': 1},
+                    })
+                    return
+                self._reply(200, {'ok': True, 'result': api.handle(method, params)})
+
+            do_GET = do_POST
+
+            def _reply(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    print(f"Фейковый Bot API на http://127.0.0.1:{port}/bot", flush=True)
+    FakeBotApi(port=port).serve_forever()
@@ -0,0 +1,246 @@
+# Нагрузочный тест: настоящий Application из boot.build_application() против фейкового Bot API
+# в отдельном процессе. N синтетических пользователей проходят
+# /start -> start_registration -> почта -> имя -> должность -> join_cycle, затем запускается match_logic.
+# Работает офлайн; с --max-p99/--min-rate завершается с кодом 1 при регрессии.
+# С --workers K бот запускается в режиме dispatcher с K процессами-воркерами (подбор пар
+# в этом режиме не замеряется, задержки обработчиков и RSS берутся только в однопроцессном режиме).
+# Запуск: python benchmarks/loadtest.py [--users 1000,10000,100000] [--workers K] [--max-p99 мс] [--min-rate апдейтов/с]
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BOT_DIR = os.path.dirname(BENCH_DIR)
+FIRST_USER = 10_000_000
+# Сколько секунд бот может не отвечать ни на один апдейт шага, прежде чем прогон считается зависшим
+STALL_TIMEOUT = 120
+
+# Шаги сценария: тип апдейта и шаблон текста/данных ({n} - id пользователя)
+SCENARIO = [
+    ('message', '/start'),
+    ('callback', 'start_registration'),
+    ('message', 'user{n}@company.com'),
+    ('message', 'Пользователь {n}'),
+    ('message', 'Разработчик'),
+    ('callback', 'join_cycle'),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def control(port, path, payload=None):
+    data = json.dumps(payload or {}).encode('utf-8')
+    request = urllib.request.Request(
+        f'http://127.0.0.1:{port}/control/{path}', data=data, headers={'Content-Type': 'application/json'}
+    )
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+async def wait_replies(port, expected, stall_timeout):
+    # Ждем, пока бот ответит на весь шаг. Большой шаг при 100k пользователей идет полчаса,
+    # поэтому ошибкой считаем не общее время, а отсутствие новых ответов дольше stall_timeout
+    replies = -1
+    progressed = time.monotonic()
+    while True:
+        stats = await asyncio.to_thread(control, port, 'stats')
+        if stats['replies'] >= expected:
+            return stats
+        if stats['replies'] != replies:
+            replies = stats['replies']
+            progressed = time.monotonic()
+        elif time.monotonic() - progressed > stall_timeout:
+            raise TimeoutError(f"Ожидали {expected} ответов, получено {replies}, "
+                               f"новых ответов нет {stall_timeout} с")
+        await asyncio.sleep(0.1)
+
+
+async def sample_loop_lag(samples, stop, interval=0.05):
+    while not stop.is_set():
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.monotonic() - started - interval))
+
+
+def placeholder_media(directory):
+    # Бот не стартует без картинки регистрации; фейковый API содержимое файла не проверяет
+    with open(os.path.join(directory, 'registration.png'), 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n')
+    return directory
+
+
+async def run_bot(users, port):
+    # Отдельный процесс на каждый размер: boot хранит состояние в модуле
+    os.chdir(tempfile.mkdtemp(prefix='coffee-load-'))
+    os.environ.setdefault('COFFEE_MEDIA_DIR', placeholder_media(os.getcwd()))
+    os.environ.setdefault('COFFEE_METRICS_PORT', '0')
+    os.environ.setdefault('COFFEE_DELIVERY_RATE', '1000000')
+    os.environ.setdefault('COFFEE_DELIVERY_CONCURRENCY', '64')
+    sys.path.insert(0, BOT_DIR)
+    import logging
+    import boot
+    from metrics import metrics
+    from telegram.ext import CallbackContext
+
+    logging.getLogger().setLevel(logging.WARNING)
+    boot.load_state()
+    application = boot.build_application(token='123:load', base_url=f'http://127.0.0.1:{port}/bot')
+    await application.initialize()
+    await application.start()
+    await application.updater.start_polling(poll_interval=0, timeout=1)
+
+    lag_samples = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(sample_loop_lag(lag_samples, stop))
+
+    try:
+        started = time.monotonic()
+        for step, (kind, template) in enumerate(SCENARIO, start=1):
+            await asyncio.to_thread(control, port, 'step', {
+                'kind': kind, 'first_user': FIRST_USER, 'count': users, 'template': template
+            })
+            stats = await wait_replies(port, users * step, STALL_TIMEOUT)
+        flow_seconds = time.monotonic() - started
+
+        match_started = time.monotonic()
+        await boot.match_logic(boot.user_data, CallbackContext(application))
+        match_seconds = time.monotonic() - match_started
+    finally:
+        # И при ошибке: без остановки поток отложенной записи не дает процессу завершиться
+        stop.set()
+        await lag_task
+        await application.updater.stop()
+        await application.stop()
+        await application.shutdown()
+        await boot.on_shutdown(application)
+
+    handler = metrics.merged_histogram('coffee_handler_seconds', exclude=('match_logic',))
+    lag_samples.sort()
+    return {
+        'users': users,
+        'updates': users * len(SCENARIO),
+        'updates_per_second': users * len(SCENARIO) / flow_seconds,
+        'handler_p50_ms': handler.quantile(0.5) * 1000,
+        'handler_p99_ms': handler.quantile(0.99) * 1000,
+        'reply_p50_ms': stats['reply_p50'] * 1000,
+        'reply_p99_ms': stats['reply_p99'] * 1000,
+        'loop_lag_p99_ms': lag_samples[int(0.99 * (len(lag_samples) - 1))] * 1000 if lag_samples else 0.0,
+        'loop_lag_max_ms': lag_samples[-1] * 1000 if lag_samples else 0.0,
+        'match_seconds': match_seconds,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def run_dispatched(users, port, workers):
+    # Бот целиком в отдельных процессах: диспетчер + воркеры с общей SQLite
+    workdir = tempfile.mkdtemp(prefix='coffee-load-')
+    env = dict(os.environ, COFFEE_MODE='dispatcher', COFFEE_WORKERS=str(workers), COFFEE_STORAGE='sqlite',
+               COFFEE_MEDIA_DIR=placeholder_media(workdir), COFFEE_BOT_TOKEN='123:load', COFFEE_BOT_API_URL=f'http://127.0.0.1:{port}/bot',
+               COFFEE_WORKER_BASE_PORT=str(free_port()), COFFEE_METRICS_PORT='0',
+               COFFEE_DELIVERY_RATE='1000000')
+    bot = subprocess.Popen([sys.executable, os.path.join(BOT_DIR, 'boot.py')], env=env,
+                           cwd=workdir,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        started = time.monotonic()
+        for step, (kind, template) in enumerate(SCENARIO, start=1):
+            control(port, 'step', {'kind': kind, 'first_user': FIRST_USER, 'count': users, 'template': template})
+            stats = asyncio.run(wait_replies(port, users * step, STALL_TIMEOUT))
+        flow_seconds = time.monotonic() - started
+    finally:
+        bot.terminate()
+        bot.wait()
+    return {
+        'users': users,
+        'updates': users * len(SCENARIO),
+        'updates_per_second': users * len(SCENARIO) / flow_seconds,
+        'handler_p50_ms': None,
+        'handler_p99_ms': None,
+        'reply_p50_ms': stats['reply_p50'] * 1000,
+        'reply_p99_ms': stats['reply_p99'] * 1000,
+        'loop_lag_p99_ms': None,
+        'loop_lag_max_ms': None,
+        'match_seconds': None,
+        'peak_rss_mb': None,
+    }
+
+
+def run_size(users, workers=0, storage='json'):
+    port = free_port()
+    # stderr тоже глушим: при остановке бота фейковый API пишет BrokenPipe по оборванному getUpdates
+    fake = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'fake_bot_api.py'), str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(50):
+            try:
+                control(port, 'stats')
+                break
+            except OSError:
+                time.sleep(0.1)
+        if workers:
+            return run_dispatched(users, port, workers)
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', str(users), '--port', str(port)],
+            capture_output=True, text=True, check=True, env=dict(os.environ, COFFEE_STORAGE=storage)
+        )
+        return json.loads(result.stdout.strip().splitlines()[-1])
+    finally:
+        fake.terminate()
+        fake.wait()
+
+
+def fmt(value, spec):
+    if value is None:
+        return format('-', spec.rstrip('f').split('.')[0])
+    return format(value, spec)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', default='1000,10000,100000')
+    parser.add_argument('--max-p99', type=float, help='порог p99 задержки ответа, мс')
+    parser.add_argument('--min-rate', type=float, help='минимум апдейтов в секунду')
+    parser.add_argument('--workers', type=int, default=0, help='число воркеров в режиме dispatcher')
+    parser.add_argument('--storage', default='json', choices=('json', 'sqlite', 'journal'),
+                        help='хранилище бота в однопроцессном режиме (в режиме dispatcher всегда sqlite)')
+    parser.add_argument('--child', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(asyncio.run(run_bot(args.child, args.port))))
+        return
+
+    failed = False
+    print(f"{'users':>8} {'upd/s':>8} {'handler p50/p99, мс':>20} {'reply p50/p99, мс':>20} "
+          f"{'lag p99/max, мс':>16} {'match, с':>9} {'RSS, МБ':>8}")
+    for users in (int(value) for value in args.users.split(',')):
+        r = run_size(users, args.workers, args.storage)
+        print(f"{r['users']:>8} {r['updates_per_second']:>8.0f} "
+              f"{fmt(r['handler_p50_ms'], '>9.1f')}/{fmt(r['handler_p99_ms'], '<10.1f')} "
+              f"{r['reply_p50_ms']:>9.1f}/{r['reply_p99_ms']:<10.1f} "
+              f"{fmt(r['loop_lag_p99_ms'], '>7.1f')}/{fmt(r['loop_lag_max_ms'], '<8.1f')} "
+              f"{fmt(r['match_seconds'], '>9.1f')} {fmt(r['peak_rss_mb'], '>8.0f')}")
+        if args.max_p99 is not None and r['reply_p99_ms'] > args.max_p99:
+            print(f"Регрессия: p99 {r['reply_p99_ms']:.1f} мс > {args.max_p99} мс")
+            failed = True
+        if args.min_rate is not None and r['updates_per_second'] < args.min_rate:
+            print(f"Регрессия: {r['updates_per_second']:.0f} апдейтов/с < {args.min_rate}")
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,51 @@
 import logging
-import random
 import uuid
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
-from telegram.ext import Application, ApplicationBuilder, CommandHandler, CallbackContext, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
+from telegram.ext import Application, ApplicationBuilder, ApplicationHandlerStop, CommandHandler, TypeHandler, CallbackContext, CallbackQueryHandler, MessageHandler, filters, ContextTypes, ConversationHandler
 from telegram.constants import ParseMode
-import json
 import os
 import asyncio
 import re
+import io
+import tempfile
 import nest_asyncio
 import datetime
+import time
 import pytz
 import updater
 from warnings import filterwarnings
 from telegram.warnings import PTBUserWarning
-from telegram.error import BadRequest
+from user_repo import DEFAULT_TENANT, UserRepository, records_in_place, tenant_of_info
+from storage import PAIR_HISTORY, USER_CONTEXT, USER_DATA, create_storage, plain, update_row
+from write_behind import WriteBehindStorage
+from cycle_registry import CycleRegistry
+from delivery import DeliveryPipeline
+from admin_digest import AdminDigest
+from matching import MatchingEngine, PairHistory, pair_key
+from metrics import metrics, timed, start_metrics_server
+from update_processor import PerUserUpdateProcessor
+from webhook import run_webhook
+from persistence import StoragePersistence
+from shared_state import SHARED_DATASETS, SharedState
+from dispatcher import Dispatcher
+from leader import LeaderElection, RunLedger, run_once
+from feedback import RATINGS, FeedbackStore, format_stats
+from match_plan import MAX_ATTEMPTS, MatchPlanStore
+from delivery_schedule import schedule
+from media import ASSETS_DIR, MediaRegistry
+from throttle import UserThrottle
+from cold_storage import ColdStorage, move_to_archive, restore_from_archive
+from snapshot import SNAPSHOT_DATASETS, read_snapshot, storage_fingerprint, write_snapshot
+from tenants import jitter_seconds, load_tenants, parse_window, scoped
+from profiling import LoopWatchdog, profiler, trace_requests, tracer
+from roster import PAGE_SIZE, EXPORT_CHUNK, RosterExporter, describe_filter, export_row, make_predicate, parse_filter, render_page
 
 # Применение nest_asyncio
 nest_asyncio.apply()
 
 filterwarnings(action="ignore", message=r".*CallbackQueryHandler", category=PTBUserWarning)
+# Порядок апдейтов одного пользователя гарантирует PerUserUpdateProcessor
+filterwarnings(action="ignore", message=r".*concurrent_updates", category=PTBUserWarning)
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,121 +54,196 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-ADMIN_IDS = [647850100, 918094104] # 918094104
-cycle_users = []
-user_data = {}
-feedback_data = {}
-not_cycle_users = {}
+ADMIN_IDS = [647850100, 918094104] # 918094104 - админы пространства default
+TENANTS_FILE = os.environ.get('COFFEE_TENANTS_FILE', 'tenants.json') # пространства (команды) со своими админами и расписанием
+MATCH_JITTER = int(os.environ.get('COFFEE_MATCH_JITTER', '300')) # разброс времени подбора между пространствами, секунды
+BOT_TOKEN = os.environ.get('COFFEE_BOT_TOKEN', 'TOKER') # from BotFather
+STORAGE_BACKEND = os.environ.get('COFFEE_STORAGE', 'json') # json, sqlite или journal
+STORAGE_DB_PATH = os.environ.get('COFFEE_DB_PATH', 'coffee.db')
+STORAGE_FLUSH_INTERVAL = float(os.environ.get('COFFEE_FLUSH_INTERVAL', '1.0')) # секунды между сбросами на диск
+PERSISTENCE_INTERVAL = float(os.environ.get('COFFEE_PERSISTENCE_INTERVAL', '5')) # как часто PTB сохраняет диалоги и context.user_data
+DELIVERY_CONCURRENCY = int(os.environ.get('COFFEE_DELIVERY_CONCURRENCY', '16')) # одновременных отправок при рассылке
+DELIVERY_GLOBAL_RATE = int(os.environ.get('COFFEE_DELIVERY_RATE', '30')) # сообщений в секунду на весь бот
+DELIVERY_BATCH = int(os.environ.get('COFFEE_DELIVERY_BATCH', '50')) # сообщений о парах в одной партии внутри окна уведомлений
+DELIVERY_TICK = float(os.environ.get('COFFEE_DELIVERY_TICK', '60')) # как часто проверять, не пора ли выпустить партию, секунды
+METRICS_PORT = int(os.environ.get('COFFEE_METRICS_PORT', '9108')) # порт /metrics на localhost, 0 - выключено
+ADMIN_DIGEST_INTERVAL = int(os.environ.get('COFFEE_ADMIN_DIGEST_INTERVAL', '300')) # окно сводки для админов, секунды
+MATCH_CROSS_POSITION = os.environ.get('COFFEE_MATCH_CROSS_POSITION', '0') == '1' # предпочитать пары с разными должностями
+MATCH_SEED = os.environ.get('COFFEE_MATCH_SEED') # фиксированный seed для воспроизводимого подбора
+COLD_DB_PATH = os.environ.get('COFFEE_COLD_DB', 'coffee-cold.db') # архив неактивных пользователей
+ARCHIVE_AFTER_DAYS = int(os.environ.get('COFFEE_ARCHIVE_AFTER_DAYS', '90')) # дней без активности до переноса в архив, 0 - не архивировать
+ARCHIVE_INTERVAL = int(os.environ.get('COFFEE_ARCHIVE_INTERVAL', '21600')) # как часто искать неактивных, секунды
+SNAPSHOT_PATH = os.environ.get('COFFEE_SNAPSHOT', 'coffee.snapshot') # бинарный снимок для быстрого старта, пусто - выключен
+MEDIA_DIR = os.environ.get('COFFEE_MEDIA_DIR', ASSETS_DIR) # каталог с картинками бота (registration.png)
+BOT_MODE = os.environ.get('COFFEE_MODE', 'polling') # polling, webhook, dispatcher (несколько процессов) или worker
+BOT_API_URL = os.environ.get('COFFEE_BOT_API_URL') # другой адрес Bot API, например фейковый для нагрузочного теста
+WORKERS = int(os.environ.get('COFFEE_WORKERS', '4')) # число процессов-воркеров в режиме dispatcher
+WORKER_BASE_PORT = int(os.environ.get('COFFEE_WORKER_BASE_PORT', '8600')) # воркер i слушает порт WORKER_BASE_PORT + i
+WORKER_PORT = int(os.environ.get('COFFEE_WORKER_PORT', '0')) # задается диспетчером
+RUN_JOBS = os.environ.get('COFFEE_RUN_JOBS', '1') != '0' # выполнять ли задачи по расписанию в этом процессе
+LEASE_DB_PATH = os.environ.get('COFFEE_LEASE_DB', 'coffee-lease.db') # общий файл аренды лидера и журнала запусков
+LEASE_TTL = float(os.environ.get('COFFEE_LEASE_TTL', '30')) # секунды; за это время лидерство переходит к другой реплике
+THROTTLE_RATE = float(os.environ.get('COFFEE_THROTTLE_RATE', '2')) # апдейтов в секунду от одного пользователя
+THROTTLE_BURST = int(os.environ.get('COFFEE_THROTTLE_BURST', '5')) # сколько апдейтов подряд пропускать без ограничения
+CALLBACK_DEDUP_WINDOW = float(os.environ.get('COFFEE_CALLBACK_DEDUP_WINDOW', '2')) # одинаковые нажатия за это время обрабатываются один раз
+SLOW_CALLBACK_SECONDS = float(os.environ.get('COFFEE_SLOW_CALLBACK', '0.5')) # блокировка цикла событий дольше этого попадает в лог со стеком, 0 - выключено
+TRACE_UPDATES = os.environ.get('COFFEE_TRACE_UPDATES', '0') == '1' # трассировать апдейты с запуска (иначе /profile trace on)
+TRACE_MIN_MS = float(os.environ.get('COFFEE_TRACE_MIN_MS', '0')) # в трассы попадают апдейты не быстрее этого, мс
+CONCURRENT_UPDATES = int(os.environ.get('COFFEE_CONCURRENT_UPDATES', '16')) # апдейтов разных пользователей одновременно
+WEBHOOK_URL = os.environ.get('COFFEE_WEBHOOK_URL') # публичный https-адрес прокси перед ботом
+WEBHOOK_LISTEN = os.environ.get('COFFEE_WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.environ.get('COFFEE_WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('COFFEE_WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.environ.get('COFFEE_WEBHOOK_SECRET') # проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+user_data = UserRepository()
+
+# Конвейер рассылки с учетом ограничений Bot API
+delivery = DeliveryPipeline(global_rate=DELIVERY_GLOBAL_RATE, concurrency=DELIVERY_CONCURRENCY)
+
+# Сводка изменений состава цикла для админов, отправляется раз в ADMIN_DIGEST_INTERVAL (создается в load_state)
+admin_digest = None
+
+# Ограничение частоты апдейтов и повторных нажатий от одного пользователя
+throttle = UserThrottle(rate=THROTTLE_RATE, burst=THROTTLE_BURST, dedup_window=CALLBACK_DEDUP_WINDOW)
 
 # Статусы для ConversationHandler
 ASKING_EMAIL, ASKING_NAME, ASKING_POSITION, CONFIRMING_NAME, CONFIRMING_POSITION, SHOWING_CARD, LEAVING_FEEDBACK = range(7)
 
-# Функции загрузки и сохранения данных
-def load_data(filename, default):
-    try:
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-                logger.info(f"Данные загружены из {filename}: {data}")
-                return data
-        return default
-    except Exception as e:
-        logger.error(f"Не удалось загрузить данные из {filename}: {e}")
-        return default
+# Хранилище данных (JSON-файлы или SQLite) с отложенной записью из фонового потока.
+# Открывается и читается один раз в load_state(), при импорте модуля ничего не загружается
+storage = None
+# Пространства (tenants.json); пользователь попадает в пространство по ссылке /start <id>
+tenants = None
+# Состав текущего цикла (участники и отказавшиеся) хранится только здесь
+cycle_registry = None
+# В режиме worker: синхронизация кэшей с изменениями других процессов
+shared_state = None
+# Отзывы о встречах и статистика циклов
+feedback_store = None
+# План текущего цикла и журнал доставки; подбор и досылка не идут одновременно
+match_plans = None
+match_lock = asyncio.Lock()
+# Неактивные пользователи: вне памяти, возвращаются при следующем апдейте от них
+cold_storage = None
+# file_id загруженных картинок, чтобы не загружать их заново на каждую отправку
+media = None
+# Задачи по расписанию выполняет только реплика-лидер, каждую - один раз за цикл
+leader = None
+run_ledger = None
+
+# История встреч и движок подбора пар
+pair_history = PairHistory()
+matching_engine = MatchingEngine(
+    pair_history,
+    prefer_cross_position=MATCH_CROSS_POSITION,
+    seed=int(MATCH_SEED) if MATCH_SEED else None
+)
 
-def save_data(data, filename):
-    try:
-        with open(filename, 'w', encoding='utf-8') as file:
-            json.dump(data, file, ensure_ascii=False, indent=4)
-            logger.info(f"Данные сохранены в {filename}: {data}")
-    except Exception as e:
-        logger.error(f"Не удалось сохранить данные в {filename}: {e}")
+metrics.gauge_callback('coffee_cycle_users', lambda: cycle_registry.count() if cycle_registry else 0)
+metrics.gauge_callback('coffee_users', lambda: len(user_data))
+metrics.gauge_callback('coffee_cold_users', lambda: cold_storage.count() if cold_storage else 0)
 
-user_data = load_data('user_data.json', {})
-cycle_users = load_data('cycle_users.json', {})
-feedback_data = load_data('feedback_data.json', {})
-not_cycle_users = load_data('not_cycle_users.json', {})
-logger.info(f"Загружены cycle users: {cycle_users}")
-logger.info(f"Загружены user data: {user_data}")
+def admin_tenant(user_id):
+    # Пространство, которым управляет пользователь, или None, если он не админ
+    return tenants.admin_tenant(user_id)
+
+def record_cycle_change(user_uuid, was_member, is_member):
+    admin_digest.record(user_uuid, user_data.tenant_of(user_uuid), was_member=was_member, is_member=is_member)
 
 def handle_cycle_start(update: Update, context):
     user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
 
     # Проверяем, есть ли уже UUID для данного пользователя в user_data
-    for uuid_key, user_info in user_data.items():
-        if user_info.get('id') == user_id:
-            context.user_data['uuid'] = uuid_key
-            return context.user_data['uuid']
+    uuid_key = user_data.find_by_telegram_id(user_id)
+    if uuid_key is not None:
+        context.user_data['uuid'] = uuid_key
+        return context.user_data['uuid']
 
     # Если UUID не найден, создаем новый
     user_uuid = str(uuid.uuid4())
     context.user_data['uuid'] = user_uuid
-    user_data[user_uuid] = {
+    info = user_data.upsert(user_uuid, {
         'id': user_id,
         'email': '',
         'name': '',
-        'position': ''
-    }
-    save_data(user_data, 'user_data.json')
+        'position': '',
+        'tenant': context.user_data.get('tenant', DEFAULT_TENANT)
+    })
+    storage.put('user_data', user_uuid, info)
     return user_uuid
 
 # Обновление функции start для вызова handle_cycle_start
+@timed
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Получена команда /start")
     user_id = update.message.from_user.id
     context.user_data['id'] = user_id
 
-    for uuid_key, user_info in user_data.items():
-        if user_info.get('id') == user_id:
-            context.user_data['uuid'] = uuid_key
-            context.user_data['email'] = user_info.get('email', '')
-            context.user_data['name'] = user_info.get('name', '')
-            context.user_data['position'] = user_info.get('position', '')
-            await update.message.reply_text(
-                f"Ваши текущие данные:\nИмя: {context.user_data['name']}\nПочта: {context.user_data['email']}\nДолжность: {context.user_data['position']}\n\n"
-                "Хотите изменить что-нибудь или начать новый цикл?",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Изменить данные", callback_data='new_cycle')],
-                    [InlineKeyboardButton("Начать новый цикл", callback_data='join_cycle')]
-                ])
-            )
-            return SHOWING_CARD
+    # Ссылка t.me/<бот>?start=<id пространства> приходит как /start <id>
+    if context.args:
+        if tenants.get(context.args[0]) is not None:
+            context.user_data['tenant'] = context.args[0]
+        else:
+            logger.warning(f"Неизвестное пространство в /start: {context.args[0]}")
+
+    uuid_key, user_info = user_data.get_by_telegram_id(user_id)
+    if uuid_key is not None:
+        context.user_data['uuid'] = uuid_key
+        await update.message.reply_text(
+            f"Ваши текущие данные:\nИмя: {user_info.name}\nПочта: {user_info.email}\nДолжность: {user_info.position}\n\n"
+            "Хотите изменить что-нибудь или начать новый цикл?",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("Изменить данные", callback_data='new_cycle')],
+                [InlineKeyboardButton("Начать новый цикл", callback_data='join_cycle')]
+            ])
+        )
+        return SHOWING_CARD
     return await start_registration(update, context)
 
 
+@timed
 async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Начало регистрации")
     user_id = update.message.from_user.id if update.message else update.callback_query.from_user.id
 
-    for uuid_key, user_info in user_data.items():
-        if user_info.get('id') == user_id:
-            await update.message.reply_text("Вы уже зарегистрированы в боте. Используйте команду /start для начала.")
-            return ConversationHandler.END
+    if user_data.find_by_telegram_id(user_id) is not None:
+        await update.message.reply_text("Вы уже зарегистрированы в боте. Используйте команду /start для начала.")
+        return ConversationHandler.END
 
-    if user_id in ADMIN_IDS:
+    if admin_tenant(user_id) is not None:
         commands = [
             BotCommand("start", "Начать работу"),
             BotCommand("show_all_users", "Показать пользователей в сессии"),
             BotCommand("match", "Выбрать пару"),
             BotCommand("clear_database", "Очистить базу данных"),
-            BotCommand("leave_feedback", "Оставить фидбек")
+            BotCommand("stats", "Статистика цикла"),
+            BotCommand("tiers", "Активные и архивные пользователи"),
+            BotCommand("leave_feedback", "Оставить фидбек"),
+            BotCommand("timezone", "Часовой пояс и время уведомлений")
         ]
+        if admin_tenant(user_id) == DEFAULT_TENANT:
+            commands.append(BotCommand("profile", "Профилирование бота"))
     else:
         commands = [
             BotCommand("start", "Начать работу"),
-            BotCommand("leave_feedback", "Оставить фидбек")
+            BotCommand("leave_feedback", "Оставить фидбек"),
+            BotCommand("timezone", "Часовой пояс и время уведомлений")
         ]
 
-    await context.bot.set_my_commands(commands, scope=BotCommandScopeChat(user_id))
+    # Меню команд в чате уже такое - не вызываем Bot API повторно
+    signature = ','.join(command.command for command in commands)
+    if context.user_data.get('commands') != signature:
+        await context.bot.set_my_commands(commands, scope=BotCommandScopeChat(user_id))
+        context.user_data['commands'] = signature
 
     keyboard = [[InlineKeyboardButton("Поехали 🚀", callback_data='start_registration')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    image_url = 'https://i.ibb.co/rfMcqY5/img.png'
-    
+
     try:
-        await context.bot.send_photo(
+        await media.send(
+            context.bot,
+            'registration',
             chat_id=update.message.chat.id if update.message else update.callback_query.message.chat.id,
-            photo=image_url,
             caption="Привет! Я чат бот random-coffee, созданный для лучшего знакомства среди друзей компании! Давай начнем?",
             reply_markup=reply_markup,
         )
@@ -152,24 +253,28 @@ async def start_registration(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     return ASKING_EMAIL
 
+@timed
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
     logger.info(f"Получен callback_query: {query.data}")
 
     if query.data == 'start_registration':
+        # Пространство из ссылки /start и установленное меню команд переживают сброс
+        kept = {key: context.user_data[key] for key in ('tenant', 'commands') if key in context.user_data}
         context.user_data.clear()
+        context.user_data.update(kept)
         logger.info("Состояние сброшено. Начинаем регистрацию, состояние ASKING_EMAIL")
         await query.message.reply_text(
             text="Отлично! Для начала давай узнаем твою почту? Напиши её ниже 😉"
         )
         return ASKING_EMAIL
     elif query.data == 'use_existing':
-        user_info = context.user_data
-        if user_info:
+        user_info = user_data.get(context.user_data.get('uuid'))
+        if user_info is not None:
             logger.info("Используем существующие данные пользователя")
             await query.message.reply_text(
-                f"Ваши текущие данные:\nИмя: {user_info.get('name', 'Не указано')}\nПочта: {user_info.get('email', 'Не указана')}\nДолжность: {user_info.get('position', 'Не указана')}\n\nХотите изменить что-нибудь или начать новый цикл?",
+                f"Ваши текущие данные:\nИмя: {user_info.name or 'Не указано'}\nПочта: {user_info.email or 'Не указана'}\nДолжность: {user_info.position or 'Не указана'}\n\nХотите изменить что-нибудь или начать новый цикл?",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("Изменить данные", callback_data='new_cycle')],
                     [InlineKeyboardButton("Начать новый цикл", callback_data='join_cycle')]
@@ -195,12 +300,13 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     logger.info("Обработчик кнопок завершен")
     return ConversationHandler.END
 
+@timed
 async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         context.user_data['name'] = update.message.text
         logger.info(f"User name: {context.user_data['name']}")
 
-        if 'email' in context.user_data:
+        if draft(context, 'email'):
             await update.message.reply_text("Записал! Теперь введи свою должность 🧑‍🏭")
             return ASKING_POSITION
         else:
@@ -211,6 +317,7 @@ async def get_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text("Произошла ошибка. Попробуйте снова позже.")
         return ConversationHandler.END
 
+@timed
 async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     email = update.message.text
 
@@ -223,39 +330,69 @@ async def get_email(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         user_id = update.message.from_user.id
         context.user_data['id'] = user_id
 
-    for uuid_key, info in user_data.items():
-        if info.get('id') == user_id:
-            context.user_data['email'] = email
-            context.user_data['uuid'] = uuid_key
-            user_data[uuid_key]['email'] = email
-            save_data(user_data, 'user_data.json')
-            await update.message.reply_text(
-                f"Ваши текущие данные:\nИмя: {info.get('name', 'Не указано')}\nПочта: {email}\nДолжность: {info.get('position', 'Не указана')}\n\nХотите изменить что-нибудь или начать новый цикл?",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Изменить данные", callback_data='new_cycle')],
-                    [InlineKeyboardButton("Начать новый цикл", callback_data='join_cycle')]
-                ])
-            )
-            return SHOWING_CARD
+    # Одна почта - один профиль: поиск по индексу, а не перебором user_data
+    owner_uuid = user_data.find_by_email(email)
+    if owner_uuid is not None and user_data[owner_uuid].id != user_id:
+        await update.message.reply_text("Эта почта уже указана в профиле другого пользователя. Пожалуйста, введите свою почту")
+        return ASKING_EMAIL
+
+    # Почта сразу сохраняется в профиль, отдельно в context.user_data ее не держим
+    uuid_key = user_data.find_by_telegram_id(user_id)
+    if uuid_key is not None:
+        context.user_data['uuid'] = uuid_key
+        info = user_data.update(uuid_key, email=email)
+        storage.put('user_data', uuid_key, info)
+        await update.message.reply_text(
+            f"Ваши текущие данные:\nИмя: {info.name or 'Не указано'}\nПочта: {email}\nДолжность: {info.position or 'Не указана'}\n\nХотите изменить что-нибудь или начать новый цикл?",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("Изменить данные", callback_data='new_cycle')],
+                [InlineKeyboardButton("Начать новый цикл", callback_data='join_cycle')]
+            ])
+        )
+        return SHOWING_CARD
 
     new_user_uuid = str(uuid.uuid4())
-    context.user_data['email'] = email
     context.user_data['uuid'] = new_user_uuid
-    user_data[new_user_uuid] = {
+    info = user_data.upsert(new_user_uuid, {
         'id': user_id,
         'email': email,
         'name': '',
-        'position': ''
-    }
-    save_data(user_data, 'user_data.json')
+        'position': '',
+        'tenant': context.user_data.get('tenant', DEFAULT_TENANT)
+    })
+    storage.put('user_data', new_user_uuid, info)
     await update.message.reply_text("Записал! Теперь введи своё имя и фамилию 😉")
     return ASKING_NAME
 
 
+# Поля анкеты, которые пользователь вводит по шагам
+PROFILE_FIELDS = ('name', 'email', 'position')
+
+def draft(context, field):
+    # Поле анкеты: введенное в этом разговоре (context.user_data), иначе из сохраненного профиля
+    if field in context.user_data:
+        return context.user_data[field]
+    info = user_data.get(context.user_data.get('uuid'))
+    return getattr(info, field) if info is not None else None
+
+def save_profile(context):
+    # Записать анкету в профиль; черновик после этого не нужен - профиль уже в UserRecord
+    user_id = context.user_data['uuid']
+    info = user_data.update(
+        user_id,
+        id=context.user_data['id'],
+        **{field: draft(context, field) for field in PROFILE_FIELDS}
+    )
+    storage.put('user_data', user_id, info)
+    for field in PROFILE_FIELDS:
+        context.user_data.pop(field, None)
+    return info
+
 def is_valid_email(email):
     email_regex = r'^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$'
     return re.match(email_regex, email) is not None
 
+@timed
 async def confirm_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -264,7 +401,7 @@ async def confirm_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         return ASKING_NAME
     else:
         await query.message.reply_text(
-            f"Отлично! В прошлой сессии твоя должность была - {context.user_data['position']}. Изменилась ли твоя должность?",
+            f"Отлично! В прошлой сессии твоя должность была - {draft(context, 'position')}. Изменилась ли твоя должность?",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("Да", callback_data='change_position')],
                 [InlineKeyboardButton("Нет", callback_data='keep_position')]
@@ -272,6 +409,7 @@ async def confirm_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
         )
         return CONFIRMING_POSITION
 
+@timed
 async def confirm_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     await query.answer()
@@ -279,14 +417,7 @@ async def confirm_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await query.message.reply_text("Пожалуйста, введите новую должность 🧑‍🏭")
         return ASKING_POSITION
     else:
-        user_id = context.user_data['uuid']
-        user_data[user_id] = {
-            'id': context.user_data['id'],
-            'name': context.user_data['name'],
-            'email': context.user_data['email'],
-            'position': context.user_data['position']
-        }
-        save_data(user_data, 'user_data.json')
+        info = save_profile(context)
         keyboard = [
             [InlineKeyboardButton("Я участвую в текущем цикле 👍", callback_data='join_cycle')],
             [InlineKeyboardButton("Пока не хочу участвовать 👎", callback_data='not_join_cycle')]
@@ -294,28 +425,22 @@ async def confirm_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.reply_text(
             f"Супер! Твоя карточка готова, давай посмотрим, как она выглядит :)\n\n"
-            f"Имя: {context.user_data['name']} 🌸\n"
-            f"Почта: {context.user_data['email']} 📫\n"
-            f"Должность: {context.user_data['position']} 👀",
+            f"Имя: {info.name} 🌸\n"
+            f"Почта: {info.email} 📫\n"
+            f"Должность: {info.position} 👀",
             reply_markup=reply_markup
         )
         return SHOWING_CARD
 
+@timed
 async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    if 'name' not in context.user_data or 'email' not in context.user_data:
+    if draft(context, 'name') is None or draft(context, 'email') is None:
         await update.message.reply_text("Кажется, я еще не знаю твое имя или почту. Пожалуйста, введи ваше имя, фамилию и почту.")
         return ASKING_NAME
     context.user_data['position'] = update.message.text
 
-    user_id = context.user_data['uuid']
-    user_data[user_id] = {
-        'id': context.user_data['id'],
-        'name': context.user_data['name'],
-        'email': context.user_data['email'],
-        'position': context.user_data['position']
-    }
-    save_data(user_data, 'user_data.json')
-    logger.info(f"User position: {context.user_data['position']}")
+    info = save_profile(context)
+    logger.info(f"User position: {info.position}")
     keyboard = [
         [InlineKeyboardButton("Я участвую в текущем цикле 👍", callback_data='join_cycle')],
         [InlineKeyboardButton("Пока не хочу участвовать 👎", callback_data='not_join_cycle')]
@@ -323,99 +448,178 @@ async def get_position(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text(
         f"Супер! Твоя карточка готова, давай посмотрим, как она выглядит :)\n\n"
-        f"Имя: {context.user_data['name']} 🌸\n"
-        f"Почта: {context.user_data['email']} 📫\n"
-        f"Должность: {context.user_data['position']} 👀",
+        f"Имя: {info.name} 🌸\n"
+        f"Почта: {info.email} 📫\n"
+        f"Должность: {info.position} 👀",
         reply_markup=reply_markup
     )
     return SHOWING_CARD
 
+@timed
 async def cycle_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
 
     user_uuid = context.user_data['uuid']
     chat_id = update.effective_chat.id
-
-    # Загрузка данных из cycle_users.json
-    cycle_users = load_data('cycle_users.json', {})
+    tenant = user_data.tenant_of(user_uuid)
 
     if query.data == 'join_cycle':
-        if user_uuid not in cycle_users:
-            cycle_users[user_uuid] = chat_id
-            save_data(cycle_users, 'cycle_users.json')
-        if user_uuid in not_cycle_users:
-            del not_cycle_users[user_uuid]
-            save_data(not_cycle_users, 'not_cycle_users.json')
-        logger.info(f"Добавлен пользователь {user_uuid} в цикл: {list(cycle_users.keys())}")
-        num_users_text = get_user_count_text(len(cycle_users))
+        if await cycle_registry.join(user_uuid, chat_id):
+            record_cycle_change(user_uuid, was_member=False, is_member=True)
+            info = user_data.update(user_uuid, last_cycle=cycle_date(tenant))
+            storage.put('user_data', user_uuid, info)
+        logger.info(f"Добавлен пользователь {user_uuid} в цикл {tenant}, участников: {cycle_registry.count(tenant)}")
+        num_users_text = get_user_count_text(cycle_registry.count(tenant))
         await query.message.reply_text(
             text=f"Отлично! На данный момент в текущем цикле участвует {num_users_text}. Ожидайте, пока наберется достаточное количество людей для выбора пары :) Сообщение о результате придет в этот чат."
         )
-        await notify_cycle_user_count(context)
     elif query.data == 'not_join_cycle':
-        if user_uuid not in not_cycle_users:
-            not_cycle_users[user_uuid] = chat_id
-            save_data(not_cycle_users, 'not_cycle_users.json')
-        if user_uuid in cycle_users:
-            del cycle_users[user_uuid]
-            save_data(cycle_users, 'cycle_users.json')
-        logger.info(f"Пользователь {user_uuid} не в цикле: {list(not_cycle_users.keys())}")
+        if await cycle_registry.leave(user_uuid, chat_id):
+            record_cycle_change(user_uuid, was_member=True, is_member=False)
+        logger.info(f"Пользователь {user_uuid} не в цикле {tenant}, участников: {cycle_registry.count(tenant)}")
         keyboard = [[InlineKeyboardButton("Ну ладно, я передумал - участвую!", callback_data='join_cycle')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.message.reply_text(
             text="Ничего страшного, если передумаешь - нажми кнопку ниже и я добавлю тебя в текущий цикл :)",
             reply_markup=reply_markup
         )
-        await notify_cycle_user_count(context)
     return SHOWING_CARD
 
 
 async def notify_cycle_users_command(update: Update = None, context: ContextTypes.DEFAULT_TYPE = None):
     if update:
-        if update.message.from_user.id not in ADMIN_IDS:
+        tenant = admin_tenant(update.message.from_user.id)
+        if tenant is None:
             await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
             return
-        await notify_cycle_user_count(context)
+        await notify_cycle_user_count(context, tenant)
         await update.message.reply_text("Уведомление о количестве пользователей в текущем цикле отправлено администраторам.")
     else:
-        await notify_cycle_user_count(context)
+        await notify_cycle_user_count(context, context.job.data)
 
+SHOW_USERS_USAGE = (
+    "Использование:\n"
+    "/show_all_users [cycle | not_cycle | position=<должность>]\n"
+    "/show_all_users export [csv | jsonl] [cycle | not_cycle | position=<должность>]"
+)
+
+def build_users_page(context):
+    cursors = context.user_data['users_cursors']
+    spec = context.user_data.get('users_filter')
+    tenant = context.user_data.get('users_tenant', DEFAULT_TENANT)
+    items, next_cursor = user_data.page(cursors[-1], PAGE_SIZE, make_predicate(spec, cycle_registry), tenant=tenant)
+    text, shown = render_page(items, len(cursors), spec)
+    if shown < len(items):
+        # Страница упёрлась в лимит длины сообщения - продолжим со следующей карточки
+        next_cursor = user_data.cursor_of(items[shown][0], tenant=tenant)
+    context.user_data['users_next'] = next_cursor
+
+    # В кнопках номер страницы: show_users_page правит то же сообщение, и без номера нажатия
+    # "Вперед" на разных страницах выглядели бы для throttle_handler повтором одного нажатия
+    buttons = []
+    if len(cursors) > 1:
+        buttons.append(InlineKeyboardButton("⬅️ Назад", callback_data=f'users_prev:{len(cursors)}'))
+    if next_cursor is not None:
+        buttons.append(InlineKeyboardButton("Вперед ➡️", callback_data=f'users_next:{len(cursors)}'))
+    return text, shown, InlineKeyboardMarkup([buttons]) if buttons else None
+
+@timed
 async def show_all_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.from_user.id not in ADMIN_IDS:
+    tenant = admin_tenant(update.message.from_user.id)
+    if tenant is None:
         await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
         return
 
-    data = load_data('user_data.json', {})
-    if not data:
+    args = list(context.args or [])
+    fmt = None
+    if args and args[0] == 'export':
+        args.pop(0)
+        fmt = args.pop(0) if args and args[0] in ('csv', 'jsonl') else 'csv'
+    try:
+        spec = parse_filter(args)
+    except ValueError:
+        await update.message.reply_text(SHOW_USERS_USAGE)
+        return
+
+    if fmt:
+        await export_users(update, context, fmt, spec, tenant)
+        return
+
+    context.user_data['users_filter'] = spec
+    context.user_data['users_tenant'] = tenant
+    context.user_data['users_cursors'] = [0]
+    text, shown, reply_markup = build_users_page(context)
+    if not shown:
         await update.message.reply_text("Нет данных пользователей.")
         return
+    await update.message.reply_text(text, reply_markup=reply_markup)
 
-    message = "Карточки пользователей:\n"
-    for user_id, info in data.items():
-        logger.info(f"user_id: {user_id}, info: {info}, type(info): {type(info)}")
-        
-        if isinstance(info, dict):
-            name = info.get('name', 'Не указано')
-            email = info.get('email', 'Не указано')
-            position = info.get('position', 'Не указано')
-            message += f"Имя: {name}\nПочта: {email}\nДолжность: {position}\n\n"
-        else:
-            logger.error(f"Ожидался словарь, но получен {type(info)} для user_id {user_id}")
+@timed
+async def show_users_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    if admin_tenant(query.from_user.id) is None:
+        return
+
+    cursors = context.user_data.get('users_cursors')
+    if not cursors:
+        await query.message.reply_text("Список устарел, вызовите /show_all_users еще раз.")
+        return
+    action, _, page = query.data.partition(':')
+    # Кнопка со страницы, которую уже перелистнули (нажатие, пришедшее до правки сообщения)
+    if page and int(page) != len(cursors):
+        return
+    if action == 'users_next' and context.user_data.get('users_next') is not None:
+        cursors.append(context.user_data['users_next'])
+    elif action == 'users_prev' and len(cursors) > 1:
+        cursors.pop()
+
+    text, shown, reply_markup = build_users_page(context)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def export_users(update: Update, context: ContextTypes.DEFAULT_TYPE, fmt, spec, tenant):
+    # Пишем пользователей во временный файл порциями и отправляем его документом
+    predicate = make_predicate(spec, cycle_registry)
+    with tempfile.TemporaryFile() as raw:
+        text_file = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        exporter = RosterExporter(text_file, fmt)
+        cursor = 0
+        while cursor is not None:
+            items, cursor = user_data.page(cursor, EXPORT_CHUNK, predicate, tenant=tenant)
+            for user_uuid, info in items:
+                exporter.write(export_row(user_uuid, info, cycle_registry))
+            # Отдаем управление циклу событий между порциями
+            await asyncio.sleep(0)
+        text_file.flush()
+        text_file.detach()
+
+        if not exporter.rows:
+            await update.message.reply_text("Нет данных пользователей.")
+            return
 
-    await update.message.reply_text(message)
+        raw.seek(0)
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=raw,
+            filename=f"users.{fmt}",
+            caption=f"Выгрузка: {describe_filter(spec)}, {exporter.rows} пользователей"
+        )
 
+@timed
 async def match(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.from_user.id not in ADMIN_IDS:
+    tenant = admin_tenant(update.message.from_user.id)
+    if tenant is None:
         await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
         return
 
-    await match_logic(user_data, context)
+    await match_logic(user_data, context, tenant)
 
+@timed
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
-    logger.info(f"context.user_data в button_handler: {context.user_data}")
+    logger.debug(f"context.user_data в button_handler: {context.user_data}")
 
     if query.data == 'yes_meet':
         meet_link = "https://calendar.google.com/calendar/u/0/r/eventedit?vcon=meet&dates=now&hl=ru"
@@ -435,117 +639,184 @@ async def scheduled_match(context: ContextTypes.DEFAULT_TYPE):
     job_data = context.job.data
     await match_logic(job_data['user_data'], context)
 
-async def match_logic(user_data_dict, context: ContextTypes.DEFAULT_TYPE):
-    logger.info("Функция match вызвана")
-    
-    # Загрузка данных из cycle_users.json
-    cycle_users_data = load_data('cycle_users.json', {})
+@timed
+async def match_logic(user_data_dict, context: ContextTypes.DEFAULT_TYPE, tenant=DEFAULT_TENANT):
+    logger.info(f"Функция match вызвана для пространства {tenant}")
+    sync_state()
+
+    async with match_lock:
+        # Незавершенный план не пересчитываем, а досылаем
+        cycle = match_plans.active(tenant)
+        if cycle:
+            logger.info(f"Есть незавершенный цикл {cycle}, досылаем")
+            await apply_plan(cycle)
+            await deliver_plan(context, cycle)
+            # Сегодняшний план не пересчитываем; досланный план прошлого дня подбор не отменяет
+            if match_plans.active(tenant) or cycle.startswith(scoped(cycle_date(tenant), tenant)):
+                logger.info(f"Подбор пропущен: цикл {cycle} еще не завершен или уже проведен сегодня")
+                return
+        await create_match(user_data_dict, context, tenant)
+
+async def create_match(user_data_dict, context: ContextTypes.DEFAULT_TYPE, tenant):
+    # Снимок участников цикла пространства на момент подбора пар
+    cycle_users_data = cycle_registry.snapshot(tenant)
 
     if len(cycle_users_data) < 2:
-        for admin_id in ADMIN_IDS:
-            await context.bot.send_message(chat_id=admin_id, text="OOPS! Недостаточно пользователей для создания пары.")
+        await notify_admins(context, "OOPS! Недостаточно пользователей для создания пары.", tenant)
         return
 
     cycle_users_in_data = [user_uuid for user_uuid in cycle_users_data if user_uuid in user_data_dict]
     missing_users = [user_uuid for user_uuid in cycle_users_data if user_uuid not in user_data_dict]
 
     if missing_users:
-        logger.warning(f"Пользователи без данных: {missing_users}")
+        logger.warning(f"Пользователи без данных: {len(missing_users)}")
+        logger.debug(f"Пользователи без данных: {missing_users[:50]}")
 
     if len(cycle_users_in_data) < 2:
-        for admin_id in ADMIN_IDS:
-            await context.bot.send_message(chat_id=admin_id, text="OOPS! Недостаточно данных для пользователей, чтобы создать пару.")
+        await notify_admins(context, "OOPS! Недостаточно данных для пользователей, чтобы создать пару.", tenant)
         return
 
-    random.shuffle(cycle_users_in_data)
-    pairs = []
-    used_users = set()
-
-    while len(cycle_users_in_data) >= 2:
-        user1_uuid = cycle_users_in_data.pop()
-        user2_uuid = cycle_users_in_data.pop()
-        
-        if user1_uuid in used_users or user2_uuid in used_users:
-            continue
-
-        pairs.append((user1_uuid, user2_uuid))
-        used_users.update([user1_uuid, user2_uuid])
+    # Подбор пар с учетом истории встреч, нечетный участник попадает в тройку
+    positions = {user_uuid: user_data_dict[user_uuid].position for user_uuid in cycle_users_in_data}
+    result = matching_engine.match(cycle_users_in_data, positions)
+    pairs = result.groups
 
     # Обработка пользователей, которым не удалось найти пару
-    remaining_users = [user_uuid for user_uuid in cycle_users_in_data if user_uuid not in used_users]
-    
-    if pairs:
-        for user1_uuid, user2_uuid in pairs:
-            user1 = user_data_dict.get(user1_uuid, {})
-            user2 = user_data_dict.get(user2_uuid, {})
+    remaining_users = result.leftover
 
-            if not user1 or not user2:
-                logger.error(f"Данные пользователей не найдены: {user1_uuid}, {user2_uuid}")
-                continue
+    # Собираем все сообщения; клавиатура добавляется при отправке, в плане хранится только флаг
+    messages = []
+    for group in pairs:
+        users = [user_data_dict.get(user_uuid) for user_uuid in group]
 
-            user1_chat_id = cycle_users_data.get(user1_uuid)
-            user2_chat_id = cycle_users_data.get(user2_uuid)
+        if not all(users):
+            logger.error(f"Данные пользователей не найдены: {', '.join(group)}")
+            continue
 
-            if not user1_chat_id or not user2_chat_id:
-                logger.error(f"Chat ID не найден для пользователей: {user1_uuid}, {user2_uuid}")
-                continue
+        chat_ids = [cycle_users_data.get(user_uuid) for user_uuid in group]
 
-            keyboard = [
-                [InlineKeyboardButton("Да, давай :)", callback_data='yes_meet')],
-                [InlineKeyboardButton("Нет, пока не нужно!", callback_data='no_meet')]
-            ]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-
-            logger.info(f"Отправка сообщения пользователю {user1_uuid} ({user1_chat_id}) и {user2_uuid} ({user2_chat_id})")
-            try:
-                await context.bot.send_message(
-                    chat_id=user1_chat_id,
-                    text=f"ВЖУХХ! И я создал пару! Это {user1.get('name', 'Пользователь')} и {user2.get('name', 'Пользователь')} 😊!\n\n"
-                         f"Напишите друг другу, и договоритесь о времени встречи или видеозвонка. Вы можете устроить онлайн-коворкинг 💻 или запланировать совместный кофе-брейк ☕️\n\n"
-                         f"А можем вообще прямо сейчас сделать встречу в Google Meet, что скажешь? 🧐",
-                    reply_markup=reply_markup
-                )
-            except BadRequest as e:
-                logger.error(f"Ошибка при отправке сообщения пользователю {user1_uuid} ({user1_chat_id}): {e}")
-
-            try:
-                await context.bot.send_message(
-                    chat_id=user2_chat_id,
-                    text=f"ВЖУХХ! И я создал пару! Это {user1.get('name', 'Пользователь')} и {user2.get('name', 'Пользователь')} 😊!\n\n"
-                         f"Напишите друг другу, и договоритесь о времени встречи или видеозвонка. Вы можете устроить онлайн-коворкинг 💻 или запланировать совместный кофе-брейк ☕️\n\n"
-                         f"А можем вообще прямо сейчас сделать встречу в Google Meet, что скажешь? 🧐",
-                    reply_markup=reply_markup
-                )
-            except BadRequest as e:
-                logger.error(f"Ошибка при отправке сообщения пользователю {user2_uuid} ({user2_chat_id}): {e}")
-
-    if remaining_users:
-        for user_uuid in remaining_users:
-            user = user_data_dict.get(user_uuid, {})
-            user_chat_id = cycle_users_data.get(user_uuid)
-            if not user_chat_id:
-                logger.error(f"Chat ID не найден для пользователя: {user_uuid}")
-                continue
+        if not all(chat_ids):
+            logger.error(f"Chat ID не найден для пользователей: {', '.join(group)}")
+            continue
 
-            try:
-                await context.bot.send_message(
-                    chat_id=user_chat_id,
-                    text=f"К сожалению, на этот раз не удалось найти пару для встречи. Но не волнуйтесь, вы автоматически будете включены в следующий цикл."
-                )
-            except BadRequest as e:
-                logger.error(f"Ошибка при отправке сообщения пользователю {user_uuid} ({user_chat_id}): {e}")
+        names = [user.name or 'Пользователь' for user in users]
+        names_text = ' и '.join(names) if len(names) == 2 else f"{', '.join(names[:-1])} и {names[-1]}"
+        text = (f"ВЖУХХ! И я создал {'пару' if len(group) == 2 else 'тройку'}! Это {names_text} 😊!\n\n"
+                f"Напишите друг другу, и договоритесь о времени встречи или видеозвонка. Вы можете устроить онлайн-коворкинг 💻 или запланировать совместный кофе-брейк ☕️\n\n"
+                f"А можем вообще прямо сейчас сделать встречу в Google Meet, что скажешь? 🧐")
+        for user_uuid, chat_id in zip(group, chat_ids):
+            messages.append({'key': user_uuid, 'chat_id': chat_id, 'text': text, 'keyboard': True})
 
-    # Сохраняем оставшихся пользователей в cycle_users.json
     for user_uuid in remaining_users:
-        cycle_users_data[user_uuid] = user_data_dict[user_uuid]['id']
-    save_data(cycle_users_data, 'cycle_users.json')
-
+        user_chat_id = cycle_users_data.get(user_uuid)
+        if not user_chat_id:
+            logger.error(f"Chat ID не найден для пользователя: {user_uuid}")
+            continue
+        messages.append({
+            'key': user_uuid,
+            'chat_id': user_chat_id,
+            'text': "К сожалению, на этот раз не удалось найти пару для встречи. Но не волнуйтесь, вы автоматически будете включены в следующий цикл."
+        })
+
+    # Партии по часовым поясам и окнам уведомлений получателей
+    config = tenants.resolve(tenant)
+    recipients = [(message['key'],) + delivery_slot(message['key'], config) for message in messages]
+    # Последняя партия и повторы после временных ошибок укладываются до следующего подбора:
+    # незавершенный план заменил бы собой новый
+    now = time.time()
+    deadline = config.next_run(config.match_at, now) - (MAX_ATTEMPTS + 1) * DELIVERY_TICK
+    batches = schedule(recipients, now, DELIVERY_BATCH, deadline=deadline)
+
+    # Сначала сохраняем план цикла и журнал доставки, потом отправляем
+    cycle = feedback_store.new_cycle_id(scoped(cycle_date(tenant), tenant))
+    await match_plans.create(cycle, pairs, remaining_users, messages, tenant=tenant, batches=batches)
+    await apply_plan(cycle, registered=user_data.tenant_size(tenant), members=len(cycle_users_data))
+    metrics.set('coffee_match_groups', len(pairs))
+    metrics.inc('coffee_match_groups_total', len(pairs))
+
+    await deliver_plan(context, cycle)
+    if match_plans.next_batch(cycle) is not None:
+        last = datetime.datetime.fromtimestamp(batches[-1][0], config.timezone)
+        await notify_admins(context, f"Сообщения о парах цикла {cycle} отправляются по окнам уведомлений: "
+                                     f"партий {len(batches)}, последняя {last:%d.%m %H:%M} ({config.timezone.zone})", tenant)
     logger.info("Функция match завершена")
 
-    # Удаление использованных пользователей из cycle_users
-    cycle_users_data = {k: v for k, v in cycle_users_data.items() if k not in used_users}
-    save_data(cycle_users_data, 'cycle_users.json')
+def delivery_slot(user_uuid, tenant):
+    # Часовой пояс и окно уведомлений пользователя; без своих настроек - как у пространства
+    info = user_data.get(user_uuid)
+    timezone = pytz.timezone(info.timezone) if info is not None and info.timezone else tenant.timezone
+    window = parse_window(info.window) if info is not None and info.window else tenant.delivery_window
+    return timezone, window
+
+async def apply_plan(cycle, registered=None, members=None):
+    # Учет цикла по сохраненному плану; при досылке после сбоя выполняется, только если не успел
+    plan = match_plans.get(cycle)
+    if plan['status'] != 'planned':
+        return
+    groups = plan['groups']
+    tenant = plan.get('tenant', DEFAULT_TENANT)
+    feedback_store.record_cycle(cycle, groups, members=members if members is not None else len(plan['recipients']),
+                                registered=registered if registered is not None else user_data.tenant_size(tenant),
+                                tenant=tenant)
+
+    # Запоминаем встречи, чтобы в следующих циклах не сводить тех же людей. Счетчик
+    # увеличивается в хранилище, а не по своей копии: ее мог обогнать другой воркер
+    for group in groups:
+        for i in range(len(group)):
+            for j in range(i + 1, len(group)):
+                count = update_row(storage, PAIR_HISTORY, pair_key(group[i], group[j]), lambda n: (n or 0) + 1)
+                pair_history.set(group[i], group[j], count)
+
+    # Удаление использованных пользователей из цикла, оставшиеся переходят в следующий
+    await cycle_registry.remove([user_uuid for group in groups for user_uuid in group])
+    match_plans.set_status(cycle, 'delivering')
+
+async def deliver_plan(context, cycle):
+    # Рассылка по недоставленным записям журнала, время которых наступило; каждая отмечается
+    # сразу после отправки. Следующие партии выпускает задача release_deliveries
+    plan = match_plans.get(cycle)
+    messages, released = match_plans.due(cycle, time.time())
+    if not messages and released == plan.get('released', 0) and match_plans.next_batch(cycle) is not None:
+        return
 
+    keyboard = [
+        [InlineKeyboardButton("Да, давай :)", callback_data='yes_meet')],
+        [InlineKeyboardButton("Нет, пока не нужно!", callback_data='no_meet')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    for message in messages:
+        if message.get('keyboard'):
+            message['reply_markup'] = reply_markup
+
+    if messages:
+        logger.info(f"Отправка сообщений о парах за цикл {cycle}: {len(messages)}")
+        await delivery.deliver(context.bot, messages,
+                               on_result=lambda message, outcome: match_plans.mark(cycle, message['key'], outcome))
+    remaining = match_plans.finish_pass(cycle, released, messages)
+    if not remaining:
+        counts = match_plans.counts(cycle)
+        await notify_admins(context, f"Рассылка цикла {cycle} завершена: доставлено {counts['sent']} из {len(plan['recipients'])}, "
+                                     f"отклонено {counts['rejected']}, не доставлено {counts['failed']}",
+                            plan.get('tenant', DEFAULT_TENANT))
+
+async def release_deliveries(context: ContextTypes.DEFAULT_TYPE):
+    # Выпуск партий по расписанию и повторы после временных ошибок - только на реплике-лидере.
+    # Эта же задача досылает незавершенный план после перезапуска
+    if not leader.is_leader():
+        return
+    # Планы пространств, убранных из tenants.json, тоже досылаются (с настройками default)
+    tenant_ids = dict.fromkeys([tenant.id for tenant in tenants] + user_data.tenant_ids())
+    for tenant_id in tenant_ids:
+        cycle = match_plans.active(tenant_id)
+        if not cycle:
+            continue
+        async with match_lock:
+            if match_plans.active(tenant_id) != cycle:
+                continue
+            await apply_plan(cycle)
+            await deliver_plan(context, cycle)
+
+@timed
 async def leave_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     logger.info(f"Пользователь {update.message.from_user.id} оставляет отзыв.")
     
@@ -561,6 +832,7 @@ async def leave_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         reply_markup=reply_markup
     )
 
+@timed
 async def feedback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -572,42 +844,209 @@ async def feedback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     }
     
     feedback_text = feedback_responses.get(query.data)
-    
-    user_id = context.user_data.get('id', str(uuid.uuid4()))
-    feedback_data[user_id] = query.data
-    save_data(feedback_data, 'feedback_data.json')
-    
+
+    user_uuid = user_data.find_by_telegram_id(query.from_user.id)
+    if user_uuid is None:
+        await query.message.reply_text("Сначала зарегистрируйся через /start :)")
+        return
+    if feedback_store.record(user_uuid, RATINGS[query.data]) is None:
+        await query.message.reply_text("Пока не было встречи, которую можно оценить. Дождись пары в следующем цикле :)")
+        return
+
     await query.message.reply_text(feedback_text)
 
+TIMEZONE_USAGE = (
+    "Использование:\n"
+    "/timezone <часовой пояс> [ЧЧ:ММ-ЧЧ:ММ]\n"
+    "Например: /timezone Europe/Berlin 09:00-18:00 - сообщение о паре придет в это время по Берлину"
+)
+
+def format_window(window):
+    return f"{window[0]:%H:%M}-{window[1]:%H:%M}" if window else "в любое время"
+
+@timed
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_uuid, info = user_data.get_by_telegram_id(update.message.from_user.id)
+    if user_uuid is None:
+        await update.message.reply_text("Сначала зарегистрируйся через /start :)")
+        return
+    if not context.args:
+        timezone, window = delivery_slot(user_uuid, tenants.resolve(tenant_of_info(info)))
+        await update.message.reply_text(f"Часовой пояс: {timezone.zone}\nОкно уведомлений: {format_window(window)}\n\n{TIMEZONE_USAGE}")
+        return
+
+    zone = context.args[0]
+    window = context.args[1] if len(context.args) > 1 else ''
+    try:
+        pytz.timezone(zone)
+        parsed = parse_window(window)
+    except (pytz.UnknownTimeZoneError, ValueError):
+        await update.message.reply_text(TIMEZONE_USAGE)
+        return
+    info = user_data.update(user_uuid, timezone=zone, window=window)
+    storage.put('user_data', user_uuid, info)
+    await update.message.reply_text(f"Записал! Часовой пояс: {zone}, окно уведомлений: {format_window(parsed)}")
+
+@timed
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = admin_tenant(update.message.from_user.id)
+    if tenant is None:
+        await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
+        return
+    # /stats [id цикла], по умолчанию - последний цикл пространства
+    cycle, cycle_stats = feedback_store.stats(context.args[0] if context.args else None, tenant)
+    if not cycle_stats:
+        await update.message.reply_text("Статистики пока нет." if not cycle else f"Цикл {cycle} не найден.")
+        return
+    await update.message.reply_text(format_stats(cycle, cycle_stats))
+
+@timed
+async def tiers(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    tenant = admin_tenant(update.message.from_user.id)
+    if tenant is None:
+        await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
+        return
+    policy = (f"В архив уходят после {ARCHIVE_AFTER_DAYS} дн. без активности и возвращаются при следующем сообщении боту."
+              if ARCHIVE_AFTER_DAYS else "Архивация выключена.")
+    await update.message.reply_text(
+        f"Пользователей в памяти: {user_data.tenant_size(tenant)}\n"
+        f"В архиве: {cold_storage.count(tenant)}\n"
+        f"Всего в боте: в памяти {len(user_data)}, в архиве {cold_storage.count()} "
+        f"({cold_storage.size_bytes() / 1024:.0f} КБ)\n\n{policy}"
+    )
+
+PROFILE_USAGE = (
+    "/profile start - начать профилирование цикла событий\n"
+    "/profile stop - остановить и получить профиль файлом (collapsed stacks для flamegraph.pl или speedscope)\n"
+    "/profile trace on [мс] - трассировать апдейты: обработчики, хранилище, вызовы Bot API; "
+    "с порогом - только апдейты не быстрее стольких мс\n"
+    "/profile trace off - выключить трассировку\n"
+    "/profile traces - последние трассы файлом"
+)
+
+@timed
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Профилирование касается всего процесса, поэтому доступно только админам пространства по умолчанию
+    if admin_tenant(update.message.from_user.id) != DEFAULT_TENANT:
+        await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
+        return
+    args = context.args or []
+    action = args[0] if args else ''
+
+    if action == 'start':
+        # Обработчик выполняется в потоке цикла событий - его и профилируем
+        if profiler.start():
+            await update.message.reply_text(f"Профилирование запущено, не дольше {profiler.max_seconds} с. "
+                                            f"Остановить: /profile stop")
+        else:
+            await update.message.reply_text("Профилирование уже идет. Остановить: /profile stop")
+    elif action == 'stop':
+        result = profiler.stop()
+        if result is None:
+            await update.message.reply_text("Профилирование не запущено. Начать: /profile start")
+            return
+        text, samples, seconds = result
+        if not samples:
+            await update.message.reply_text("За время профилирования не собрано ни одной выборки.")
+            return
+        top = '\n'.join(f"{count * 100 / samples:.0f}% {frame}" for frame, count in profiler.top())
+        top = top or "цикл событий простаивал"
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=io.BytesIO(text.encode('utf-8')),
+            filename=f"profile-{int(time.time())}.folded",
+            caption=f"Профиль за {seconds:.0f} с, выборок {samples}. Чаще всего в стеке:\n{top}"[:1024]
+        )
+    elif action == 'trace' and len(args) > 1 and args[1] in ('on', 'off'):
+        if args[1] == 'off':
+            tracer.disable()
+            await update.message.reply_text("Трассировка апдейтов выключена.")
+            return
+        try:
+            min_ms = float(args[2]) if len(args) > 2 else 0.0
+        except ValueError:
+            await update.message.reply_text(PROFILE_USAGE)
+            return
+        tracer.enable(min_ms / 1000)
+        await update.message.reply_text(f"Трассировка апдейтов включена (от {min_ms:g} мс). Трассы: /profile traces")
+    elif action == 'traces':
+        text = tracer.dump()
+        if not text:
+            await update.message.reply_text("Трасс пока нет. Включить: /profile trace on")
+            return
+        await context.bot.send_document(
+            chat_id=update.effective_chat.id,
+            document=io.BytesIO(text.encode('utf-8')),
+            filename=f"traces-{int(time.time())}.txt",
+            caption=f"Последние трассы апдейтов: {len(tracer.recent)}"
+        )
+    else:
+        await update.message.reply_text(PROFILE_USAGE)
+
+@timed
 async def clear_database(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.from_user.id not in ADMIN_IDS:
+    tenant = admin_tenant(update.message.from_user.id)
+    if tenant is None:
         await update.message.reply_text("OOPS! Эта команда доступна только администраторам.")
         return
-    global user_data
-    user_data = {}
-    save_data(user_data, 'user_data.json')
+    if len(tenants) == 1:
+        user_data.clear()
+        storage.replace('user_data', {})
+        cold_storage.clear()
+    else:
+        # Удаляем только пользователей своего пространства
+        for user_uuid in user_data.tenant_uuids(tenant):
+            user_data.delete(user_uuid)
+            storage.delete('user_data', user_uuid)
+        cold_storage.clear(tenant)
     await update.message.reply_text("База данных успешно очищена!")
 
-async def notify_admins(context, message: str):
-    for admin_id in ADMIN_IDS:
+async def notify_admins(context, message: str, tenant=DEFAULT_TENANT):
+    config = tenants.get(tenant)
+    if config is None:
+        logger.error(f"Пространство {tenant} не найдено в {TENANTS_FILE}, сообщение админам не отправлено")
+        return
+    for admin_id in config.admins:
         try:
             await context.bot.send_message(chat_id=admin_id, text=message)
+            metrics.inc('coffee_messages_sent_total', outcome='sent')
         except Exception as e:
+            metrics.inc('coffee_messages_sent_total', outcome='failed')
             logger.error(f"Не удалось отправить сообщение админу {admin_id}: {e}")
 
-async def notify_cycle_user_count(context: ContextTypes.DEFAULT_TYPE):
-    cycle_users = load_data('cycle_users.json', {})
-    num_users = len(cycle_users)
+async def notify_cycle_user_count(context: ContextTypes.DEFAULT_TYPE, tenant):
+    sync_state()
+    num_users = cycle_registry.count(tenant)
     message = f"На данный момент в текущем цикле {num_users} пользователей."
-    await notify_admins(context, message)
+    await notify_admins(context, message, tenant)
+
 
+async def send_admin_digest(context: ContextTypes.DEFAULT_TYPE):
+    # Сводку отправляет только лидер: изменения всех реплик он читает из хранилища
+    if not leader.is_leader():
+        return
+    sync_state()
+
+    def name_of(user_uuid):
+        info = user_data.get(user_uuid)
+        return info.name if info is not None and info.name else user_uuid
+
+    pending = admin_digest.pending()
+    for tenant in dict.fromkeys([tenant.id for tenant in tenants] + list(pending)):
+        changes = pending.get(tenant)
+        if not changes:
+            admin_digest.skip(tenant)
+            continue
+        message = admin_digest.build(tenant, changes, cycle_registry.count(tenant), name_of)
+        if message:
+            await notify_admins(context, message, tenant)
 
 async def check_cycle_users(context: ContextTypes.DEFAULT_TYPE):
     logger.info("Проверка пользователей цикла")
-    if len(cycle_users) == 0:
+    if cycle_registry.count() == 0:
         await notify_admins(context, "Нет пользователей в текущем цикле.")
     else:
-        await notify_admins(context, f"В текущем цикле {len(cycle_users)} пользователей.")
+        await notify_admins(context, f"В текущем цикле {cycle_registry.count()} пользователей.")
     logger.info("Завершена проверка пользователей цикла")
 
 def get_user_count_text(count):
@@ -631,7 +1070,8 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 async def set_commands(application):
     commands = [
         BotCommand("start", "Начать работу"),
-        BotCommand("leave_feedback", "Оставить фидбек")
+        BotCommand("leave_feedback", "Оставить фидбек"),
+        BotCommand("timezone", "Часовой пояс и время уведомлений")
     ]
     await application.bot.set_my_commands(commands)
 
@@ -646,32 +1086,251 @@ async def send_message_to_chat(context: CallbackContext):
     except Exception as e:
         logger.error(f"Ошибка при отправке сообщения: {e}")
 
+def cycle_date(tenant=DEFAULT_TENANT):
+    return tenants.resolve(tenant).today()
+
+async def run_exclusive(job, callback, tenant=DEFAULT_TENANT):
+    # Один запуск за цикл на одной реплике; не-лидер ждет до двух сроков аренды (см. leader.run_once)
+    await run_once(leader, run_ledger, scoped(job, tenant), cycle_date(tenant), callback, wait=LEASE_TTL * 2)
+
+def today_utc():
+    return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+def archive_user(application, user_uuid):
+    telegram_id = user_data[user_uuid].id
+    user_context = application.user_data.get(telegram_id) or storage.get(USER_CONTEXT, telegram_id)
+    move_to_archive(cold_storage, storage, user_data, cycle_registry, user_uuid, user_context)
+    if telegram_id is not None:
+        application.drop_user_data(telegram_id)
+
+def rehydrate(telegram_id, context):
+    # Возврат пользователя из архива при первом апдейте от него; None, если в архиве его нет
+    restored = restore_from_archive(cold_storage, storage, user_data, cycle_registry, telegram_id)
+    if restored is None:
+        return None
+    user_uuid, user_context = restored
+    if user_context and not context.user_data:
+        # PTB уже прочитал пустой context.user_data - заполняем его, persistence сохранит сам
+        context.user_data.update(user_context)
+    metrics.inc('coffee_rehydrated_users_total')
+    logger.info(f"Пользователь {user_uuid} возвращен из архива")
+    return user_uuid
+
+async def archive_inactive(context: CallbackContext):
+    # Перенос пользователей без активности дольше ARCHIVE_AFTER_DAYS в архив - только на лидере.
+    # Участников текущего цикла не трогаем
+    if not leader.is_leader():
+        return
+    sync_state()
+    today = today_utc()
+    cutoff = (datetime.date.fromisoformat(today) - datetime.timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    candidates = []
+    for user_uuid, info in list(user_data.items()):
+        last_seen = info.last_seen
+        if not last_seen:
+            # Пользователи, заведенные до учета активности: отсчет идет с первого прохода
+            storage.put('user_data', user_uuid, user_data.update(user_uuid, last_seen=today))
+        elif last_seen < cutoff and not cycle_registry.is_member(user_uuid):
+            candidates.append(user_uuid)
+    for index, user_uuid in enumerate(candidates):
+        archive_user(context.application, user_uuid)
+        if index % 500 == 499:
+            # Отдаем управление циклу событий между порциями
+            await asyncio.sleep(0)
+    if candidates:
+        metrics.inc('coffee_archived_users_total', len(candidates))
+        logger.info(f"В архив перенесено неактивных пользователей: {len(candidates)}, в памяти осталось {len(user_data)}")
+
+async def renew_lease(context: CallbackContext):
+    leader.acquire()
+
 async def notify_admins_task(context: CallbackContext):
-    await notify_cycle_users_command(None, context)
+    # context.job.data - id пространства
+    await run_exclusive('notify_admins', lambda: notify_cycle_users_command(None, context), context.job.data)
 
 async def run_match_task(context: CallbackContext):
-    await match_logic(user_data, context)
+    tenant = context.job.data
+    await run_exclusive('run_match', lambda: match_logic(user_data, context, tenant), tenant)
+
+async def on_startup(application):
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await start_metrics_server(port=METRICS_PORT)
+    if SLOW_CALLBACK_SECONDS:
+        watchdog = LoopWatchdog(SLOW_CALLBACK_SECONDS)
+        watchdog.start(asyncio.get_running_loop())
+        application.bot_data['loop_watchdog'] = watchdog
+
+async def on_shutdown(application):
+    # Сбрасываем несохраненные изменения перед выходом
+    server = application.bot_data.get('metrics_server')
+    if server:
+        server.close()
+    watchdog = application.bot_data.get('loop_watchdog')
+    if watchdog:
+        watchdog.stop()
+    profiler.stop()
+    cold_storage.close()
+    if leader:
+        # Отдаем лидерство сразу, не дожидаясь истечения аренды
+        leader.release()
+        leader.close()
+        run_ledger.close()
+    datasets = None
+    if SNAPSHOT_PATH and STORAGE_BACKEND != 'journal':
+        datasets = {dataset: storage.load(dataset) for dataset in SNAPSHOT_DATASETS}
+        # marshal сохраняет только встроенные типы - профили пишем в формате хранилища
+        datasets[USER_DATA] = {key: info if isinstance(info, dict) else plain(info)
+                               for key, info in datasets[USER_DATA].items()}
+    storage.close()
+    if datasets is not None:
+        # Отпечаток берем после закрытия, когда все изменения уже на диске
+        try:
+            write_snapshot(SNAPSHOT_PATH, datasets, storage_fingerprint(STORAGE_BACKEND, db_path=STORAGE_DB_PATH))
+        except Exception as e:
+            logger.error(f"Не удалось записать снимок {SNAPSHOT_PATH}: {e}")
+
+def open_storage():
+    if BOT_MODE == 'worker':
+        # Воркеры делят одну SQLite: пишем сразу и ведем ленту изменений для остальных процессов
+        return create_storage('sqlite', db_path=STORAGE_DB_PATH, track_changes=SHARED_DATASETS)
+    # Журнал событий дописывает одну строку на изменение, поэтому пишет сразу
+    backend = create_storage(STORAGE_BACKEND, db_path=STORAGE_DB_PATH)
+    if STORAGE_BACKEND == 'journal':
+        return backend
+    return WriteBehindStorage(backend, interval=STORAGE_FLUSH_INTERVAL)
+
+def load_state():
+    # Единственное место загрузки данных: сначала бинарный снимок, если он актуален, иначе JSON/SQLite
+    global storage, tenants, cycle_registry, shared_state, feedback_store, match_plans, media, cold_storage, admin_digest
+
+    started = time.perf_counter()
+    snapshot = None
+    if SNAPSHOT_PATH:
+        snapshot = read_snapshot(SNAPSHOT_PATH, storage_fingerprint(STORAGE_BACKEND, db_path=STORAGE_DB_PATH))
+    storage = open_storage()
+    if snapshot:
+        if USER_DATA in snapshot:
+            # Профили из снимка сразу становятся UserRecord, без промежуточной копии словарей
+            records_in_place(snapshot[USER_DATA])
+        storage.prime(snapshot)
+
+    tenants = load_tenants(TENANTS_FILE, ADMIN_IDS)
+    cycle_registry = CycleRegistry(storage, tenant_of=user_data.tenant_of)
+    if BOT_MODE == 'worker':
+        # Позицию в ленте изменений запоминаем до чтения данных, чтобы ничего не пропустить
+        shared_state = SharedState(storage, user_data, cycle_registry, pair_history=pair_history)
+    user_data.load(storage.load('user_data'))
+    if hasattr(storage, 'adopt'):
+        # Кэш хранилища держит те же UserRecord, что и user_data, а не вторую копию словарей
+        storage.adopt(USER_DATA, user_data.data)
+    cycle_registry.load()
+    feedback_store = FeedbackStore(storage)
+    admin_digest = AdminDigest(storage)
+    match_plans = MatchPlanStore(storage)
+    media = MediaRegistry(storage, directory=MEDIA_DIR)
+    media.check()
+    cold_storage = ColdStorage(COLD_DB_PATH)
+    pair_history.load(storage.load('pair_history'))
+    logger.info(f"Данные загружены {'из снимка' if snapshot else 'из хранилища'} за {time.perf_counter() - started:.3f} с: "
+                f"пользователей {len(user_data)}, участников цикла {cycle_registry.count()}")
+
+def sync_state():
+    # В многопроцессном режиме дочитываем изменения, сделанные другими воркерами
+    if shared_state:
+        shared_state.sync()
+
+async def sync_state_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    sync_state()
+
+async def activity_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Группа -1: возврат из архива и отметка активности (last_seen пишется не чаще раза в день)
+    user = update.effective_user
+    if user is None:
+        return
+    user_uuid = user_data.find_by_telegram_id(user.id)
+    if user_uuid is None:
+        user_uuid = rehydrate(user.id, context)
+        if user_uuid is None:
+            return
+    today = today_utc()
+    if user_data[user_uuid].last_seen != today:
+        storage.put('user_data', user_uuid, user_data.update(user_uuid, last_seen=today))
+
+async def throttle_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Группа -3, до всех обработчиков: повторы, спам и нажатия, которые ничего не меняют,
+    # получают дешевый ответ на callback и дальше не обрабатываются
+    user = update.effective_user
+    if user is None:
+        return
+    query = update.callback_query
+    if query and throttle.is_duplicate(user.id, (query.data, query.message.message_id if query.message else None)):
+        metrics.inc('coffee_throttled_total', reason='duplicate')
+        await query.answer()
+        raise ApplicationHandlerStop
+    if not throttle.allow(user.id):
+        metrics.inc('coffee_throttled_total', reason='rate')
+        if query:
+            await query.answer("Слишком часто, подожди пару секунд 🙂")
+        raise ApplicationHandlerStop
+    if query and query.data in ('join_cycle', 'not_join_cycle'):
+        sync_state()
+        user_uuid = user_data.find_by_telegram_id(user.id)
+        if user_uuid is None:
+            return
+        if query.data == 'join_cycle' and cycle_registry.is_member(user_uuid):
+            text = "Ты уже участвуешь в текущем цикле 👍"
+        elif (query.data == 'not_join_cycle' and not cycle_registry.is_member(user_uuid)
+              and cycle_registry.is_opted_out(user_uuid)):
+            text = "Ты уже не участвуешь в текущем цикле"
+        else:
+            return
+        metrics.inc('coffee_throttled_total', reason='noop')
+        await query.answer(text)
+        raise ApplicationHandlerStop
+
+def build_application(token=BOT_TOKEN, base_url=BOT_API_URL):
+    # Собирает Application со всеми обработчиками и задачами; base_url позволяет
+    # направить бота на локальный Bot API (нагрузочный тест)
+    global leader, run_ledger
+    builder = ApplicationBuilder().token(token).post_init(on_startup).post_shutdown(on_shutdown)
+    # Разные пользователи обрабатываются параллельно, апдейты одного пользователя - по порядку
+    builder = builder.concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES, tracer=tracer))
+    # Состояния регистрации и context.user_data переживают перезапуск
+    builder = builder.persistence(StoragePersistence(storage, update_interval=PERSISTENCE_INTERVAL))
+    if base_url:
+        builder = builder.base_url(base_url)
+    application = builder.build()
+    job_queue = application.job_queue
+    # Вызовы Bot API из обработчиков попадают в трассы апдейтов
+    trace_requests(application.bot.request, tracer)
+    if TRACE_UPDATES:
+        tracer.enable(TRACE_MIN_MS / 1000)
 
-async def main():
-    global user_data, cycle_users, feedback_data, not_cycle_users
+    if RUN_JOBS:
+        leader = LeaderElection(LEASE_DB_PATH, ttl=LEASE_TTL)
+        run_ledger = RunLedger(LEASE_DB_PATH)
+        job_queue.run_repeating(renew_lease, interval=LEASE_TTL / 3, first=0, name="leader_lease")
 
-    application = ApplicationBuilder().token("TOKER").build() # from BotFather
-    job_queue = application.job_queue
+        for tenant in tenants:
+            # Уведомление администраторам пространства в его часовом поясе
+            job_queue.run_daily(notify_admins_task, time=tenant.daily_time(tenant.notify_at), data=tenant.id,
+                                name=scoped("notify_admins", tenant.id))
 
-    user_data = load_data('user_data.json', {})
-    cycle_users = load_data('cycle_users.json', {})
-    feedback_data = load_data('feedback_data.json', {})
-    not_cycle_users = load_data('not_cycle_users.json', {})
-    logger.info(f"Загружены cycle users: {cycle_users}")
-    logger.info(f"Загружены user data: {user_data}")
+            # Подбор пар; сдвиг по пространствам, чтобы рассылки не упирались в общий лимит отправки
+            jitter = jitter_seconds(tenant.id, MATCH_JITTER) if len(tenants) > 1 else 0
+            job_queue.run_daily(run_match_task, time=tenant.daily_time(tenant.match_at, jitter), data=tenant.id,
+                                name=scoped("run_match", tenant.id))
+            logger.info(f"Пространство {tenant.id}: подбор пар в {tenant.match_at} {tenant.timezone} + {jitter} с")
 
-    minsk_tz = pytz.timezone('Europe/Minsk')
+        # Партии сообщений о парах по окнам уведомлений и досылка после перезапуска
+        job_queue.run_repeating(release_deliveries, interval=DELIVERY_TICK, first=LEASE_TTL / 3, name="release_deliveries")
 
-    # Уведомление администраторам в 9:50
-    job_queue.run_daily(notify_admins_task, time=datetime.time(15, 13, 0, tzinfo=minsk_tz), name="notify_admins")
+        if ARCHIVE_AFTER_DAYS:
+            # Перенос неактивных пользователей в архив
+            job_queue.run_repeating(archive_inactive, interval=ARCHIVE_INTERVAL, first=ARCHIVE_INTERVAL, name="archive_inactive")
 
-    # Запуск функции /match в 10:00
-    job_queue.run_daily(run_match_task, time=datetime.time(20, 48, 0, tzinfo=minsk_tz), name="run_match")
+        # Сводка изменений состава цикла для админов
+        job_queue.run_repeating(send_admin_digest, interval=ADMIN_DIGEST_INTERVAL, first=ADMIN_DIGEST_INTERVAL, name="admin_digest")
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('start', start)],
@@ -690,19 +1349,55 @@ async def main():
             ]
         },
         fallbacks=[],
+        name='registration',
+        persistent=True,
     )
 
+    application.add_handler(TypeHandler(Update, throttle_handler), group=-3)
+    if shared_state:
+        # Пользователя перенес в архив лидер - этот воркер забывает его context.user_data,
+        # иначе копия осталась бы в памяти и вернулась бы в базу при следующей записи
+        shared_state.on_user_removed = application.drop_user_data
+        application.add_handler(TypeHandler(Update, sync_state_handler), group=-2)
+    application.add_handler(TypeHandler(Update, activity_handler), group=-1)
     application.add_handler(conv_handler)
     application.add_handler(CommandHandler('start', start))
     application.add_handler(CommandHandler('show_all_users', show_all_users))
     application.add_handler(CommandHandler('match', match))
     application.add_handler(CommandHandler('clear_database', clear_database))
     application.add_handler(CommandHandler('leave_feedback', leave_feedback))
+    application.add_handler(CommandHandler('stats', stats))
+    application.add_handler(CommandHandler('tiers', tiers))
+    application.add_handler(CommandHandler('timezone', set_timezone))
+    application.add_handler(CommandHandler('profile', profile))
     application.add_handler(CallbackQueryHandler(button_handler, pattern='^yes_meet$|^no_meet$'))
+    application.add_handler(CallbackQueryHandler(show_users_page, pattern=r'^users_(prev|next)(:\d+)?$'))
     application.add_handler(CallbackQueryHandler(feedback_handler, pattern='^feedback_1$|^feedback_2$|^feedback_3$'))
     application.add_error_handler(error_handler)
+    return application
 
-    await application.run_polling()
+async def main():
+    if BOT_MODE == 'dispatcher':
+        # Сам диспетчер данных не читает - это делают воркеры
+        if STORAGE_BACKEND != 'sqlite':
+            raise RuntimeError("Для режима dispatcher нужно COFFEE_STORAGE=sqlite (перенос: python storage.py migrate)")
+        dispatcher = Dispatcher(WORKERS, base_port=WORKER_BASE_PORT, path=WEBHOOK_PATH, metrics_port=METRICS_PORT)
+        await dispatcher.run(BOT_TOKEN, base_url=BOT_API_URL, webhook_url=WEBHOOK_URL, listen=WEBHOOK_LISTEN,
+                             port=WEBHOOK_PORT, webhook_secret=WEBHOOK_SECRET)
+        return
+
+    load_state()
+    application = build_application()
+    if BOT_MODE == 'worker':
+        await run_webhook(application, None, listen='127.0.0.1', port=WORKER_PORT,
+                          path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    elif BOT_MODE == 'webhook':
+        if not WEBHOOK_URL:
+            raise RuntimeError("Для режима webhook нужен COFFEE_WEBHOOK_URL")
+        await run_webhook(application, WEBHOOK_URL, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                          path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    else:
+        await application.run_polling()
 
 if __name__ == '__main__':
     nest_asyncio.apply()
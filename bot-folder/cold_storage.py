@@ -0,0 +1,117 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from storage import NOT_CYCLE_USERS, USER_CONTEXT, USER_DATA, USER_MATCHES
+
+logger = logging.getLogger(__name__)
+
+
+class ColdStorage:
+    # Архив неактивных пользователей в отдельной SQLite: одна строка на пользователя, все его
+    # данные - сжатый JSON. В памяти бота архивные пользователи не держатся, найти их можно
+    # только по telegram_id (индекс в базе), когда пользователь снова пишет боту
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cold_users (
+                key TEXT PRIMARY KEY,
+                telegram_id INTEGER,
+                tenant TEXT NOT NULL,
+                archived_at REAL NOT NULL,
+                payload BLOB NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS cold_users_telegram_id ON cold_users (telegram_id);
+            CREATE INDEX IF NOT EXISTS cold_users_tenant ON cold_users (tenant);
+        """)
+
+    def archive(self, user_uuid, telegram_id, tenant, payload):
+        # payload: {набор данных: значение} - все, что нужно вернуть в горячее хранилище
+        blob = zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cold_users (key, telegram_id, tenant, archived_at, payload) VALUES (?, ?, ?, ?, ?)",
+                (user_uuid, telegram_id, tenant, time.time(), blob)
+            )
+
+    def find_by_telegram_id(self, telegram_id):
+        with self._lock:
+            row = self._conn.execute("SELECT key FROM cold_users WHERE telegram_id = ? LIMIT 1", (telegram_id,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, user_uuid):
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM cold_users WHERE key = ?", (user_uuid,)).fetchone()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8')) if row else None
+
+    def delete(self, user_uuid):
+        with self._lock:
+            self._conn.execute("DELETE FROM cold_users WHERE key = ?", (user_uuid,))
+
+    def count(self, tenant=None):
+        with self._lock:
+            if tenant is None:
+                return self._conn.execute("SELECT COUNT(*) FROM cold_users").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM cold_users WHERE tenant = ?", (tenant,)).fetchone()[0]
+
+    def clear(self, tenant=None):
+        with self._lock:
+            if tenant is None:
+                self._conn.execute("DELETE FROM cold_users")
+            else:
+                self._conn.execute("DELETE FROM cold_users WHERE tenant = ?", (tenant,))
+
+    def size_bytes(self):
+        return sum(os.path.getsize(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def move_to_archive(cold_storage, storage, user_data, cycle_registry, user_uuid, user_context=None):
+    # Сначала запись в архив, потом удаление из горячего хранилища: при сбое между ними
+    # пользователь остается в обоих местах, и следующий проход перезапишет архив.
+    # Возвращает telegram_id, чтобы вызывающий забыл и context.user_data пользователя
+    info = user_data[user_uuid]
+    payload = {USER_DATA: info.to_dict()}
+    opted_out = cycle_registry.opted_out.get(user_uuid)
+    if opted_out is not None:
+        payload[NOT_CYCLE_USERS] = opted_out
+    user_match = storage.get(USER_MATCHES, user_uuid)
+    if user_match is not None:
+        payload[USER_MATCHES] = user_match
+    if user_context:
+        payload[USER_CONTEXT] = dict(user_context)
+    cold_storage.archive(user_uuid, info.id, user_data.tenant_of(user_uuid), payload)
+
+    user_data.delete(user_uuid)
+    storage.delete(USER_DATA, user_uuid)
+    cycle_registry.archive(user_uuid)
+    if user_match is not None:
+        storage.delete(USER_MATCHES, user_uuid)
+    return info.id
+
+
+def restore_from_archive(cold_storage, storage, user_data, cycle_registry, telegram_id):
+    # Возврат пользователя из архива в горячее хранилище: (uuid, сохраненный context.user_data
+    # или None); None, если в архиве его нет
+    user_uuid = cold_storage.find_by_telegram_id(telegram_id)
+    if user_uuid is None:
+        return None
+    payload = cold_storage.load(user_uuid)
+    info = user_data.upsert(user_uuid, payload[USER_DATA])
+    storage.put(USER_DATA, user_uuid, info)
+    cycle_registry.restore(user_uuid, payload.get(NOT_CYCLE_USERS))
+    if USER_MATCHES in payload:
+        storage.put(USER_MATCHES, user_uuid, payload[USER_MATCHES])
+    cold_storage.delete(user_uuid)
+    return user_uuid, payload.get(USER_CONTEXT)
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+
+from storage import CYCLE_USERS, NOT_CYCLE_USERS
+from user_repo import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+
+class CycleRegistry:
+    # Единственный владелец состава текущего цикла: участники (uuid -> chat_id) и отказавшиеся.
+    # Данные живут в памяти, изменения идут под asyncio.Lock и сохраняются через хранилище.
+    # Участники дополнительно разложены по пространствам (tenant_of(uuid)), чтобы подбор
+    # и счетчики одного пространства не обходили всех участников
+
+    def __init__(self, storage, tenant_of=None):
+        self.storage = storage
+        self.tenant_of = tenant_of or (lambda user_uuid: DEFAULT_TENANT)
+        self.members = {}
+        self.opted_out = {}
+        self._by_tenant = {}
+        self._member_tenant = {}
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        self.members = self.storage.load(CYCLE_USERS)
+        self.opted_out = self.storage.load(NOT_CYCLE_USERS)
+        self._by_tenant = {}
+        self._member_tenant = {}
+        for user_uuid, chat_id in self.members.items():
+            self._index(user_uuid, chat_id)
+        logger.info(f"Загружено участников цикла: {len(self.members)}, отказавшихся: {len(self.opted_out)}")
+
+    def _index(self, user_uuid, chat_id):
+        tenant = self.tenant_of(user_uuid)
+        self._member_tenant[user_uuid] = tenant
+        self._by_tenant.setdefault(tenant, {})[user_uuid] = chat_id
+
+    def _unindex(self, user_uuid):
+        tenant = self._member_tenant.pop(user_uuid, None)
+        if tenant is not None:
+            self._by_tenant[tenant].pop(user_uuid, None)
+
+    def _add(self, user_uuid, chat_id):
+        self._unindex(user_uuid)
+        self.members[user_uuid] = chat_id
+        self._index(user_uuid, chat_id)
+
+    def _discard(self, user_uuid):
+        self._unindex(user_uuid)
+        return self.members.pop(user_uuid, None)
+
+    def refresh(self, dataset, user_uuid, value):
+        # Изменение, сделанное другим процессом (shared_state.py): только кэш, без записи
+        if dataset == CYCLE_USERS:
+            if value is None:
+                self._discard(user_uuid)
+            else:
+                self._add(user_uuid, value)
+        elif value is None:
+            self.opted_out.pop(user_uuid, None)
+        else:
+            self.opted_out[user_uuid] = value
+
+    def count(self, tenant=None):
+        if tenant is None:
+            return len(self.members)
+        return len(self._by_tenant.get(tenant, ()))
+
+    def is_member(self, user_uuid):
+        return user_uuid in self.members
+
+    def is_opted_out(self, user_uuid):
+        return user_uuid in self.opted_out
+
+    def snapshot(self, tenant=None):
+        if tenant is None:
+            return dict(self.members)
+        return dict(self._by_tenant.get(tenant, {}))
+
+    def archive(self, user_uuid):
+        # Пользователь уходит в холодный архив (участников цикла не архивируют):
+        # возвращает его отметку об отказе (chat_id) или None
+        chat_id = self.opted_out.pop(user_uuid, None)
+        if chat_id is not None:
+            self.storage.delete(NOT_CYCLE_USERS, user_uuid)
+        return chat_id
+
+    def restore(self, user_uuid, opted_out):
+        if opted_out is not None:
+            self.opted_out[user_uuid] = opted_out
+            self.storage.put(NOT_CYCLE_USERS, user_uuid, opted_out)
+
+    async def join(self, user_uuid, chat_id):
+        # Возвращает True, если состав цикла изменился
+        async with self._lock:
+            changed = user_uuid not in self.members
+            if changed:
+                self._add(user_uuid, chat_id)
+                self.storage.put(CYCLE_USERS, user_uuid, chat_id)
+            if self.opted_out.pop(user_uuid, None) is not None:
+                self.storage.delete(NOT_CYCLE_USERS, user_uuid)
+            return changed
+
+    async def leave(self, user_uuid, chat_id):
+        async with self._lock:
+            changed = user_uuid in self.members
+            if user_uuid not in self.opted_out:
+                self.opted_out[user_uuid] = chat_id
+                self.storage.put(NOT_CYCLE_USERS, user_uuid, chat_id)
+            if changed:
+                self._discard(user_uuid)
+                self.storage.delete(CYCLE_USERS, user_uuid)
+            return changed
+
+    async def remove(self, user_uuids):
+        # Убираем из цикла пользователей, которым нашлась пара
+        async with self._lock:
+            for user_uuid in user_uuids:
+                if self._discard(user_uuid) is not None:
+                    self.storage.delete(CYCLE_USERS, user_uuid)
@@ -0,0 +1,163 @@
+import asyncio
+import datetime
+import logging
+import time
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ограничения Bot API: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+GLOBAL_RATE = 30
+PER_CHAT_RATE = 1
+# Запас общего bucket: при запасе, равном скорости, рассылка после простоя выпускает
+# 30 сообщений разом поверх пополнения и получает 429. Маленький запас раскладывает
+# отправки равномерно по секунде
+GLOBAL_BURST = 1
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class DeliveryReport:
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.failed = []
+        self.retries = 0
+        self.rate_limited = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    def summary(self):
+        return (f"Рассылка: отправлено {self.sent} из {self.total}, ошибок {len(self.failed)}, "
+                f"повторов {self.retries}, ограничений скорости {self.rate_limited}, "
+                f"время {self.elapsed:.1f} с")
+
+
+def _retry_after_seconds(error):
+    retry_after = error.retry_after
+    if isinstance(retry_after, datetime.timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class DeliveryPipeline:
+    # Параллельная рассылка с ограничением числа одновременных запросов, общим и
+    # поканальным token bucket, учетом RetryAfter и повтором временных ошибок
+
+    def __init__(self, global_rate=GLOBAL_RATE, per_chat_rate=PER_CHAT_RATE, concurrency=16,
+                 max_retries=3, backoff=1.0, global_burst=GLOBAL_BURST):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.per_chat_rate = per_chat_rate
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self._paused_until = 0.0
+
+    async def _wait_pause(self):
+        delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _send(self, bot, message, chat_buckets, report, on_result=None):
+        chat_id = message['chat_id']
+        bucket = chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, capacity=1)
+        attempt = 0
+        while True:
+            await self._wait_pause()
+            await bucket.acquire()
+            await self.global_bucket.acquire()
+            try:
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=message['text'],
+                    reply_markup=message.get('reply_markup')
+                )
+                report.sent += 1
+                metrics.inc('coffee_messages_sent_total', outcome='sent')
+                if on_result:
+                    on_result(message, 'sent')
+                return True
+            except RetryAfter as e:
+                # Telegram просит подождать - притормаживаем всю рассылку, а не только этот чат.
+                # Повторные 429 считаем попытками, иначе сообщение может крутиться бесконечно
+                report.rate_limited += 1
+                metrics.inc('coffee_messages_sent_total', outcome='rate_limited')
+                delay = _retry_after_seconds(e)
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                logger.warning(f"Превышен лимит отправки, пауза {delay} с")
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._fail(message, report, e, 'failed', on_result)
+                    return False
+            except (BadRequest, Forbidden) as e:
+                # Постоянные ошибки (чат не найден, бот заблокирован) не повторяем
+                self._fail(message, report, e, 'rejected', on_result)
+                return False
+            except NetworkError as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    self._fail(message, report, e, 'failed', on_result)
+                    return False
+                report.retries += 1
+                metrics.inc('coffee_messages_sent_total', outcome='retry')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1))
+            except Exception as e:
+                # Неожиданная ошибка одного сообщения не должна останавливать всю рассылку
+                logger.exception(f"Неожиданная ошибка при отправке сообщения пользователю {message.get('key')} ({chat_id})")
+                self._fail(message, report, e, 'failed', on_result, log=False)
+                return False
+
+    @staticmethod
+    def _fail(message, report, error, outcome, on_result, log=True):
+        if log:
+            logger.error(f"Не удалось отправить сообщение пользователю {message.get('key')} "
+                         f"({message['chat_id']}): {error}")
+        report.failed.append((message.get('key'), message['chat_id'], str(error)))
+        metrics.inc('coffee_messages_sent_total', outcome=outcome)
+        if on_result:
+            on_result(message, outcome)
+
+    async def deliver(self, bot, messages, on_result=None):
+        # messages: список словарей {'chat_id', 'text', 'reply_markup', 'key'};
+        # on_result(message, outcome) вызывается сразу после отправки: sent, rejected или failed
+        report = DeliveryReport(len(messages))
+        queue = asyncio.Queue()
+        for message in messages:
+            queue.put_nowait(message)
+        chat_buckets = {}
+
+        async def worker():
+            while True:
+                try:
+                    message = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                await self._send(bot, message, chat_buckets, report, on_result)
+
+        await asyncio.gather(*(worker() for _ in range(min(self.concurrency, len(messages)) or 1)))
+        report.elapsed = time.monotonic() - report.started
+        logger.info(report.summary())
+        return report
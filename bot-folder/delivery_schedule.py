@@ -0,0 +1,48 @@
+import datetime
+import math
+
+# Сколько сообщений о парах отправлять одной партией внутри окна
+BATCH_SIZE = 50
+
+
+def next_window(now, timezone, window):
+    # Ближайшее еще не закончившееся окно (начало, конец) в поясе timezone, в секундах epoch.
+    # Если окно уже идет, начало - текущий момент
+    local = datetime.datetime.fromtimestamp(now, timezone)
+    start_at, end_at = window
+    for shift in (-1, 0, 1):
+        day = local.date() + datetime.timedelta(days=shift)
+        end_day = day if end_at > start_at else day + datetime.timedelta(days=1)
+        start = timezone.localize(datetime.datetime.combine(day, start_at)).timestamp()
+        end = timezone.localize(datetime.datetime.combine(end_day, end_at)).timestamp()
+        if end > now:
+            return max(start, now), end
+    raise ValueError(f"Не найдено окно {window} после {local}")
+
+
+def schedule(recipients, now, batch_size=BATCH_SIZE, deadline=None):
+    # recipients: [(ключ, часовой пояс, окно)], окно None - отправить сразу.
+    # Получатели группируются по поясу и окну, каждая группа делится на партии, равномерно
+    # разнесенные по ближайшему окну. Возвращает [[время, [ключи]], ...] по возрастанию времени.
+    # deadline - к этому моменту выпускаются все партии, даже если окно получателя еще не
+    # началось: план должен завершиться до следующего подбора пар
+    groups = {}
+    for key, timezone, window in recipients:
+        group = (timezone.zone, window) if window else ('', None)
+        groups.setdefault(group, (timezone, []))[1].append(key)
+
+    batches = []
+    for (_, window), (timezone, keys) in groups.items():
+        if window is None:
+            batches.append([now, keys])
+            continue
+        start, end = next_window(now, timezone, window)
+        count = math.ceil(len(keys) / batch_size)
+        step = (end - start) / count
+        for index in range(count):
+            at = start + index * step
+            if deadline is not None:
+                at = max(now, min(at, deadline))
+            batches.append([at, keys[index * batch_size:(index + 1) * batch_size]])
+    batches.sort(key=lambda batch: batch[0])
+    return batches
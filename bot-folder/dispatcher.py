@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import os
+import secrets
+import sys
+
+import httpx
+
+from webhook import SECRET_HEADER, WebhookServer, stop_event
+
+logger = logging.getLogger(__name__)
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'boot.py')
+TELEGRAM_API_URL = 'https://api.telegram.org/bot'
+POLL_TIMEOUT = 30
+QUEUE_SIZE = 1000
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 10.0
+
+
+def update_user_id(update):
+    # Кто прислал апдейт: from/user у вложенного объекта, иначе чат
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if user:
+            return user['id']
+        chat = value.get('chat')
+        if chat:
+            return chat['id']
+    return None
+
+
+class Worker:
+    # Процесс boot.py в режиме worker: принимает апдейты от диспетчера на локальном порту
+
+    def __init__(self, index, port, env, path='/telegram'):
+        self.index = index
+        self.port = port
+        self.env = env
+        self.url = f'http://127.0.0.1:{port}{path}'
+        self.queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.process = None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(sys.executable, BOT_FILE, env=self.env)
+        logger.info(f"Воркер {self.index} запущен (pid {self.process.pid}, порт {self.port})")
+
+    async def stop(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+            await self.process.wait()
+
+
+class Dispatcher:
+    # Принимает апдейты (getUpdates или webhook) и раздает их K воркерам по from_user.id.
+    # Все апдейты пользователя попадают в один воркер и отправляются туда по очереди,
+    # поэтому порядок внутри диалога сохраняется. Общие данные воркеры берут из одной SQLite
+
+    def __init__(self, count, base_port=8600, path='/telegram', metrics_port=0, env=None):
+        self.secret = secrets.token_hex(16)
+        self.path = path
+        self._stopping = False
+        self.workers = []
+        for index in range(count):
+            worker_env = dict(env if env is not None else os.environ)
+            worker_env.update({
+                'COFFEE_MODE': 'worker',
+                'COFFEE_WORKER_INDEX': str(index),
+                'COFFEE_WORKER_PORT': str(base_port + index),
+                'COFFEE_WEBHOOK_PATH': path,
+                'COFFEE_WEBHOOK_SECRET': self.secret,
+                'COFFEE_STORAGE': 'sqlite',
+                # Снимок пишет только однопроцессный режим
+                'COFFEE_SNAPSHOT': '',
+                # Задачи по расписанию выполняет один воркер
+                'COFFEE_RUN_JOBS': '1' if index == 0 else '0',
+                'COFFEE_METRICS_PORT': str(metrics_port + 1 + index) if metrics_port else '0',
+            })
+            self.workers.append(Worker(index, base_port + index, worker_env, path))
+
+    def route(self, update):
+        user_id = update_user_id(update) or 0
+        return self.workers[user_id % len(self.workers)]
+
+    async def submit(self, update):
+        await self.route(update).queue.put(update)
+
+    async def _forward(self, client, worker):
+        # Апдейты воркеру отправляются строго по одному; пока воркер недоступен - повторяем
+        while True:
+            update = await worker.queue.get()
+            delay = RETRY_DELAY
+            while True:
+                try:
+                    response = await client.post(worker.url, json=update, headers={SECRET_HEADER: self.secret})
+                    if response.status_code == 200:
+                        break
+                    if 400 <= response.status_code < 500:
+                        logger.error(f"Воркер {worker.index} отклонил апдейт {update.get('update_id')}: {response.status_code}")
+                        break
+                except httpx.HTTPError as e:
+                    logger.debug(f"Воркер {worker.index} недоступен: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+    async def _supervise(self, worker):
+        # Упавший воркер перезапускается, апдейты ждут его в очереди
+        while not self._stopping:
+            await worker.start()
+            code = await worker.process.wait()
+            if self._stopping:
+                return
+            logger.error(f"Воркер {worker.index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(1)
+
+    async def poll(self, client, api_url):
+        await client.post(f'{api_url}/deleteWebhook')
+        offset = 0
+        while True:
+            try:
+                response = await client.post(f'{api_url}/getUpdates', json={'offset': offset, 'timeout': POLL_TIMEOUT},
+                                             timeout=POLL_TIMEOUT + 10)
+                updates = response.json().get('result', [])
+            except (httpx.HTTPError, ValueError) as e:
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(RETRY_DELAY)
+                continue
+            for update in updates:
+                await self.submit(update)
+                offset = update['update_id'] + 1
+
+    async def run(self, token, base_url=None, webhook_url=None, listen='127.0.0.1', port=8443,
+                  webhook_secret=None):
+        api_url = f'{base_url or TELEGRAM_API_URL}{token}'
+        stop = stop_event()
+        server = None
+        async with httpx.AsyncClient(timeout=30) as client:
+            tasks = [asyncio.create_task(self._supervise(worker)) for worker in self.workers]
+            tasks += [asyncio.create_task(self._forward(client, worker)) for worker in self.workers]
+            try:
+                if webhook_url:
+                    server = WebhookServer(self.submit, listen, port, self.path, webhook_secret)
+                    await server.start()
+                    params = {'url': webhook_url.rstrip('/') + self.path}
+                    if webhook_secret:
+                        params['secret_token'] = webhook_secret
+                    await client.post(f'{api_url}/setWebhook', json=params)
+                else:
+                    tasks.append(asyncio.create_task(self.poll(client, api_url)))
+                logger.info(f"Диспетчер запущен, воркеров: {len(self.workers)}")
+                await stop.wait()
+            finally:
+                self._stopping = True
+                if server:
+                    await server.stop()
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*(worker.stop() for worker in self.workers))
@@ -0,0 +1,118 @@
+import logging
+
+from storage import CYCLE_STATS, MATCH_FEEDBACK, USER_MATCHES, update_row
+from tenants import scoped
+from user_repo import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# Оценки из кнопок /leave_feedback
+RATINGS = {'feedback_1': 1, 'feedback_2': 2, 'feedback_3': 3}
+# Ключ в cycle_stats с id последнего цикла (у пространств - с префиксом, см. tenants.scoped)
+LATEST_KEY = 'latest'
+
+
+def feedback_key(cycle, group_key, user_uuid):
+    return f"{cycle}|{group_key}|{user_uuid}"
+
+
+def group_key(group):
+    return '+'.join(sorted(group))
+
+
+class FeedbackStore:
+    # Отзывы хранятся по (цикл, пара, пользователь), а счетчики цикла обновляются на каждой
+    # записи, поэтому /stats читает одну строку cycle_stats и не обходит историю.
+    # user_matches: uuid -> последняя встреча пользователя, ее он и оценивает. Отзыв о прошлой
+    # встрече удаляется, когда у пользователя появляется новая: оценить ее уже нельзя,
+    # а в счетчиках cycle_stats она учтена. Поэтому обоих наборов не больше, чем пользователей
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def latest_cycle(self, tenant=DEFAULT_TENANT):
+        return self.storage.get(CYCLE_STATS, scoped(LATEST_KEY, tenant))
+
+    def new_cycle_id(self, date):
+        # Несколько подборов за день (например, ручной /match) получают разные id
+        cycle = date
+        n = 1
+        while self.storage.get(CYCLE_STATS, cycle) is not None:
+            n += 1
+            cycle = f"{date}#{n}"
+        return cycle
+
+    def record_cycle(self, cycle, groups, members, registered, tenant=DEFAULT_TENANT):
+        # members - участников цикла на момент подбора, registered - всего зарегистрированных
+        matched = 0
+        for group in groups:
+            key = group_key(group)
+            for user_uuid in group:
+                previous = self.storage.get(USER_MATCHES, user_uuid)
+                if previous:
+                    self.storage.delete(MATCH_FEEDBACK, feedback_key(previous['cycle'], previous['group'], user_uuid))
+                self.storage.put(USER_MATCHES, user_uuid, {'cycle': cycle, 'group': key})
+            matched += len(group)
+        self.storage.put(CYCLE_STATS, cycle, {
+            'members': members,
+            'registered': registered,
+            'groups': len(groups),
+            'matched': matched,
+            'responses': 0,
+            'ratings': {str(rating): 0 for rating in sorted(RATINGS.values())},
+            'tenant': tenant,
+        })
+        self.storage.put(CYCLE_STATS, scoped(LATEST_KEY, tenant), cycle)
+
+    def record(self, user_uuid, rating):
+        # Возвращает id цикла или None, если пользователю еще не подбирали пару.
+        # Повторная оценка той же встречи заменяет предыдущую, счетчики правятся на разницу
+        match = self.storage.get(USER_MATCHES, user_uuid)
+        if not match:
+            return None
+        cycle = match['cycle']
+        key = feedback_key(cycle, match['group'], user_uuid)
+        previous = self.storage.get(MATCH_FEEDBACK, key)
+        if self.storage.get(CYCLE_STATS, cycle) is None:
+            logger.error(f"Нет счетчиков цикла {cycle} для отзыва {key}")
+            return None
+
+        def count(stats):
+            # Счетчики читаются и пишутся одной операцией хранилища: отзывы на разных
+            # воркерах с общей базой не теряют прибавки друг друга
+            stats = dict(stats, ratings=dict(stats['ratings']))
+            if previous is None:
+                stats['responses'] += 1
+            else:
+                stats['ratings'][str(previous)] -= 1
+            stats['ratings'][str(rating)] += 1
+            return stats
+
+        self.storage.put(MATCH_FEEDBACK, key, rating)
+        update_row(self.storage, CYCLE_STATS, cycle, count)
+        return cycle
+
+    def stats(self, cycle=None, tenant=DEFAULT_TENANT):
+        # Циклы другого пространства для админа не существуют
+        cycle = cycle or self.latest_cycle(tenant)
+        if not cycle:
+            return None, None
+        stats = self.storage.get(CYCLE_STATS, cycle)
+        if not isinstance(stats, dict) or stats.get('tenant', DEFAULT_TENANT) != tenant:
+            return cycle, None
+        return cycle, stats
+
+
+def format_stats(cycle, stats):
+    ratings = stats['ratings']
+    rated = sum(ratings.values())
+    average = sum(int(rating) * count for rating, count in ratings.items()) / rated if rated else 0
+    participation = stats['members'] / stats['registered'] * 100 if stats['registered'] else 0
+    response = stats['responses'] / stats['matched'] * 100 if stats['matched'] else 0
+    distribution = '\n'.join(f"{'💚' * int(rating)}: {count}" for rating, count in sorted(ratings.items()))
+    return (f"Статистика цикла {cycle}\n"
+            f"Участников: {stats['members']} из {stats['registered']} ({participation:.0f}%)\n"
+            f"Групп: {stats['groups']}, в парах: {stats['matched']}\n"
+            f"Ответили на опрос: {stats['responses']} ({response:.0f}%)\n"
+            f"Средняя оценка: {average:.2f}\n"
+            f"{distribution}")
@@ -0,0 +1,215 @@
+import datetime
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from metrics import metrics
+from storage import DATASETS, CYCLE_USERS, NOT_CYCLE_USERS, JsonStorage, plain, save_data
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'snapshot.json'
+JOURNAL_FILE = 'journal.log'
+ARCHIVE_DIR = 'journal-archive'
+
+
+def _segment_seq(path):
+    # journal.<seq>.log -> seq
+    return int(os.path.basename(path).split('.')[1])
+
+
+def read_records(path):
+    with open(path, 'r', encoding='utf-8') as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # Недописанная строка после аварийного завершения
+                logger.warning(f"Пропущена поврежденная запись в {path}")
+
+
+def apply_record(datasets, record):
+    data = datasets.setdefault(record['ds'], {})
+    if record['op'] == 'put':
+        data[record['key']] = record['value']
+    elif record['op'] == 'del':
+        data.pop(record['key'], None)
+    elif record['op'] == 'replace':
+        datasets[record['ds']] = dict(record['value'])
+
+
+class JournalStorage:
+    # Событийное хранение: каждое изменение дописывается одной строкой в journal.log,
+    # состояние при старте = последний снимок + проигрывание журнала.
+    # Фоновое уплотнение периодически сворачивает журнал в новый снимок
+
+    def __init__(self, directory='.', compact_threshold=10000, compact_interval=60.0, keep_archive=True):
+        self.directory = directory
+        self.compact_threshold = compact_threshold
+        self.compact_interval = compact_interval
+        self.keep_archive = keep_archive
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self.journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.archive_dir = os.path.join(directory, ARCHIVE_DIR)
+        self._lock = threading.RLock()
+        self._seq = 0
+        self._records = 0
+        self._data = {dataset: {} for dataset in DATASETS}
+        self._restore()
+        self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='journal-compaction', daemon=True)
+        self._thread.start()
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'journal.*.log')), key=_segment_seq)
+
+    def _restore(self):
+        started = time.perf_counter()
+        has_journal = os.path.exists(self.journal_path) or self._segments()
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as file:
+                snapshot = json.load(file)
+            self._seq = snapshot['seq']
+            self._data.update(snapshot['datasets'])
+        elif not has_journal:
+            # Первый запуск в этом режиме - берем данные из существующих JSON-файлов
+            legacy = JsonStorage(self.directory)
+            for dataset in DATASETS:
+                self._data[dataset] = legacy.load(dataset)
+            save_data({'seq': 0, 'datasets': self._data}, self.snapshot_path)
+
+        replayed = 0
+        for path in self._segments() + [self.journal_path]:
+            if not os.path.exists(path):
+                continue
+            for record in read_records(path):
+                if record['seq'] <= self._seq:
+                    continue
+                apply_record(self._data, record)
+                self._seq = record['seq']
+                replayed += 1
+        self._records = replayed
+        logger.info(f"Состояние восстановлено: снимок + {replayed} событий за {time.perf_counter() - started:.3f} с")
+
+    def _append(self, record):
+        with self._lock:
+            self._seq += 1
+            record['seq'] = self._seq
+            record['ts'] = int(time.time())
+            line = json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=plain) + '\n'
+            self._journal.write(line)
+            self._journal.flush()
+            self._records += 1
+        metrics.inc('coffee_storage_bytes_written_total', len(line), dataset=record['ds'])
+
+    # Интерфейс хранилища
+
+    def load(self, dataset):
+        with self._lock:
+            return dict(self._data[dataset])
+
+    def count(self, dataset):
+        with self._lock:
+            return len(self._data[dataset])
+
+    def get(self, dataset, key, default=None):
+        with self._lock:
+            return self._data[dataset].get(str(key), default)
+
+    def put(self, dataset, key, value):
+        key = str(key)
+        with self._lock:
+            self._data[dataset][key] = value
+            self._append({'ds': dataset, 'op': 'put', 'key': key, 'value': value})
+
+    def delete(self, dataset, key):
+        key = str(key)
+        with self._lock:
+            if self._data[dataset].pop(key, None) is not None:
+                self._append({'ds': dataset, 'op': 'del', 'key': key})
+
+    def replace(self, dataset, data):
+        with self._lock:
+            self._data[dataset] = dict(data)
+            self._append({'ds': dataset, 'op': 'replace', 'value': self._data[dataset]})
+
+    def adopt(self, dataset, data):
+        # Те же данные в другом представлении (UserRecord вместо словарей), в журнал не пишется
+        with self._lock:
+            self._data[dataset] = dict(data)
+
+    # Уплотнение
+
+    def _run(self):
+        while not self._stopped.wait(self.compact_interval):
+            if self._records >= self.compact_threshold:
+                self.compact()
+
+    def compact(self):
+        with self._lock:
+            if self._records == 0:
+                return
+            # Переименовываем текущий журнал в сегмент и сразу открываем новый,
+            # сам снимок пишется уже без блокировки
+            self._journal.close()
+            segment = os.path.join(self.directory, f'journal.{self._seq}.log')
+            os.replace(self.journal_path, segment)
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+            snapshot = {'seq': self._seq, 'datasets': {k: dict(v) for k, v in self._data.items()}}
+            self._records = 0
+
+        started = time.perf_counter()
+        save_data(snapshot, self.snapshot_path)
+        for path in self._segments():
+            if _segment_seq(path) > snapshot['seq']:
+                continue
+            if self.keep_archive:
+                os.makedirs(self.archive_dir, exist_ok=True)
+                os.replace(path, os.path.join(self.archive_dir, os.path.basename(path)))
+            else:
+                os.remove(path)
+        logger.info(f"Журнал свернут в снимок (seq={snapshot['seq']}) за {time.perf_counter() - started:.3f} с")
+
+    def close(self):
+        self._stopped.set()
+        self._thread.join(timeout=5)
+        self.compact()
+        with self._lock:
+            self._journal.close()
+
+
+def audit_trail(directory='.', user_uuid=None):
+    # История входа/выхода из цикла по архиву и текущему журналу
+    archive = sorted(glob.glob(os.path.join(directory, ARCHIVE_DIR, 'journal.*.log')), key=_segment_seq)
+    active = sorted(glob.glob(os.path.join(directory, 'journal.*.log')), key=_segment_seq)
+    for path in archive + active + [os.path.join(directory, JOURNAL_FILE)]:
+        if not os.path.exists(path):
+            continue
+        for record in read_records(path):
+            if record['ds'] not in (CYCLE_USERS, NOT_CYCLE_USERS) or record['op'] == 'replace':
+                continue
+            if user_uuid and record.get('key') != user_uuid:
+                continue
+            if record['ds'] == CYCLE_USERS:
+                action = 'вступил в цикл' if record['op'] == 'put' else 'покинул цикл'
+            else:
+                action = 'отказался от участия' if record['op'] == 'put' else 'снял отказ'
+            yield datetime.datetime.fromtimestamp(record['ts']), record['key'], action
+
+
+if __name__ == '__main__':
+    # python journal.py audit [каталог] [uuid]
+    if len(sys.argv) < 2 or sys.argv[1] != 'audit':
+        print("Использование: python journal.py audit [каталог] [uuid]")
+        sys.exit(1)
+    directory = sys.argv[2] if len(sys.argv) > 2 else '.'
+    for when, key, action in audit_trail(directory, sys.argv[3] if len(sys.argv) > 3 else None):
+        print(f"{when:%Y-%m-%d %H:%M:%S} {key} {action}")
@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import os
+import secrets
+import socket
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def _connect(path):
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS job_runs (
+            job TEXT NOT NULL,
+            cycle TEXT NOT NULL,
+            owner TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            finished_at REAL,
+            PRIMARY KEY (job, cycle)
+        );
+    """)
+    return conn
+
+
+class LeaderElection:
+    # Аренда лидерства в строке SQLite: лидер продлевает ее каждые ttl/3 секунд,
+    # остальные реплики забирают аренду, когда она истекла. Если лидер упал,
+    # другая реплика становится лидером не позже чем через ttl + ttl/3 секунд
+
+    def __init__(self, path, name='scheduler', ttl=30.0, owner=None):
+        self.path = path
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or f'{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}'
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._expires_at = 0.0
+
+    def acquire(self):
+        # Захватить или продлить аренду; возвращает True, если этот процесс - лидер
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (self.name,)).fetchone()
+                leader = row is None or row[0] == self.owner or row[1] <= now
+                if leader:
+                    self._conn.execute(
+                        "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                        "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                        (self.name, self.owner, now + self.ttl)
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        was_leader = self.is_leader()
+        self._expires_at = now + self.ttl if leader else 0.0
+        if leader and not was_leader:
+            logger.info(f"Реплика {self.owner} стала лидером ({self.name})")
+        elif was_leader and not leader:
+            logger.warning(f"Реплика {self.owner} потеряла лидерство ({self.name}): аренду занял {row[0]}")
+        return leader
+
+    def is_leader(self):
+        # Локальная оценка без обращения к базе
+        return self._expires_at > time.time()
+
+    def release(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+        self._expires_at = 0.0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RunLedger:
+    # Журнал запусков задач по расписанию: (задача, дата цикла) записывается до запуска,
+    # поэтому повторно за тот же цикл задача не выполнится ни в этой, ни в другой реплике
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+
+    def claim(self, job, cycle, owner):
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO job_runs (job, cycle, owner, started_at) VALUES (?, ?, ?, ?)",
+                (job, cycle, owner, time.time())
+            )
+            return cursor.rowcount == 1
+
+    def finish(self, job, cycle):
+        with self._lock:
+            self._conn.execute("UPDATE job_runs SET finished_at = ? WHERE job = ? AND cycle = ?",
+                               (time.time(), job, cycle))
+
+    def get(self, job, cycle):
+        # (owner, started_at, finished_at) или None
+        with self._lock:
+            return self._conn.execute(
+                "SELECT owner, started_at, finished_at FROM job_runs WHERE job = ? AND cycle = ?", (job, cycle)
+            ).fetchone()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+async def run_once(leader, ledger, job, cycle, callback, wait):
+    # Выполнить задачу один раз за цикл на одной реплике. Не-лидер не пропускает запуск сразу,
+    # а ждет до wait секунд: если лидер упал, задачу выполнит тот, кто перехватит аренду.
+    # Возвращает True, если задачу выполнила эта реплика
+    deadline = time.time() + wait
+    while True:
+        previous = ledger.get(job, cycle)
+        if previous:
+            logger.info(f"Задача {job} за {cycle} уже запускалась репликой {previous[0]}, пропускаем")
+            return False
+        if leader.acquire():
+            if not ledger.claim(job, cycle, leader.owner):
+                continue
+            try:
+                await callback()
+            finally:
+                ledger.finish(job, cycle)
+            return True
+        if time.time() > deadline:
+            logger.info(f"Задача {job} за {cycle}: эта реплика не лидер, выполняет другая")
+            return False
+        await asyncio.sleep(leader.ttl / 3)
@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+
+from storage import CYCLE_PLANS, DELIVERIES
+from tenants import scoped
+from user_repo import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# Ключ в cycle_plans с id незавершенного плана (у каждого пространства свой, см. tenants.scoped)
+ACTIVE_KEY = 'active'
+# Сколько раз пробовать отправить сообщение при временных ошибках, прежде чем отметить failed
+MAX_ATTEMPTS = 3
+
+PLANNED = 'planned'
+DELIVERING = 'delivering'
+DONE = 'done'
+
+
+def delivery_key(cycle, user_uuid):
+    return f"{cycle}|{user_uuid}"
+
+
+class MatchPlanStore:
+    # План цикла (кто с кем) и журнал доставки по каждому получателю сохраняются до первой
+    # отправки. Рассылка идет только по записям pending и отмечает каждую сразу после ответа
+    # Telegram, поэтому после перезапуска досылаются только недоставленные сообщения, без
+    # нового подбора пар. Сбой между отправкой и отметкой может дать одно повторное сообщение.
+    # Получатели в плане упорядочены по партиям [[время, число], ...] (delivery_schedule.py):
+    # released - сколько партий уже выпущено, retry - кого повторить после временной ошибки.
+    # Завершенный план сжимается до итогов (summary), записи журнала доставки удаляются
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def active(self, tenant=DEFAULT_TENANT):
+        return self.storage.get(CYCLE_PLANS, scoped(ACTIVE_KEY, tenant))
+
+    def get(self, cycle):
+        return self.storage.get(CYCLE_PLANS, cycle)
+
+    async def create(self, cycle, groups, leftover, messages, tenant=DEFAULT_TENANT, batches=None):
+        # messages: {'key', 'chat_id', 'text', 'keyboard'}; batches: [[время, [ключи]], ...],
+        # по умолчанию - все сразу
+        if batches is None:
+            batches = [[time.time(), [message['key'] for message in messages]]]
+        for message in messages:
+            self.storage.put(DELIVERIES, delivery_key(cycle, message['key']), {
+                'chat_id': message['chat_id'],
+                'text': message['text'],
+                'keyboard': message.get('keyboard', False),
+                'status': 'pending',
+                'attempts': 0,
+            })
+        self.storage.put(CYCLE_PLANS, cycle, {
+            'groups': [list(group) for group in groups],
+            'leftover': list(leftover),
+            'recipients': [key for _, keys in batches for key in keys],
+            'batches': [[at, len(keys)] for at, keys in batches],
+            'released': 0,
+            'retry': [],
+            'status': PLANNED,
+            'passes': 0,
+            'created': int(time.time()),
+            'tenant': tenant,
+        })
+        self.storage.put(CYCLE_PLANS, scoped(ACTIVE_KEY, tenant), cycle)
+        # План должен оказаться на диске до первой отправки; запись - в потоке, не в цикле событий
+        flush = getattr(self.storage, 'flush', None)
+        if flush:
+            await asyncio.to_thread(flush)
+        logger.info(f"План цикла {cycle} сохранен: групп {len(groups)}, получателей {len(messages)}, партий {len(batches)}")
+
+    def set_status(self, cycle, status):
+        plan = self.get(cycle)
+        self.storage.put(CYCLE_PLANS, cycle, dict(plan, status=status))
+
+    def _pending(self, cycle, user_uuids):
+        messages = []
+        for user_uuid in user_uuids:
+            entry = self.storage.get(DELIVERIES, delivery_key(cycle, user_uuid))
+            if entry and entry['status'] == 'pending':
+                messages.append(dict(entry, key=user_uuid))
+        return messages
+
+    def due(self, cycle, now):
+        # Что пора отправить: повторы прошлого прохода и партии, время которых наступило.
+        # Возвращает (сообщения, выпущено партий); второе сохраняет finish_pass после отправки,
+        # поэтому при сбое посреди прохода партии выпускаются заново, а отправленное пропускается
+        plan = self.get(cycle)
+        batches = plan.get('batches') or [[0, len(plan['recipients'])]]
+        released = plan.get('released', 0)
+        user_uuids = list(plan.get('retry', []))
+        offset = sum(count for _, count in batches[:released])
+        while released < len(batches) and batches[released][0] <= now:
+            count = batches[released][1]
+            user_uuids.extend(plan['recipients'][offset:offset + count])
+            offset += count
+            released += 1
+        return self._pending(cycle, user_uuids), released
+
+    def next_batch(self, cycle):
+        # Время следующей невыпущенной партии или None
+        plan = self.get(cycle)
+        batches = plan.get('batches') or []
+        released = plan.get('released', 0)
+        return batches[released][0] if released < len(batches) else None
+
+    def counts(self, cycle):
+        # Итог рассылки по журналу: {статус: число}; у завершенного плана - из итогов
+        plan = self.get(cycle)
+        if 'summary' in plan:
+            return {status: plan['summary'][status] for status in ('sent', 'rejected', 'failed', 'pending')}
+        counts = {'sent': 0, 'rejected': 0, 'failed': 0, 'pending': 0}
+        for user_uuid in plan['recipients']:
+            entry = self.storage.get(DELIVERIES, delivery_key(cycle, user_uuid))
+            if entry:
+                counts[entry['status']] += 1
+        return counts
+
+    def mark(self, cycle, user_uuid, outcome):
+        key = delivery_key(cycle, user_uuid)
+        entry = dict(self.storage.get(DELIVERIES, key))
+        if outcome == 'sent':
+            entry['status'] = 'sent'
+        elif outcome == 'rejected':
+            entry['status'] = 'rejected'
+        else:
+            # Временная ошибка - остается pending до следующего прохода, пока есть попытки
+            entry['attempts'] += 1
+            if entry['attempts'] >= MAX_ATTEMPTS:
+                entry['status'] = 'failed'
+        self.storage.put(DELIVERIES, key, entry)
+
+    def finish_pass(self, cycle, released, messages):
+        # Возвращает, сколько сообщений еще ждет отправки; план закрывается, когда таких нет
+        plan = dict(self.get(cycle))
+        plan['passes'] += 1
+        plan['released'] = released
+        plan['retry'] = [message['key'] for message in self._pending(cycle, [message['key'] for message in messages])]
+        batches = plan.get('batches') or [[0, len(plan['recipients'])]]
+        remaining = len(plan['retry']) + sum(count for _, count in batches[released:])
+        if not remaining:
+            plan = self._compact(cycle, plan)
+            self.storage.delete(CYCLE_PLANS, scoped(ACTIVE_KEY, plan['tenant']))
+        self.storage.put(CYCLE_PLANS, cycle, plan)
+        return remaining
+
+    def _compact(self, cycle, plan):
+        # Журнал доставки и состав плана нужны только до конца рассылки: от завершенного
+        # плана остаются итоги, иначе cycle_plans и deliveries растут с каждым циклом
+        summary = self.counts(cycle)
+        summary['groups'] = len(plan['groups'])
+        summary['recipients'] = len(plan['recipients'])
+        for user_uuid in plan['recipients']:
+            self.storage.delete(DELIVERIES, delivery_key(cycle, user_uuid))
+        return {
+            'status': DONE,
+            'passes': plan['passes'],
+            'created': plan['created'],
+            'finished': int(time.time()),
+            'tenant': plan.get('tenant', DEFAULT_TENANT),
+            'summary': summary,
+        }
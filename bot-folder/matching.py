@@ -0,0 +1,195 @@
+import logging
+import random
+import time
+
+logger = logging.getLogger(__name__)
+
+# Штрафы при подборе пары: повторная встреча намного хуже, чем совпадение должностей
+REPEAT_PENALTY = 100
+SAME_POSITION_PENALTY = 1
+
+
+def pair_key(user1_uuid, user2_uuid):
+    return '|'.join(sorted((user1_uuid, user2_uuid)))
+
+
+class PairHistory:
+    # Кто с кем уже встречался. uuid переводятся в целые номера, пара хранится одним int,
+    # чтобы проверка "встречались ли" была дешевой даже для сотен тысяч пар
+
+    def __init__(self, data=None):
+        self._ids = {}
+        self._pairs = {}
+        if data:
+            self.load(data)
+
+    def load(self, data):
+        # data: {"uuid1|uuid2": количество встреч}
+        self._ids = {}
+        self._pairs = {}
+        for key, count in data.items():
+            user1_uuid, _, user2_uuid = key.partition('|')
+            self._pairs[self._key(user1_uuid, user2_uuid)] = count
+
+    def _id(self, user_uuid):
+        user_id = self._ids.get(user_uuid)
+        if user_id is None:
+            user_id = self._ids[user_uuid] = len(self._ids)
+        return user_id
+
+    def _key(self, user1_uuid, user2_uuid):
+        id1, id2 = self._id(user1_uuid), self._id(user2_uuid)
+        if id1 > id2:
+            id1, id2 = id2, id1
+        return (id1 << 32) | id2
+
+    def count(self, user1_uuid, user2_uuid):
+        return self._pairs.get(self._key(user1_uuid, user2_uuid), 0)
+
+    def add(self, user1_uuid, user2_uuid):
+        key = self._key(user1_uuid, user2_uuid)
+        self._pairs[key] = self._pairs.get(key, 0) + 1
+        return self._pairs[key]
+
+    def set(self, user1_uuid, user2_uuid, count):
+        # Значение из хранилища: счетчик мог увеличить другой процесс
+        key = self._key(user1_uuid, user2_uuid)
+        if count:
+            self._pairs[key] = count
+        else:
+            self._pairs.pop(key, None)
+
+    def __len__(self):
+        return len(self._pairs)
+
+
+class MatchResult:
+    def __init__(self, groups, leftover, repeats, elapsed):
+        self.groups = groups
+        self.leftover = leftover
+        self.repeats = repeats
+        self.elapsed = elapsed
+
+    @property
+    def used(self):
+        return {user_uuid for group in self.groups for user_uuid in group}
+
+
+class MatchingEngine:
+    # Жадный подбор пар в скользящем окне кандидатов + локальное улучшение обменами.
+    # Без перебора всех пар: O(N * window) для подбора и O(повторы * attempts) для улучшения
+
+    def __init__(self, history, prefer_cross_position=False, window=8, improve_attempts=32, seed=None):
+        self.history = history
+        self.prefer_cross_position = prefer_cross_position
+        self.window = window
+        self.improve_attempts = improve_attempts
+        self.rng = random.Random(seed)
+
+    def cost(self, user1_uuid, user2_uuid, positions):
+        cost = self.history.count(user1_uuid, user2_uuid) * REPEAT_PENALTY
+        if self.prefer_cross_position:
+            position = positions.get(user1_uuid)
+            if position and position == positions.get(user2_uuid):
+                cost += SAME_POSITION_PENALTY
+        return cost
+
+    def _order(self, participants, positions):
+        order = list(participants)
+        self.rng.shuffle(order)
+        if not self.prefer_cross_position:
+            return order
+        # Чередуем должности, чтобы в окне кандидатов оказывались люди с разных позиций
+        buckets = {}
+        for user_uuid in order:
+            buckets.setdefault((positions.get(user_uuid) or '').strip().lower(), []).append(user_uuid)
+        queues = sorted(buckets.values(), key=len, reverse=True)
+        interleaved = []
+        while queues:
+            for queue in queues:
+                interleaved.append(queue.pop())
+            queues = [queue for queue in queues if queue]
+        return interleaved
+
+    def _greedy(self, order, positions):
+        matched = [False] * len(order)
+        pairs = []
+        for i, user_uuid in enumerate(order):
+            if matched[i]:
+                continue
+            best, best_cost, seen = None, None, 0
+            j = i + 1
+            while j < len(order) and seen < self.window:
+                if not matched[j]:
+                    seen += 1
+                    cost = self.cost(user_uuid, order[j], positions)
+                    if best is None or cost < best_cost:
+                        best, best_cost = j, cost
+                        if cost == 0:
+                            break
+                j += 1
+            if best is None:
+                continue
+            matched[i] = matched[best] = True
+            pairs.append([user_uuid, order[best]])
+        leftover = [user_uuid for i, user_uuid in enumerate(order) if not matched[i]]
+        return pairs, leftover
+
+    def _improve(self, pairs, positions):
+        # Для пар с повтором пробуем обменяться партнерами со случайной другой парой
+        if len(pairs) < 2:
+            return
+        for index, pair in enumerate(pairs):
+            if self.history.count(pair[0], pair[1]) == 0:
+                continue
+            for _ in range(self.improve_attempts):
+                other_index = self.rng.randrange(len(pairs))
+                if other_index == index:
+                    continue
+                other = pairs[other_index]
+                a, b = pair
+                c, d = other
+                current = self.cost(a, b, positions) + self.cost(c, d, positions)
+                swap1 = self.cost(a, c, positions) + self.cost(b, d, positions)
+                swap2 = self.cost(a, d, positions) + self.cost(b, c, positions)
+                if swap1 < current and swap1 <= swap2:
+                    pair[1], other[0] = c, b
+                elif swap2 < current:
+                    pair[1], other[1] = d, b
+                else:
+                    continue
+                if self.history.count(pair[0], pair[1]) == 0:
+                    break
+
+    def _place_leftover(self, pairs, user_uuid, positions):
+        # Нечетного участника добавляем третьим в пару, где он никого не встречал
+        best, best_cost = None, None
+        for index in self.rng.sample(range(len(pairs)), min(len(pairs), self.window * 4)):
+            a, b = pairs[index]
+            cost = self.cost(user_uuid, a, positions) + self.cost(user_uuid, b, positions)
+            if best is None or cost < best_cost:
+                best, best_cost = index, cost
+                if cost == 0:
+                    break
+        pairs[best].append(user_uuid)
+
+    def match(self, participants, positions=None):
+        started = time.perf_counter()
+        positions = positions or {}
+        order = self._order(participants, positions)
+        pairs, leftover = self._greedy(order, positions)
+        self._improve(pairs, positions)
+        if pairs and leftover:
+            for user_uuid in leftover:
+                self._place_leftover(pairs, user_uuid, positions)
+            leftover = []
+
+        groups = [tuple(group) for group in pairs]
+        repeats = sum(
+            1 for group in groups
+            for i in range(len(group)) for j in range(i + 1, len(group))
+            if self.history.count(group[i], group[j])
+        )
+        elapsed = time.perf_counter() - started
+        logger.info(f"Подобрано групп: {len(groups)}, повторных встреч: {repeats}, время {elapsed:.3f} с")
+        return MatchResult(groups, leftover, repeats, elapsed)
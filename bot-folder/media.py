@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import logging
+import os
+
+from telegram.error import BadRequest
+
+from storage import MEDIA_ASSETS
+
+logger = logging.getLogger(__name__)
+
+ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets')
+
+# Медиа бота: имя -> (тип, файл в assets/). Тип - суффикс метода Bot.send_<тип>:
+# photo, document, video, animation. Файлы лежат рядом с ботом, внешних адресов нет
+ASSETS = {
+    'registration': ('photo', 'registration.png'),
+}
+
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_id(message):
+    # У фото Telegram возвращает несколько размеров, последний - оригинал
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)):
+        attachment = attachment[-1]
+    return attachment.file_id
+
+
+class MediaRegistry:
+    # Каждый файл загружается в Telegram один раз, полученный file_id сохраняется в хранилище
+    # и дальше отправляется вместо файла. file_id привязан к боту и к содержимому файла: при
+    # смене токена или файла, а также если Telegram отклонил file_id, файл загружается заново
+
+    def __init__(self, storage, assets=ASSETS, directory=ASSETS_DIR):
+        self.storage = storage
+        self.assets = assets
+        self.directory = directory
+        self._sources = {}
+        # Первые одновременные отправки одного файла ждут одну загрузку
+        self._locks = {}
+
+    def check(self):
+        # Вызывается при старте: без файла бот не запускается, а не падает на первой отправке
+        missing = [os.path.join(self.directory, filename) for _, filename in self.assets.values()
+                   if not os.path.exists(os.path.join(self.directory, filename))]
+        if missing:
+            raise FileNotFoundError(f"Нет файлов медиа: {', '.join(missing)}")
+
+    def _source(self, name):
+        # (путь к файлу, отпечаток содержимого)
+        source = self._sources.get(name)
+        if source is None:
+            path = os.path.join(self.directory, self.assets[name][1])
+            source = self._sources[name] = (path, _file_digest(path))
+        return source
+
+    def _cached(self, name, bot_id):
+        entry = self.storage.get(MEDIA_ASSETS, name)
+        if entry and entry['bot'] == bot_id and entry['source'] == self._source(name)[1]:
+            return entry['file_id']
+        return None
+
+    async def send(self, bot, name, chat_id, **kwargs):
+        # Отправить медиа name в чат; kwargs передаются в send_<тип> (caption, reply_markup...)
+        kind = self.assets[name][0]
+        method = getattr(bot, f'send_{kind}')
+        file_id = self._cached(name, bot.id)
+        if file_id:
+            try:
+                return await method(chat_id, file_id, **kwargs)
+            except BadRequest as e:
+                logger.warning(f"Telegram отклонил file_id медиа {name}: {e}, загружаем заново")
+                if self._cached(name, bot.id) == file_id:
+                    self.storage.delete(MEDIA_ASSETS, name)
+
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        async with lock:
+            # Пока ждали, файл мог загрузить другой обработчик
+            file_id = self._cached(name, bot.id)
+            if file_id:
+                return await method(chat_id, file_id, **kwargs)
+            path, fingerprint = self._source(name)
+            with open(path, 'rb') as file:
+                message = await method(chat_id, file, **kwargs)
+            self.storage.put(MEDIA_ASSETS, name, {'file_id': _file_id(message), 'bot': bot.id, 'source': fingerprint})
+            logger.info(f"Медиа {name} загружено в Telegram, дальше отправляется по file_id")
+            return message
@@ -0,0 +1,212 @@
+import asyncio
+import functools
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм в секундах
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels)) + '}'
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def quantile(self, q):
+        # Оценка квантиля как histogram_quantile в Prometheus: линейно внутри корзины,
+        # а не верхней границей корзины. Выше последней границы - сама граница
+        if not self.total:
+            return 0.0
+        target = q * self.total
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= target:
+                return lower + (bound - lower) * (target - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+
+class Metrics:
+    # Счетчики, гистограммы и текущие значения в формате Prometheus (text exposition)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        self._gauge_callbacks = {}
+        self._help = {}
+        # Трассировка апдейтов (profiling.py) получает каждое измерение времени
+        self.on_observe = None
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+        hook = self.on_observe
+        if hook is not None:
+            hook(name, value, key[1])
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge_callback(self, name, func):
+        # Значение вычисляется в момент чтения метрик
+        self._gauge_callbacks[name] = func
+
+    def histogram(self, name, **labels):
+        return self._histograms.get((name, tuple(sorted(labels.items()))))
+
+    def merged_histogram(self, name, exclude=()):
+        # Сумма гистограмм метрики по всем меткам, кроме исключенных обработчиков
+        merged = Histogram()
+        with self._lock:
+            for (metric, labels), histogram in self._histograms.items():
+                if metric != name or dict(labels).get('handler') in exclude:
+                    continue
+                merged.total += histogram.total
+                merged.sum += histogram.sum
+                merged.counts = [a + b for a, b in zip(merged.counts, histogram.counts)]
+        return merged
+
+    def render(self):
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            histograms = [(key, list(h.buckets), list(h.counts), h.total, h.sum) for key, h in histograms]
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{name}{_labels_text(labels)} {value}")
+        for (name, labels), value in gauges:
+            header(name, 'gauge')
+            lines.append(f"{name}{_labels_text(labels)} {value}")
+        for name, func in sorted(self._gauge_callbacks.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.error(f"Не удалось вычислить метрику {name}: {e}")
+                continue
+            header(name, 'gauge')
+            lines.append(f"{name} {value}")
+        for (name, labels), buckets, counts, total, total_sum in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_labels_text(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels_text(labels + (('le', '+Inf'),))} {total}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {total_sum}")
+            lines.append(f"{name}_count{_labels_text(labels)} {total}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('coffee_handler_seconds', 'Время обработки апдейта обработчиком')
+metrics.describe('coffee_handler_errors_total', 'Исключения в обработчиках')
+metrics.describe('coffee_storage_load_seconds', 'Время загрузки набора данных')
+metrics.describe('coffee_storage_save_seconds', 'Время записи набора данных')
+metrics.describe('coffee_storage_bytes_written_total', 'Записано байт в хранилище')
+metrics.describe('coffee_storage_flush_seconds', 'Время сброса отложенных изменений набора')
+metrics.describe('coffee_storage_coalesced_writes_total', 'Изменения, объединенные с уже ожидающим сбросом')
+metrics.describe('coffee_messages_sent_total', 'Исходящие сообщения по результату')
+metrics.describe('coffee_cycle_users', 'Участников в текущем цикле')
+metrics.describe('coffee_users', 'Зарегистрированных пользователей')
+metrics.describe('coffee_match_groups', 'Групп создано при последнем подборе')
+metrics.describe('coffee_match_groups_total', 'Групп создано за все подборы')
+
+
+def timed(func):
+    # Декоратор для async-обработчиков: гистограмма времени и счетчик ошибок по имени функции
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        except Exception:
+            metrics.inc('coffee_handler_errors_total', handler=name)
+            raise
+        finally:
+            metrics.observe('coffee_handler_seconds', time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+
+async def _serve(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        path = request_line.split()[1].decode() if len(request_line.split()) > 1 else '/'
+        if path.split('?')[0] == '/metrics':
+            body = metrics.render().encode('utf-8')
+            status = '200 OK'
+        else:
+            body = b'not found\n'
+            status = '404 Not Found'
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.error(f"Ошибка при отдаче метрик: {e}")
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host='127.0.0.1', port=9108):
+    server = await asyncio.start_server(_serve, host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
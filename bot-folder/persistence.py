@@ -0,0 +1,104 @@
+import copy
+import json
+import logging
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from storage import CONVERSATIONS, USER_CONTEXT
+
+logger = logging.getLogger(__name__)
+
+
+def conversation_key(name, key):
+    # Ключ ConversationHandler - кортеж (chat_id, user_id), в хранилище - строка
+    return f"{name}:{json.dumps(list(key))}"
+
+
+class StoragePersistence(BasePersistence):
+    # Persistence для PTB поверх хранилища бота (storage.py / write_behind.py):
+    # - context.user_data читается лениво, при первом апдейте от пользователя;
+    # - PTB раз в update_interval передает только измененных пользователей и диалоги,
+    #   они уходят в хранилище построчными put/delete;
+    # - сохраняются только незавершенные диалоги, завершенные удаляются
+
+    def __init__(self, storage, update_interval=5):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True,
+                                                     callback_data=False),
+                         update_interval=update_interval)
+        self.storage = storage
+        self._loaded_users = set()
+
+    # user_data
+
+    async def get_user_data(self):
+        # Ничего не читаем заранее - данные пользователя подгружает refresh_user_data
+        return {}
+
+    async def refresh_user_data(self, user_id, user_data):
+        if user_id in self._loaded_users:
+            return
+        self._loaded_users.add(user_id)
+        stored = self.storage.get(USER_CONTEXT, user_id)
+        if stored and not user_data:
+            user_data.update(stored)
+
+    async def update_user_data(self, user_id, data):
+        self._loaded_users.add(user_id)
+        # Копия: хранилище пишет на диск в фоне, а обработчики продолжают менять словарь
+        self.storage.put(USER_CONTEXT, user_id, copy.deepcopy(data))
+
+    async def drop_user_data(self, user_id):
+        self._loaded_users.discard(user_id)
+        self.storage.delete(USER_CONTEXT, user_id)
+
+    # Диалоги
+
+    async def get_conversations(self, name):
+        prefix = f"{name}:"
+        conversations = {}
+        for key, state in self.storage.load(CONVERSATIONS).items():
+            if key.startswith(prefix):
+                conversations[tuple(json.loads(key[len(prefix):]))] = state
+        logger.info(f"Восстановлено диалогов {name}: {len(conversations)}")
+        return conversations
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            self.storage.delete(CONVERSATIONS, conversation_key(name, key))
+        else:
+            self.storage.put(CONVERSATIONS, conversation_key(name, key), new_state)
+
+    # chat_data, bot_data и callback_data бот не использует
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        # PTB уже передал все изменения; сбрасываем отложенную запись, если она есть
+        flush = getattr(self.storage, 'flush', None)
+        if flush:
+            flush()
@@ -0,0 +1,267 @@
+import collections
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Кадр, в котором простаивающий цикл событий ждет сокеты
+IDLE_FRAME = 'select (selectors.py'
+# Обертки вокруг обработчиков: при поиске виновника блокировки их кадры пропускаются
+WRAPPER_FILES = ('metrics.py', 'update_processor.py', 'profiling.py')
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _frames(frame):
+    # Кадры от внутреннего к внешнему
+    while frame is not None:
+        yield frame
+        frame = frame.f_back
+
+
+def _stack(frame):
+    # Стек от внешнего вызова к внутреннему
+    labels = [_frame_label(f) for f in _frames(frame)]
+    labels.reverse()
+    return labels
+
+
+class SamplingProfiler:
+    # Профиль по выборкам: фоновый поток каждые interval секунд снимает стек потока цикла
+    # событий через sys._current_frames() и считает одинаковые стеки. Сам цикл событий
+    # не инструментируется, поэтому накладные расходы не зависят от числа обработчиков.
+    # Результат - collapsed stacks ("a;b;c 42"), их читают flamegraph.pl и speedscope
+
+    def __init__(self, interval=0.005, max_seconds=300):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self._thread = None
+        self._stop = threading.Event()
+        self._counts = collections.Counter()
+        self._samples = 0
+        self._started = 0.0
+        self._target = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self, thread_id=None):
+        # thread_id - поток, который профилируем; по умолчанию вызывающий (цикл событий)
+        if self.running:
+            return False
+        self._target = threading.get_ident() if thread_id is None else thread_id
+        self._counts = collections.Counter()
+        self._samples = 0
+        self._started = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        deadline = self._started + self.max_seconds
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                break
+            self._counts[';'.join(_stack(frame))] += 1
+            self._samples += 1
+            if time.monotonic() >= deadline:
+                logger.warning(f"Профилирование остановлено по лимиту {self.max_seconds} с, ждет /profile stop")
+                break
+
+    def stop(self):
+        # Возвращает (collapsed stacks, выборок, секунд) или None, если профилирование не шло
+        if not self.running:
+            return None
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        elapsed = time.monotonic() - self._started
+        text = ''.join(f"{stack} {count}\n" for stack, count in self._counts.most_common())
+        return text, self._samples, elapsed
+
+    def top(self, limit=5):
+        # Функции, на которых чаще всего останавливалась выборка (собственное время),
+        # без ожидания цикла событий в selectors - это простой, а не работа
+        own = collections.Counter()
+        for stack, count in self._counts.items():
+            leaf = stack.rsplit(';', 1)[-1]
+            if not leaf.startswith(IDLE_FRAME):
+                own[leaf] += count
+        return own.most_common(limit)
+
+
+def _span_name(name, labels):
+    # coffee_storage_save_seconds{dataset=user_data} -> "storage_save user_data"
+    short = name[len('coffee_'):] if name.startswith('coffee_') else name
+    short = short[:-len('_seconds')] if short.endswith('_seconds') else short
+    return ' '.join([short] + [str(value) for _, value in labels])
+
+
+class UpdateTrace:
+
+    def __init__(self, update_id, kind):
+        self.update_id = update_id
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.seconds = None
+        # [(название, секунды)] в порядке завершения
+        self.spans = []
+
+    def format(self):
+        spans = ', '.join(f"{name} {seconds * 1000:.1f} мс" for name, seconds in self.spans)
+        return f"апдейт {self.update_id} ({self.kind}): {self.seconds * 1000:.1f} мс [{spans}]"
+
+
+def describe_update(update):
+    # Что пришло: команда или текст, нажатая кнопка - без содержимого сообщений пользователя
+    query = getattr(update, 'callback_query', None)
+    if query is not None:
+        return f"callback {query.data}"
+    message = getattr(update, 'message', None)
+    text = getattr(message, 'text', None) or ''
+    if text.startswith('/'):
+        return text.split()[0]
+    return 'message' if message is not None else 'update'
+
+
+class UpdateTracer:
+    # Трассировка апдейтов по запросу: путь апдейта через обработчики (@timed), чтение и запись
+    # хранилища и вызовы Bot API с их длительностью. Включается /profile trace on; трасса
+    # привязана к задаче апдейта через contextvars, поэтому параллельные апдейты не смешиваются.
+    # Выключенная трассировка стоит одну проверку в metrics.observe
+
+    def __init__(self, keep=200, min_seconds=0.0):
+        self.min_seconds = min_seconds
+        self.recent = collections.deque(maxlen=keep)
+        self._current = contextvars.ContextVar('coffee_update_trace', default=None)
+        self.enabled = False
+
+    def enable(self, min_seconds=None):
+        if min_seconds is not None:
+            self.min_seconds = min_seconds
+        self.enabled = True
+        metrics.on_observe = self.record
+
+    def disable(self):
+        self.enabled = False
+        metrics.on_observe = None
+
+    def begin(self, update):
+        if not self.enabled:
+            return None
+        trace = UpdateTrace(getattr(update, 'update_id', None), describe_update(update))
+        return trace, self._current.set(trace)
+
+    def finish(self, started):
+        if started is None:
+            return
+        trace, token = started
+        self._current.reset(token)
+        trace.seconds = time.perf_counter() - trace.started
+        if trace.seconds >= self.min_seconds:
+            self.recent.append(trace)
+            logger.info(f"Трасса: {trace.format()}")
+
+    def record(self, name, seconds, labels=()):
+        trace = self._current.get()
+        if trace is not None:
+            trace.spans.append((_span_name(name, labels), seconds))
+
+    def dump(self):
+        return ''.join(trace.format() + '\n' for trace in self.recent)
+
+
+def trace_requests(request, tracer):
+    # Вызовы Bot API через этот запрос попадают в трассу апдейта, из которого сделаны
+    do_request = request.do_request
+
+    async def traced(url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await do_request(url, *args, **kwargs)
+        finally:
+            # В адресе есть токен - в трассу идет только метод API
+            tracer.record(f"api_{url.rsplit('/', 1)[-1]}", time.perf_counter() - started)
+
+    request.do_request = traced
+
+
+class LoopWatchdog:
+    # Детектор блокировок цикла событий: цикл раз в interval отмечается, сторожевой поток
+    # проверяет отметку. Если цикл молчит дольше threshold, в лог идет стек потока цикла -
+    # по нему видно, какой обработчик держит цикл. В отличие от loop.set_debug(True),
+    # обычная работа цикла не замедляется
+
+    def __init__(self, threshold=0.5, interval=0.1):
+        self.threshold = threshold
+        self.interval = interval
+        self._loop = None
+        self._thread_id = None
+        self._beat = 0.0
+        self._reported = False
+        self._handle = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, loop):
+        self._loop = loop
+        self._thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        self._handle = loop.call_later(self.interval, self._heartbeat)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+        logger.info(f"Детектор блокировок цикла событий включен, порог {self.threshold} с")
+
+    def _heartbeat(self):
+        now = time.monotonic()
+        lag = now - self._beat - self.interval
+        if lag >= self.threshold:
+            metrics.inc('coffee_loop_stalls_total')
+            metrics.observe('coffee_loop_stall_seconds', lag)
+            logger.warning(f"Цикл событий был заблокирован {lag:.3f} с")
+        self._beat = now
+        self._reported = False
+        self._handle = self._loop.call_later(self.interval, self._heartbeat)
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            if self._reported or time.monotonic() - self._beat - self.interval < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            self._reported = True
+            stack = _stack(frame)
+            # Кадры самого бота, без PTB, asyncio и оберток - это и есть виновный обработчик
+            own = [_frame_label(f) for f in _frames(frame) if f.f_code.co_filename.startswith(BOT_DIR)
+                   and os.path.basename(f.f_code.co_filename) not in WRAPPER_FILES]
+            logger.warning(f"Цикл событий заблокирован дольше {self.threshold} с, обработчик: "
+                           f"{' <- '.join(own[:5]) or 'не найден'}; стек: {' -> '.join(stack[-15:])}")
+
+    def stop(self):
+        self._stop.set()
+        if self._handle:
+            self._handle.cancel()
+        if self._thread:
+            self._thread.join(timeout=self.interval * 5)
+
+
+metrics.describe('coffee_loop_stalls_total', 'Блокировки цикла событий дольше порога')
+metrics.describe('coffee_loop_stall_seconds', 'Длительность блокировок цикла событий')
+
+profiler = SamplingProfiler()
+tracer = UpdateTracer()
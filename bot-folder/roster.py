@@ -0,0 +1,107 @@
+import csv
+import json
+
+# Лимит Telegram на длину сообщения - 4096 символов, оставляем запас под заголовок
+MESSAGE_LIMIT = 3800
+PAGE_SIZE = 20
+# Имя, почта и должность - свободный текст до 4096 символов; в карточке поле обрезается
+CARD_FIELD_LIMIT = 300
+EXPORT_CHUNK = 1000
+EXPORT_FIELDS = ['uuid', 'id', 'name', 'email', 'position', 'in_cycle', 'opted_out']
+
+
+def parse_filter(args):
+    # Фильтр из аргументов команды: cycle, not_cycle или position=<должность>
+    text = ' '.join(args).strip()
+    if not text:
+        return None
+    if text in ('cycle', 'not_cycle'):
+        return text
+    if text.startswith('position='):
+        position = text[len('position='):].strip()
+        if position:
+            return f'position={position}'
+    raise ValueError(text)
+
+
+def describe_filter(spec):
+    if spec is None:
+        return "все пользователи"
+    if spec == 'cycle':
+        return "участники текущего цикла"
+    if spec == 'not_cycle':
+        return "отказавшиеся от участия"
+    return f"должность содержит «{spec[len('position='):]}»"
+
+
+def make_predicate(spec, registry):
+    if spec is None:
+        return None
+    if spec == 'cycle':
+        return lambda user_uuid, info: registry.is_member(user_uuid)
+    if spec == 'not_cycle':
+        return lambda user_uuid, info: registry.is_opted_out(user_uuid)
+    position = spec[len('position='):].lower()
+    return lambda user_uuid, info: position in (info.position or '').lower()
+
+
+def _clip(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def format_card(info):
+    name = _clip(info.name or 'Не указано', CARD_FIELD_LIMIT)
+    email = _clip(info.email or 'Не указано', CARD_FIELD_LIMIT)
+    position = _clip(info.position or 'Не указано', CARD_FIELD_LIMIT)
+    return f"Имя: {name}\nПочта: {email}\nДолжность: {position}\n\n"
+
+
+def render_page(items, page_number, spec):
+    # Собираем страницу списком строк и одним join, не выходя за лимит сообщения
+    parts = [f"Карточки пользователей ({describe_filter(spec)}), страница {page_number}:\n"]
+    length = len(parts[0])
+    shown = 0
+    for _, info in items:
+        card = format_card(info)
+        if length + len(card) > MESSAGE_LIMIT:
+            if shown:
+                break
+            # Первая карточка страницы показывается всегда, иначе курсор не сдвинется
+            card = _clip(card, MESSAGE_LIMIT - length)
+        parts.append(card)
+        length += len(card)
+        shown += 1
+    return ''.join(parts), shown
+
+
+def export_row(user_uuid, info, registry):
+    return {
+        'uuid': user_uuid,
+        'id': info.id if info.id is not None else '',
+        'name': info.name,
+        'email': info.email,
+        'position': info.position,
+        'in_cycle': registry.is_member(user_uuid),
+        'opted_out': registry.is_opted_out(user_uuid),
+    }
+
+
+class RosterExporter:
+    # Построчная запись пользователей в CSV или JSONL-файл порциями по EXPORT_CHUNK,
+    # чтобы не собирать весь список в памяти
+
+    def __init__(self, file, fmt):
+        self.file = file
+        self.fmt = fmt
+        self.rows = 0
+        self._writer = None
+        if fmt == 'csv':
+            self._writer = csv.DictWriter(file, fieldnames=EXPORT_FIELDS)
+            self._writer.writeheader()
+
+    def write(self, row):
+        if self._writer is not None:
+            self._writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row, ensure_ascii=False) + '\n')
+        self.rows += 1
@@ -0,0 +1,84 @@
+import logging
+import time
+
+from metrics import metrics
+from storage import CYCLE_USERS, NOT_CYCLE_USERS, PAIR_HISTORY, USER_DATA
+
+logger = logging.getLogger(__name__)
+
+# Наборы, которые процессы-воркеры держат в памяти и синхронизируют через ленту изменений SQLite.
+# pair_history - чтобы подбор на любом воркере не сводил уже встречавшихся
+SHARED_DATASETS = (USER_DATA, CYCLE_USERS, NOT_CYCLE_USERS, PAIR_HISTORY)
+
+
+class SharedState:
+    # Несколько процессов работают с одной базой SQLite. Каждый держит user_data и состав цикла
+    # в памяти (индексы, быстрые обработчики), а перед обработкой апдейта дочитывает из таблицы
+    # changes, какие строки поменяли другие процессы, и перечитывает только их.
+    # Если процесс отстал дальше, чем хранится лента, наборы перечитываются целиком.
+    # on_user_removed(telegram_id) вызывается, когда другой процесс удалил пользователя
+    # (например, перенес в архив): процесс, обрабатывавший его апдейты, забывает и его context.user_data
+
+    def __init__(self, storage, user_data, cycle_registry, pair_history=None, on_user_removed=None):
+        self.storage = storage
+        self.user_data = user_data
+        self.cycle_registry = cycle_registry
+        self.pair_history = pair_history
+        self.on_user_removed = on_user_removed
+        self.last_seq = storage.last_change()
+
+    def reload(self):
+        self.user_data.load(self.storage.load(USER_DATA))
+        self.cycle_registry.load()
+        if self.pair_history is not None:
+            self.pair_history.load(self.storage.load(PAIR_HISTORY))
+
+    def sync(self):
+        started = time.perf_counter()
+        applied = 0
+        while True:
+            first, rows = self.storage.changes_since(self.last_seq)
+            if first is not None and first > self.last_seq + 1:
+                logger.warning(f"Лента изменений обрезана (есть с {first}, прочитано до {self.last_seq}), перечитываем данные")
+                self.last_seq = self.storage.last_change()
+                self.reload()
+                return
+            if not rows:
+                break
+            changed = {}
+            for seq, dataset, key in rows:
+                changed[(dataset, key)] = seq
+            for dataset, key in changed:
+                self._apply(dataset, key)
+            applied += len(changed)
+            self.last_seq = rows[-1][0]
+        if applied:
+            metrics.observe('coffee_shared_sync_seconds', time.perf_counter() - started)
+            logger.debug(f"Синхронизировано изменений других процессов: {applied}")
+
+    def _apply(self, dataset, key):
+        if dataset == PAIR_HISTORY:
+            if self.pair_history is None:
+                return
+            if key == '*':
+                self.pair_history.load(self.storage.load(PAIR_HISTORY))
+            else:
+                user1_uuid, _, user2_uuid = key.partition('|')
+                self.pair_history.set(user1_uuid, user2_uuid, self.storage.get(PAIR_HISTORY, key))
+            return
+        if key == '*':
+            if dataset == USER_DATA:
+                self.user_data.load(self.storage.load(USER_DATA))
+            else:
+                self.cycle_registry.load()
+            return
+        value = self.storage.get(dataset, key)
+        if dataset == USER_DATA:
+            if value is None:
+                info = self.user_data.delete(key)
+                if info is not None and info.id is not None and self.on_user_removed:
+                    self.on_user_removed(info.id)
+            else:
+                self.user_data.upsert(key, value)
+        elif dataset in (CYCLE_USERS, NOT_CYCLE_USERS):
+            self.cycle_registry.refresh(dataset, key, value)
@@ -0,0 +1,77 @@
+import logging
+import marshal
+import os
+import struct
+import time
+
+from storage import DATASETS, USER_CONTEXT
+
+logger = logging.getLogger(__name__)
+
+# Бинарный снимок данных для быстрого старта: заголовок MAGIC + версия формата,
+# затем marshal от {'fingerprint': ..., 'created': ..., 'datasets': {...}}.
+# Пишется при штатной остановке, при старте используется, только если хранилище
+# с тех пор не менялось (совпадает отпечаток файлов), иначе - обычная загрузка из JSON/SQLite
+MAGIC = b'COFFEESNAP'
+VERSION = 1
+_HEADER = struct.Struct('>H')
+
+# context.user_data читается лениво по одному пользователю (persistence.py), в снимок не попадает
+SNAPSHOT_DATASETS = tuple(dataset for dataset in DATASETS if dataset != USER_CONTEXT)
+
+
+def _file_signature(path):
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def storage_fingerprint(backend, directory='.', db_path='coffee.db'):
+    # Отпечаток файлов хранилища; считается при закрытом хранилище
+    if backend == 'json':
+        return {dataset: _file_signature(os.path.join(directory, f'{dataset}.json')) for dataset in DATASETS}
+    if backend == 'sqlite':
+        return {path: _file_signature(path) for path in (db_path, f'{db_path}-wal')}
+    # У журнала свой снимок, бинарный не используется
+    return None
+
+
+def write_snapshot(path, datasets, fingerprint):
+    started = time.perf_counter()
+    payload = marshal.dumps({'fingerprint': fingerprint, 'created': int(time.time()), 'datasets': datasets})
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as file:
+        file.write(MAGIC + _HEADER.pack(VERSION))
+        file.write(payload)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    logger.info(f"Снимок {path} записан ({len(payload)} байт) за {time.perf_counter() - started:.3f} с")
+
+
+def read_snapshot(path, fingerprint):
+    # Возвращает {набор: данные} или None, если снимка нет, он другой версии или устарел
+    if not path or fingerprint is None or not os.path.exists(path):
+        return None
+    started = time.perf_counter()
+    try:
+        with open(path, 'rb') as file:
+            header = file.read(len(MAGIC) + _HEADER.size)
+            if header[:len(MAGIC)] != MAGIC:
+                logger.warning(f"Снимок {path}: неизвестный формат, загружаем из хранилища")
+                return None
+            version, = _HEADER.unpack(header[len(MAGIC):])
+            if version != VERSION:
+                logger.warning(f"Снимок {path}: версия {version} не поддерживается, загружаем из хранилища")
+                return None
+            payload = marshal.loads(file.read())
+    except Exception as e:
+        logger.error(f"Не удалось прочитать снимок {path}: {e}")
+        return None
+    if payload.get('fingerprint') != fingerprint:
+        logger.info(f"Снимок {path} устарел: хранилище менялось после него")
+        return None
+    logger.info(f"Снимок {path} прочитан за {time.perf_counter() - started:.3f} с")
+    return payload['datasets']
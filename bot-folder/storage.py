@@ -0,0 +1,412 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Наборы данных бота. Имя набора совпадает с именем JSON-файла без расширения
+USER_DATA = 'user_data'
+CYCLE_USERS = 'cycle_users'
+NOT_CYCLE_USERS = 'not_cycle_users'
+FEEDBACK_DATA = 'feedback_data'
+PAIR_HISTORY = 'pair_history'
+# Состояния ConversationHandler и context.user_data (см. persistence.py)
+CONVERSATIONS = 'conversations'
+USER_CONTEXT = 'user_context'
+# Отзывы о встречах и счетчики по циклам (см. feedback.py)
+MATCH_FEEDBACK = 'match_feedback'
+USER_MATCHES = 'user_matches'
+CYCLE_STATS = 'cycle_stats'
+# План подбора пар и журнал доставки сообщений о парах (см. match_plan.py)
+CYCLE_PLANS = 'cycle_plans'
+DELIVERIES = 'deliveries'
+# file_id загруженных в Telegram картинок и документов (см. media.py)
+MEDIA_ASSETS = 'media_assets'
+# Изменения состава цикла для сводки админам (см. admin_digest.py)
+DIGEST_CHANGES = 'digest_changes'
+DATASETS = (USER_DATA, CYCLE_USERS, NOT_CYCLE_USERS, FEEDBACK_DATA, PAIR_HISTORY, CONVERSATIONS, USER_CONTEXT,
+            MATCH_FEEDBACK, USER_MATCHES, CYCLE_STATS, CYCLE_PLANS, DELIVERIES, MEDIA_ASSETS, DIGEST_CHANGES)
+
+
+# Сколько символов данных показывать в отладочном логе
+LOG_PREVIEW_LIMIT = 500
+
+
+def summarize(data):
+    # Краткое описание набора для логов вместо полного дампа
+    size = len(data) if hasattr(data, '__len__') else 1
+    if not logger.isEnabledFor(logging.DEBUG):
+        return f"{size} записей"
+    preview = repr(data)
+    if len(preview) > LOG_PREVIEW_LIMIT:
+        preview = preview[:LOG_PREVIEW_LIMIT] + '...'
+    return f"{size} записей: {preview}"
+
+
+def plain(value):
+    # Значение в формате хранилища: объекты с to_dict (UserRecord из user_repo.py) пишутся
+    # прежним словарем. Передается в json как default=
+    to_dict = getattr(value, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError(f"Объект типа {type(value).__name__} нельзя сохранить")
+    return to_dict()
+
+
+def _dataset_label(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+# Функции загрузки и сохранения данных
+def load_data(filename, default):
+    try:
+        if os.path.exists(filename):
+            started = time.perf_counter()
+            with open(filename, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            metrics.observe('coffee_storage_load_seconds', time.perf_counter() - started, dataset=_dataset_label(filename))
+            logger.debug(f"Данные загружены из {filename}: {summarize(data)}")
+            return data
+        return default
+    except Exception as e:
+        logger.error(f"Не удалось загрузить данные из {filename}: {e}")
+        return default
+
+
+def save_data(data, filename):
+    # Пишем во временный файл и атомарно подменяем, чтобы сбой не оставил обрезанный JSON
+    tmp_filename = f'{filename}.tmp'
+    started = time.perf_counter()
+    try:
+        with open(tmp_filename, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, indent=4, default=plain)
+            file.flush()
+            os.fsync(file.fileno())
+            written = file.tell()
+        os.replace(tmp_filename, filename)
+        dataset = _dataset_label(filename)
+        metrics.observe('coffee_storage_save_seconds', time.perf_counter() - started, dataset=dataset)
+        metrics.inc('coffee_storage_bytes_written_total', written, dataset=dataset)
+        logger.debug(f"Данные сохранены в {filename}: {summarize(data)}")
+    except Exception as e:
+        logger.error(f"Не удалось сохранить данные в {filename}: {e}")
+        raise
+
+
+class JsonStorage:
+    # Хранение каждого набора в отдельном JSON-файле. Подходит для небольших установок:
+    # любое изменение строки переписывает весь файл набора
+    whole_file = True
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self._cache = {}
+
+    def path(self, dataset):
+        return os.path.join(self.directory, f'{dataset}.json')
+
+    def _dataset(self, dataset):
+        if dataset not in self._cache:
+            self._cache[dataset] = load_data(self.path(dataset), {})
+        return self._cache[dataset]
+
+    def load(self, dataset):
+        return dict(self._dataset(dataset))
+
+    def count(self, dataset):
+        return len(self._dataset(dataset))
+
+    def get(self, dataset, key, default=None):
+        return self._dataset(dataset).get(str(key), default)
+
+    def put(self, dataset, key, value):
+        data = self._dataset(dataset)
+        data[str(key)] = value
+        save_data(data, self.path(dataset))
+
+    def delete(self, dataset, key):
+        data = self._dataset(dataset)
+        if data.pop(str(key), None) is not None:
+            save_data(data, self.path(dataset))
+
+    def replace(self, dataset, data):
+        self._cache[dataset] = dict(data)
+        save_data(self._cache[dataset], self.path(dataset))
+
+    def adopt(self, dataset, data):
+        # Те же данные в другом представлении (UserRecord вместо словарей) - кэш не держит вторую копию
+        if dataset in self._cache:
+            self._cache[dataset] = dict(data)
+
+    def write_changes(self, dataset, upserts, deletes, snapshot):
+        # Файл всё равно переписывается целиком, поэтому пишем готовый снимок набора
+        self._cache[dataset] = snapshot
+        save_data(snapshot, self.path(dataset))
+
+    def close(self):
+        pass
+
+
+# Сколько последних записей ленты изменений хранить для других процессов
+CHANGES_KEEP = 100000
+CHANGES_TRIM_EVERY = 1000
+
+
+class SqliteStorage:
+    # Хранение в SQLite (WAL): по таблице на набор, изменения - построчные upsert'ы.
+    # track_changes - наборы, изменения которых дополнительно пишутся в таблицу changes,
+    # чтобы другие процессы с той же базой могли обновить свои кэши (см. shared_state.py)
+
+    def __init__(self, path='coffee.db', track_changes=()):
+        self.path = path
+        self.track_changes = frozenset(track_changes)
+        self._tracked = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS user_data (
+                    key TEXT PRIMARY KEY,
+                    telegram_id INTEGER,
+                    email TEXT,
+                    value TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS user_data_telegram_id ON user_data (telegram_id);
+                CREATE INDEX IF NOT EXISTS user_data_email ON user_data (email);
+                CREATE TABLE IF NOT EXISTS cycle_users (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS not_cycle_users (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS feedback_data (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS pair_history (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS conversations (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS user_context (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS match_feedback (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS user_matches (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS cycle_stats (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS cycle_plans (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS deliveries (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS media_assets (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS digest_changes (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    dataset TEXT NOT NULL,
+                    key TEXT NOT NULL
+                );
+            """)
+
+    @staticmethod
+    def _check(dataset):
+        if dataset not in DATASETS:
+            raise ValueError(f"Неизвестный набор данных: {dataset}")
+
+    def _upsert_sql(self, dataset):
+        if dataset == USER_DATA:
+            return ("INSERT INTO user_data (key, telegram_id, email, value) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET telegram_id = excluded.telegram_id, "
+                    "email = excluded.email, value = excluded.value")
+        return (f"INSERT INTO {dataset} (key, value) VALUES (?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET value = excluded.value")
+
+    @staticmethod
+    def _row(dataset, key, value):
+        encoded = json.dumps(value, ensure_ascii=False, default=plain)
+        if dataset == USER_DATA:
+            if not isinstance(value, dict):
+                value = plain(value) if hasattr(value, 'to_dict') else {}
+            info = value
+            return str(key), info.get('id'), (info.get('email') or '').lower(), encoded
+        return str(key), encoded
+
+    def _track(self, dataset, keys):
+        # Вызывается внутри транзакции записи, чтобы изменение и запись о нем не разошлись
+        if dataset not in self.track_changes:
+            return
+        self._conn.executemany("INSERT INTO changes (dataset, key) VALUES (?, ?)", [(dataset, str(key)) for key in keys])
+        self._tracked += len(keys)
+        if self._tracked >= CHANGES_TRIM_EVERY:
+            self._tracked = 0
+            self._conn.execute("DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (CHANGES_KEEP,))
+
+    def last_change(self):
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return row[0] if row else 0
+
+    def changes_since(self, seq, limit=10000):
+        # Возвращает (первый доступный seq, [(seq, набор, ключ), ...]); ключ '*' - набор заменен целиком
+        with self._lock:
+            first = self._conn.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+            rows = self._conn.execute(
+                "SELECT seq, dataset, key FROM changes WHERE seq > ? ORDER BY seq LIMIT ?", (seq, limit)
+            ).fetchall()
+        return first, rows
+
+    def _record_write(self, dataset, started, rows):
+        metrics.observe('coffee_storage_save_seconds', time.perf_counter() - started, dataset=dataset)
+        metrics.inc('coffee_storage_bytes_written_total', sum(len(row[-1]) for row in rows), dataset=dataset)
+
+    def load(self, dataset):
+        self._check(dataset)
+        started = time.perf_counter()
+        with self._lock:
+            rows = self._conn.execute(f"SELECT key, value FROM {dataset}").fetchall()
+        data = {key: json.loads(value) for key, value in rows}
+        metrics.observe('coffee_storage_load_seconds', time.perf_counter() - started, dataset=dataset)
+        return data
+
+    def count(self, dataset):
+        self._check(dataset)
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM {dataset}").fetchone()[0]
+
+    def get(self, dataset, key, default=None):
+        # Чтение одной строки без загрузки всего набора
+        self._check(dataset)
+        with self._lock:
+            row = self._conn.execute(f"SELECT value FROM {dataset} WHERE key = ?", (str(key),)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def put(self, dataset, key, value):
+        self._check(dataset)
+        if dataset in self.track_changes:
+            self.write_changes(dataset, {key: value}, [])
+            return
+        started = time.perf_counter()
+        row = self._row(dataset, key, value)
+        with self._lock:
+            self._conn.execute(self._upsert_sql(dataset), row)
+        self._record_write(dataset, started, [row])
+
+    def update(self, dataset, key, func, default=None):
+        # Чтение-изменение-запись строки в одной транзакции: BEGIN IMMEDIATE берет блокировку
+        # записи до чтения, и процессы с общей базой не затирают изменения друг друга
+        self._check(dataset)
+        started = time.perf_counter()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                current = self._conn.execute(f"SELECT value FROM {dataset} WHERE key = ?", (str(key),)).fetchone()
+                value = func(json.loads(current[0]) if current else default)
+                row = self._row(dataset, key, value)
+                self._conn.execute(self._upsert_sql(dataset), row)
+                self._track(dataset, [key])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._record_write(dataset, started, [row])
+        return value
+
+    def delete(self, dataset, key):
+        self._check(dataset)
+        if dataset in self.track_changes:
+            self.write_changes(dataset, {}, [key])
+            return
+        with self._lock:
+            self._conn.execute(f"DELETE FROM {dataset} WHERE key = ?", (str(key),))
+
+    def replace(self, dataset, data):
+        self._check(dataset)
+        started = time.perf_counter()
+        rows = [self._row(dataset, key, value) for key, value in data.items()]
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute(f"DELETE FROM {dataset}")
+                self._conn.executemany(self._upsert_sql(dataset), rows)
+                self._track(dataset, ['*'])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._record_write(dataset, started, rows)
+
+    def write_changes(self, dataset, upserts, deletes, snapshot=None):
+        self._check(dataset)
+        started = time.perf_counter()
+        rows = [self._row(dataset, key, value) for key, value in upserts.items()]
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(self._upsert_sql(dataset), rows)
+                self._conn.executemany(f"DELETE FROM {dataset} WHERE key = ?", [(str(key),) for key in deletes])
+                self._track(dataset, list(upserts) + list(deletes))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        self._record_write(dataset, started, rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def update_row(storage, dataset, key, func, default=None):
+    # Новое значение строки func(текущее) с записью; возвращает новое значение.
+    # SqliteStorage делает это одной транзакцией (см. SqliteStorage.update). Остальные
+    # хранилища принадлежат одному процессу, и get/put без await между ними не перемешаются
+    update = getattr(storage, 'update', None)
+    if update:
+        return update(dataset, key, func, default)
+    value = func(storage.get(dataset, key, default))
+    storage.put(dataset, key, value)
+    return value
+
+
+def create_storage(backend='json', directory='.', db_path='coffee.db', track_changes=()):
+    if backend == 'json':
+        return JsonStorage(directory)
+    if backend == 'sqlite':
+        return SqliteStorage(db_path, track_changes)
+    if backend == 'journal':
+        from journal import JournalStorage
+        return JournalStorage(directory)
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
+
+
+# Наборы, которые бот хранил в JSON до появления SQLite
+LEGACY_DATASETS = (USER_DATA, CYCLE_USERS, NOT_CYCLE_USERS, FEEDBACK_DATA)
+
+
+def migrate_json_to_sqlite(directory='.', db_path='coffee.db', force=False):
+    # Одноразовый перенос user_data.json, cycle_users.json, not_cycle_users.json
+    # и feedback_data.json в SQLite. Наборы без JSON-файла не трогаем, непустые
+    # таблицы перезаписываем только с force
+    source = JsonStorage(directory)
+    target = SqliteStorage(db_path)
+    try:
+        datasets = [dataset for dataset in LEGACY_DATASETS if os.path.exists(source.path(dataset))]
+        filled = [dataset for dataset in datasets if target.count(dataset)]
+        if filled and not force:
+            raise RuntimeError(f"Таблицы {', '.join(filled)} в {db_path} уже заполнены, "
+                               f"для перезаписи запустите перенос с --force")
+        for dataset in datasets:
+            data = source.load(dataset)
+            target.replace(dataset, data)
+            logger.info(f"Перенесено записей из {source.path(dataset)}: {len(data)}")
+    finally:
+        target.close()
+
+
+if __name__ == '__main__':
+    # python storage.py migrate [--force] [каталог с JSON] [путь к базе]
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    args = [arg for arg in sys.argv[1:] if arg != '--force']
+    if not args or args[0] != 'migrate':
+        print("Использование: python storage.py migrate [--force] [каталог] [coffee.db]")
+        sys.exit(1)
+    try:
+        migrate_json_to_sqlite(*args[1:3], force='--force' in sys.argv)
+    except RuntimeError as e:
+        logger.error(e)
+        sys.exit(1)
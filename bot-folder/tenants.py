@@ -0,0 +1,133 @@
+import datetime
+import json
+import logging
+import os
+import re
+import zlib
+
+import pytz
+
+from user_repo import DEFAULT_TENANT
+
+logger = logging.getLogger(__name__)
+
+# id пространства попадает в ссылку t.me/<бот>?start=<id> и в ключи хранилища
+TENANT_ID_RE = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+DEFAULT_TIMEZONE = 'Europe/Minsk'
+
+
+def parse_time(value):
+    hours, minutes = value.split(':')
+    return datetime.time(int(hours), int(minutes))
+
+
+def parse_window(value):
+    # "09:00-18:00" -> (начало, конец); пусто - без окна. Окно может переходить через полночь
+    if not value:
+        return None
+    start, end = value.split('-')
+    start, end = parse_time(start.strip()), parse_time(end.strip())
+    if start == end:
+        raise ValueError(f"Пустое окно уведомлений: {value!r}")
+    return start, end
+
+
+def scoped(key, tenant_id):
+    # Ключ в общем наборе данных; у пространства по умолчанию - прежний, без префикса
+    return key if tenant_id == DEFAULT_TENANT else f"{tenant_id}:{key}"
+
+
+def jitter_seconds(tenant_id, limit):
+    # Постоянный для пространства сдвиг 0..limit секунд: задачи разных пространств
+    # не стартуют в одну секунду, а у каждого время запуска не меняется день ото дня
+    if limit <= 0:
+        return 0
+    return zlib.crc32(tenant_id.encode('utf-8')) % (int(limit) + 1)
+
+
+class Tenant:
+    # Пространство (компания/команда): свои админы, состав, циклы, расписание и часовой пояс.
+    # delivery_window - в какое местное время рассылать сообщения о парах; без него - сразу
+
+    def __init__(self, tenant_id, name=None, admins=(), timezone=DEFAULT_TIMEZONE, notify_at='15:13', match_at='20:48',
+                 delivery_window=None):
+        if not TENANT_ID_RE.match(tenant_id):
+            raise ValueError(f"Недопустимый id пространства: {tenant_id!r}")
+        self.id = tenant_id
+        self.name = name or tenant_id
+        self.admins = list(admins)
+        self.timezone = pytz.timezone(timezone)
+        self.notify_at = parse_time(notify_at)
+        self.match_at = parse_time(match_at)
+        self.delivery_window = parse_window(delivery_window)
+
+    def today(self):
+        return datetime.datetime.now(self.timezone).date().isoformat()
+
+    def next_run(self, at, now):
+        # Ближайший после now момент ежедневного времени at в поясе пространства, секунды epoch
+        local = datetime.datetime.fromtimestamp(now, self.timezone)
+        for shift in (0, 1, 2):
+            day = local.date() + datetime.timedelta(days=shift)
+            moment = self.timezone.localize(datetime.datetime.combine(day, at)).timestamp()
+            if moment > now:
+                return moment
+        raise ValueError(f"Не найдено время {at} после {local}")
+
+    def daily_time(self, at, offset=0):
+        # Время ежедневной задачи в поясе пространства, сдвинутое на offset секунд
+        moment = datetime.datetime.combine(datetime.date(2000, 1, 1), at) + datetime.timedelta(seconds=offset)
+        return moment.time().replace(tzinfo=self.timezone)
+
+
+class TenantRegistry:
+
+    def __init__(self, tenants):
+        self._tenants = {tenant.id: tenant for tenant in tenants}
+        self._missing = set()
+        # Админ нескольких пространств управляет первым из них по порядку в конфигурации
+        self._by_admin = {}
+        for tenant in tenants:
+            for admin_id in tenant.admins:
+                self._by_admin.setdefault(admin_id, tenant.id)
+
+    def get(self, tenant_id):
+        return self._tenants.get(tenant_id)
+
+    def resolve(self, tenant_id):
+        # Настройки пространства из данных (tenant пользователя, плана). Пространство могли
+        # убрать из tenants.json, а его пользователи и планы остались - для них берутся
+        # настройки default, чтобы задачи и обработчики не падали на None
+        tenant = self._tenants.get(tenant_id)
+        if tenant is None:
+            if tenant_id not in self._missing:
+                self._missing.add(tenant_id)
+                logger.warning(f"Пространство {tenant_id} не найдено в конфигурации, используются настройки {DEFAULT_TENANT}")
+            tenant = self._tenants[DEFAULT_TENANT]
+        return tenant
+
+    def admin_tenant(self, telegram_id):
+        # id пространства, которым управляет пользователь, или None
+        return self._by_admin.get(telegram_id)
+
+    def __iter__(self):
+        return iter(self._tenants.values())
+
+    def __len__(self):
+        return len(self._tenants)
+
+
+def load_tenants(path, default_admins):
+    # tenants.json: {"<id>": {"name", "admins", "timezone", "notify_at", "match_at", "delivery_window"}}.
+    # Пространство default есть всегда; без файла бот работает как раньше с одной командой
+    config = {}
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as file:
+            config = json.load(file)
+    settings = {'admins': default_admins}
+    settings.update(config.pop(DEFAULT_TENANT, {}))
+    tenants = [Tenant(DEFAULT_TENANT, **settings)]
+    for tenant_id, settings in config.items():
+        tenants.append(Tenant(tenant_id, **settings))
+    logger.info(f"Загружено пространств: {len(tenants)}")
+    return TenantRegistry(tenants)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Модули бота лежат плоско в bot-folder и импортируются по имени, как из boot.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
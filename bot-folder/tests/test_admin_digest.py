@@ -0,0 +1,19 @@
+from admin_digest import AdminDigest
+from storage import SqliteStorage
+
+
+def test_leader_builds_digest_from_changes_of_all_workers(tmp_path):
+    db_path = str(tmp_path / 'coffee.db')
+    worker, leader = AdminDigest(SqliteStorage(db_path)), AdminDigest(SqliteStorage(db_path))
+    worker.record('u1', 'default', was_member=False, is_member=True)
+    leader.record('u2', 'default', was_member=False, is_member=True)
+    # Вошел и вышел за одно окно - чистого изменения нет
+    worker.record('u3', 'default', was_member=False, is_member=True)
+    leader.record('u3', 'default', was_member=True, is_member=False)
+
+    pending = leader.pending()
+    assert list(pending) == ['default']
+    message = leader.build('default', pending['default'], 2, lambda user_uuid: user_uuid)
+    assert 'вступили: 2, вышли: 0' in message
+    assert 'u1' in message and 'u2' in message and 'u3' not in message
+    assert leader.pending() == {} and worker.pending() == {}
@@ -0,0 +1,62 @@
+import asyncio
+
+from cold_storage import ColdStorage, move_to_archive, restore_from_archive
+from cycle_registry import CycleRegistry
+from shared_state import SHARED_DATASETS, SharedState
+from storage import USER_CONTEXT, USER_DATA, USER_MATCHES, SqliteStorage
+from user_repo import UserRepository
+
+PROFILE = {'id': 501, 'email': 'anna@company.com', 'name': 'Аня', 'position': 'Разработчик',
+           'tenant': 'acme', 'last_seen': '2026-01-01'}
+
+
+def open_worker(db_path, on_user_removed=None):
+    storage = SqliteStorage(db_path, track_changes=SHARED_DATASETS)
+    users = UserRepository(storage.load(USER_DATA))
+    registry = CycleRegistry(storage, tenant_of=users.tenant_of)
+    registry.load()
+    shared = SharedState(storage, users, registry, on_user_removed=on_user_removed)
+    return storage, users, registry, shared
+
+
+def test_archive_and_restore_round_trip(tmp_path):
+    storage, users, registry, _ = open_worker(str(tmp_path / 'coffee.db'))
+    cold = ColdStorage(str(tmp_path / 'cold.db'))
+    storage.put(USER_DATA, 'u1', users.upsert('u1', PROFILE))
+    storage.put(USER_MATCHES, 'u1', {'cycle': '2026-01-01', 'partner': 'u2'})
+    asyncio.run(registry.leave('u1', 501))
+
+    telegram_id = move_to_archive(cold, storage, users, registry, 'u1', {'state': 'menu'})
+    assert telegram_id == 501
+    assert 'u1' not in users and storage.get(USER_DATA, 'u1') is None
+    assert storage.get(USER_MATCHES, 'u1') is None
+    assert not registry.is_opted_out('u1')
+    assert cold.count('acme') == 1
+
+    assert restore_from_archive(cold, storage, users, registry, 502) is None
+    user_uuid, user_context = restore_from_archive(cold, storage, users, registry, 501)
+    assert (user_uuid, user_context) == ('u1', {'state': 'menu'})
+    assert users['u1'].to_dict() == PROFILE
+    assert users.find_by_telegram_id(501) == 'u1'
+    assert storage.get(USER_DATA, 'u1') == PROFILE
+    assert storage.get(USER_MATCHES, 'u1') == {'cycle': '2026-01-01', 'partner': 'u2'}
+    assert registry.is_opted_out('u1')
+    assert cold.count() == 0
+    cold.close()
+
+
+def test_archive_on_leader_drops_user_context_on_owning_worker(tmp_path):
+    db_path = str(tmp_path / 'coffee.db')
+    storage, users, registry, _ = open_worker(db_path)
+    storage.put(USER_DATA, 'u1', users.upsert('u1', PROFILE))
+    storage.put(USER_CONTEXT, 501, {'state': 'menu'})
+    dropped = []
+    _, worker_users, _, worker_shared = open_worker(db_path, on_user_removed=dropped.append)
+    assert 'u1' in worker_users
+
+    cold = ColdStorage(str(tmp_path / 'cold.db'))
+    move_to_archive(cold, storage, users, registry, 'u1', storage.get(USER_CONTEXT, 501))
+    worker_shared.sync()
+    assert dropped == [501]
+    assert 'u1' not in worker_users
+    cold.close()
@@ -0,0 +1,104 @@
+import asyncio
+import os
+import sys
+import time
+
+import pytest
+from telegram import Bot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from delivery import DeliveryPipeline, TokenBucket
+from fake_bot_api import FakeBotApi
+
+
+@pytest.fixture
+def api():
+    api = FakeBotApi().start()
+    yield api
+    api.stop()
+
+
+async def _deliver(api, pipeline, messages, on_result=None):
+    bot = Bot('123:test', base_url=api.base_url)
+    await bot.initialize()
+    try:
+        return await pipeline.deliver(bot, messages, on_result)
+    finally:
+        await bot.shutdown()
+
+
+def _messages(count):
+    return [{'key': f'user-{i}', 'chat_id': 1000 + i, 'text': f'Пара #{i}'} for i in range(count)]
+
+
+def test_all_messages_are_sent(api):
+    results = []
+    report = asyncio.run(_deliver(api, DeliveryPipeline(global_rate=100, concurrency=4), _messages(5),
+                                  lambda message, outcome: results.append((message['key'], outcome))))
+    assert report.sent == 5 and not report.failed
+    assert sorted(chat_id for chat_id, _ in api.sent) == [1000, 1001, 1002, 1003, 1004]
+    assert sorted(results) == [(f'user-{i}', 'sent') for i in range(5)]
+
+
+def test_repeated_rate_limit_gives_up(api):
+    # API отвечает 429 на каждую отправку: сообщение не должно крутиться бесконечно
+    api._over_limit = lambda: True
+    results = []
+    report = asyncio.run(asyncio.wait_for(
+        _deliver(api, DeliveryPipeline(global_rate=100, max_retries=1), _messages(1),
+                 lambda message, outcome: results.append(outcome)),
+        timeout=10))
+    assert report.sent == 0
+    assert report.rate_limited == 2
+    assert [key for key, _, _ in report.failed] == ['user-0']
+    assert results == ['failed']
+
+
+class BrokenChatBot:
+    # Настоящий бот поверх фейкового API, который падает с неожиданной ошибкой в одном чате
+    def __init__(self, bot, broken_chat_id):
+        self.bot = bot
+        self.broken_chat_id = broken_chat_id
+
+    async def send_message(self, chat_id, **kwargs):
+        if chat_id == self.broken_chat_id:
+            raise ValueError('сломанное сообщение')
+        return await self.bot.send_message(chat_id=chat_id, **kwargs)
+
+
+def test_unexpected_error_does_not_stop_delivery(api):
+    async def scenario():
+        bot = Bot('123:test', base_url=api.base_url)
+        await bot.initialize()
+        try:
+            pipeline = DeliveryPipeline(global_rate=100, concurrency=1)
+            return await pipeline.deliver(BrokenChatBot(bot, 1001), _messages(3),
+                                          lambda message, outcome: results.__setitem__(message['key'], outcome))
+        finally:
+            await bot.shutdown()
+
+    results = {}
+    report = asyncio.run(scenario())
+    assert report.sent == 2
+    assert [key for key, _, _ in report.failed] == ['user-1']
+    assert results == {'user-0': 'sent', 'user-1': 'failed', 'user-2': 'sent'}
+    assert sorted(chat_id for chat_id, _ in api.sent) == [1000, 1002]
+
+
+def test_token_bucket_burst_and_refill():
+    async def scenario():
+        bucket = TokenBucket(rate=20, capacity=3)
+        started = time.monotonic()
+        # Запас выдается сразу
+        for _ in range(3):
+            await bucket.acquire()
+        burst = time.monotonic() - started
+        # Дальше - со скоростью пополнения, 20 в секунду
+        for _ in range(4):
+            await bucket.acquire()
+        return burst, time.monotonic() - started
+
+    burst, total = asyncio.run(scenario())
+    assert burst < 0.05
+    assert 0.18 <= total < 0.5
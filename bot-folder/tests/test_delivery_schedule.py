@@ -0,0 +1,23 @@
+import datetime
+
+import pytz
+
+from delivery_schedule import schedule
+from tenants import Tenant
+
+
+def test_batches_after_next_match_are_pulled_before_it():
+    # Ручной /match в 20:00 по Минску, плановый подбор в 20:48. Окно получателей в
+    # Лос-Анджелесе (11-14 местного) начинается уже после планового подбора
+    tenant = Tenant('default', timezone='Europe/Minsk', match_at='20:48')
+    now = tenant.timezone.localize(datetime.datetime(2026, 10, 18, 20, 0)).timestamp()
+    deadline = tenant.next_run(tenant.match_at, now) - 240
+    assert deadline - now == 48 * 60 - 240
+
+    window = (datetime.time(11), datetime.time(14))
+    recipients = [(f'user-{i}', pytz.timezone('America/Los_Angeles'), window) for i in range(120)]
+    unbounded = schedule(recipients, now, batch_size=50)
+    assert unbounded[-1][0] > deadline
+    batches = schedule(recipients, now, batch_size=50, deadline=deadline)
+    assert [len(keys) for _, keys in batches] == [50, 50, 20]
+    assert all(now <= at <= deadline for at, _ in batches)
@@ -0,0 +1,48 @@
+import threading
+
+from feedback import FeedbackStore
+from storage import CYCLE_STATS, MATCH_FEEDBACK, SqliteStorage, USER_MATCHES
+
+
+def test_feedback_counts_from_two_workers_are_not_lost(tmp_path):
+    # Два воркера с одной базой SQLite одновременно пишут отзывы разных пользователей
+    db_path = str(tmp_path / 'coffee.db')
+    workers = [FeedbackStore(SqliteStorage(db_path)) for _ in range(2)]
+    workers[0].record_cycle('2026-10-18', [], members=0, registered=0)
+    users = [f'user-{i}' for i in range(200)]
+    for user_uuid in users:
+        workers[0].storage.put(USER_MATCHES, user_uuid, {'cycle': '2026-10-18', 'group': 'g'})
+
+    def rate(store, batch):
+        for user_uuid in batch:
+            store.record(user_uuid, 3)
+
+    threads = [threading.Thread(target=rate, args=(store, users[i::2])) for i, store in enumerate(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = workers[1].storage.get(CYCLE_STATS, '2026-10-18')
+    assert stats['responses'] == len(users)
+    assert stats['ratings']['3'] == len(users)
+
+
+def test_repeated_rating_replaces_previous(tmp_path):
+    store = FeedbackStore(SqliteStorage(str(tmp_path / 'coffee.db')))
+    store.record_cycle('2026-10-18', [('a', 'b')], members=2, registered=2)
+    store.record('a', 1)
+    store.record('a', 3)
+    _, stats = store.stats()
+    assert stats['responses'] == 1
+    assert stats['ratings'] == {'1': 0, '2': 0, '3': 1}
+
+
+def test_feedback_of_previous_meeting_is_dropped_on_new_match(tmp_path):
+    store = FeedbackStore(SqliteStorage(str(tmp_path / 'coffee.db')))
+    store.record_cycle('c1', [('a', 'b')], members=2, registered=2)
+    store.record('a', 2)
+    store.record_cycle('c2', [('a', 'c')], members=2, registered=3)
+    assert store.storage.load(MATCH_FEEDBACK) == {}
+    # Итоги прошлого цикла сохраняются
+    assert store.stats('c1')[1]['ratings']['2'] == 1
@@ -0,0 +1,56 @@
+import os
+
+from journal import ARCHIVE_DIR, JOURNAL_FILE, SNAPSHOT_FILE, JournalStorage
+
+
+def open_journal(directory):
+    # Фоновое уплотнение не мешает тесту: порог и интервал заведомо большие
+    return JournalStorage(str(directory), compact_threshold=10 ** 9, compact_interval=3600)
+
+
+def test_replay_after_crash(tmp_path):
+    storage = open_journal(tmp_path)
+    storage.put('user_data', 'a', {'id': 1, 'email': 'a@b.c', 'name': 'A', 'position': 'dev'})
+    storage.put('cycle_users', 'a', 100)
+    storage.put('cycle_users', 'b', 200)
+    storage.delete('cycle_users', 'b')
+    storage.put('user_data', 'a', {'id': 1, 'email': 'a@b.c', 'name': 'A', 'position': 'qa'})
+    # Без close(): процесс "упал", состояние восстанавливается только из журнала
+
+    restored = open_journal(tmp_path)
+    assert restored.load('cycle_users') == {'a': 100}
+    assert restored.get('user_data', 'a')['position'] == 'qa'
+    restored.close()
+
+
+def test_compaction_folds_journal_into_snapshot(tmp_path):
+    storage = open_journal(tmp_path)
+    for i in range(50):
+        storage.put('cycle_users', f'user-{i}', i)
+    storage.compact()
+
+    # Журнал уплотнен: сегмент ушел в архив, текущий журнал пуст
+    assert os.path.exists(tmp_path / SNAPSHOT_FILE)
+    assert os.path.getsize(tmp_path / JOURNAL_FILE) == 0
+    assert os.listdir(tmp_path / ARCHIVE_DIR)
+
+    # Изменения после уплотнения проигрываются поверх снимка
+    storage.delete('cycle_users', 'user-0')
+    storage.put('cycle_users', 'user-50', 50)
+
+    restored = open_journal(tmp_path)
+    data = restored.load('cycle_users')
+    assert len(data) == 50
+    assert 'user-0' not in data and data['user-50'] == 50
+    restored.close()
+    storage.close()
+
+
+def test_replace_survives_restart(tmp_path):
+    storage = open_journal(tmp_path)
+    storage.put('cycle_users', 'old', 1)
+    storage.replace('cycle_users', {'new': 2})
+
+    restored = open_journal(tmp_path)
+    assert restored.load('cycle_users') == {'new': 2}
+    restored.close()
@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from leader import LeaderElection, RunLedger, run_once
+
+
+def test_one_of_two_contenders_leads_and_renews(tmp_path):
+    path = str(tmp_path / 'lease.db')
+    first = LeaderElection(path, ttl=30, owner='a')
+    second = LeaderElection(path, ttl=30, owner='b')
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.is_leader() and not second.is_leader()
+    # Продление своей аренды
+    assert first.acquire()
+    assert not second.acquire()
+
+
+def test_expired_lease_is_taken_over(tmp_path):
+    path = str(tmp_path / 'lease.db')
+    first = LeaderElection(path, ttl=0.2, owner='a')
+    second = LeaderElection(path, ttl=0.2, owner='b')
+    assert first.acquire()
+    assert not second.acquire()
+    # Лидер перестал продлевать аренду
+    time.sleep(0.25)
+    assert not first.is_leader()
+    assert second.acquire()
+    assert not first.acquire()
+
+
+def test_released_lease_is_taken_at_once(tmp_path):
+    path = str(tmp_path / 'lease.db')
+    first = LeaderElection(path, ttl=30, owner='a')
+    second = LeaderElection(path, ttl=30, owner='b')
+    assert first.acquire()
+    first.release()
+    assert second.acquire()
+
+
+def test_job_runs_once_per_cycle_across_replicas(tmp_path):
+    path = str(tmp_path / 'lease.db')
+    runs = []
+
+    async def job():
+        runs.append(1)
+
+    async def scenario():
+        first = LeaderElection(path, ttl=0.3, owner='a')
+        second = LeaderElection(path, ttl=0.3, owner='b')
+        ledger_first, ledger_second = RunLedger(path), RunLedger(path)
+        assert await run_once(first, ledger_first, 'run_match', '2026-10-18', job, wait=0.6)
+        # Вторая реплика видит запуск в журнале и не ждет аренды
+        assert not await run_once(second, ledger_second, 'run_match', '2026-10-18', job, wait=0.6)
+        # Лидер упал: следующий цикл после истечения аренды выполняет вторая реплика
+        assert await run_once(second, ledger_second, 'run_match', '2026-10-19', job, wait=0.6)
+        owner, started_at, finished_at = ledger_first.get('run_match', '2026-10-19')
+        assert owner == 'b' and finished_at >= started_at
+
+    asyncio.run(scenario())
+    assert len(runs) == 2
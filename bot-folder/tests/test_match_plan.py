@@ -0,0 +1,83 @@
+import asyncio
+import time
+
+from match_plan import MatchPlanStore
+from storage import DELIVERIES, SqliteStorage
+from write_behind import WriteBehindStorage
+
+
+def open_storage(path):
+    return WriteBehindStorage(SqliteStorage(str(path)), interval=3600)
+
+
+def make_messages(count):
+    return [{'key': f'user-{i}', 'chat_id': 1000 + i, 'text': 'пара', 'keyboard': True} for i in range(count)]
+
+
+def test_delivery_resumes_from_ledger_after_restart(tmp_path):
+    db_path = tmp_path / 'coffee.db'
+    storage = open_storage(db_path)
+    plans = MatchPlanStore(storage)
+    messages = make_messages(6)
+    asyncio.run(plans.create('2026-10-18', [('user-0', 'user-1')], [], messages))
+
+    due, released = plans.due('2026-10-18', time.time())
+    assert [message['key'] for message in due] == [message['key'] for message in messages]
+    # Успели отправить половину, и процесс упал - finish_pass не вызывался
+    for message in due[:3]:
+        plans.mark('2026-10-18', message['key'], 'sent')
+    storage.close()
+
+    storage = open_storage(db_path)
+    plans = MatchPlanStore(storage)
+    assert plans.active() == '2026-10-18'
+    due, released = plans.due('2026-10-18', time.time())
+    assert [message['key'] for message in due] == ['user-3', 'user-4', 'user-5']
+    assert due[0]['chat_id'] == 1003 and due[0]['keyboard'] is True
+
+    for message in due:
+        plans.mark('2026-10-18', message['key'], 'sent')
+    assert plans.finish_pass('2026-10-18', released, due) == 0
+    assert plans.active() is None
+    # От завершенного плана остаются итоги, журнал доставки удален
+    assert plans.counts('2026-10-18') == {'sent': 6, 'rejected': 0, 'failed': 0, 'pending': 0}
+    assert plans.get('2026-10-18')['summary']['recipients'] == 6
+    storage.flush()
+    assert storage.backend.load(DELIVERIES) == {}
+    storage.close()
+
+
+def test_temporary_failures_are_retried_then_given_up(tmp_path):
+    storage = open_storage(tmp_path / 'coffee.db')
+    plans = MatchPlanStore(storage)
+    asyncio.run(plans.create('c1', [], [], make_messages(2)))
+
+    for attempt in range(3):
+        due, released = plans.due('c1', time.time())
+        assert [message['key'] for message in due] == (['user-0', 'user-1'] if attempt == 0 else ['user-1'])
+        for message in due:
+            plans.mark('c1', message['key'], 'sent' if message['key'] == 'user-0' else 'error')
+        remaining = plans.finish_pass('c1', released, due)
+    # После MAX_ATTEMPTS временных ошибок сообщение отмечается failed и план закрывается
+    assert remaining == 0
+    assert plans.active() is None
+    storage.close()
+
+
+def test_deferred_batches_are_released_on_time(tmp_path):
+    storage = open_storage(tmp_path / 'coffee.db')
+    plans = MatchPlanStore(storage)
+    now = time.time()
+    messages = make_messages(4)
+    asyncio.run(plans.create('c1', [], [], messages, batches=[[now, ['user-0', 'user-1']], [now + 3600, ['user-2', 'user-3']]]))
+
+    due, released = plans.due('c1', now)
+    assert [message['key'] for message in due] == ['user-0', 'user-1']
+    for message in due:
+        plans.mark('c1', message['key'], 'sent')
+    assert plans.finish_pass('c1', released, due) == 2
+    assert plans.next_batch('c1') == now + 3600
+
+    due, released = plans.due('c1', now + 3600)
+    assert [message['key'] for message in due] == ['user-2', 'user-3']
+    storage.close()
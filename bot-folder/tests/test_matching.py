@@ -0,0 +1,46 @@
+from matching import MatchingEngine, PairHistory
+
+
+def users(count):
+    return [f'user-{i}' for i in range(count)]
+
+
+def pairs_of(group):
+    return [(group[i], group[j]) for i in range(len(group)) for j in range(i + 1, len(group))]
+
+
+def test_no_repeated_pairs_across_rounds():
+    history = PairHistory()
+    participants = users(16)
+    for round_number in range(5):
+        result = MatchingEngine(history, seed=round_number).match(participants)
+        assert result.repeats == 0
+        for group in result.groups:
+            for a, b in pairs_of(group):
+                assert history.count(a, b) == 0, f"повтор {a}-{b} в раунде {round_number}"
+        for group in result.groups:
+            for a, b in pairs_of(group):
+                history.add(a, b)
+
+
+def test_odd_count_makes_one_triad():
+    result = MatchingEngine(PairHistory(), seed=1).match(users(7))
+    sizes = sorted(len(group) for group in result.groups)
+    assert sizes == [2, 2, 3]
+    assert result.leftover == []
+    assert result.used == set(users(7))
+
+
+def test_same_seed_same_result():
+    history = PairHistory({'user-0|user-1': 1, 'user-2|user-3': 2})
+    first = MatchingEngine(history, seed=42).match(users(11))
+    second = MatchingEngine(history, seed=42).match(users(11))
+    assert first.groups == second.groups
+
+
+def test_history_is_respected_when_avoidable():
+    # Все соседи по списку уже встречались, но обойтись без повторов можно
+    participants = users(10)
+    history = PairHistory({f'{participants[i]}|{participants[i + 1]}': 1 for i in range(0, 10, 2)})
+    for seed in range(20):
+        assert MatchingEngine(history, seed=seed).match(participants).repeats == 0
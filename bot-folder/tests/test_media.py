@@ -0,0 +1,40 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from media import MediaRegistry
+from storage import SqliteStorage
+
+
+class PhotoBot:
+    # Бот, который запоминает, что ему передали: файл или file_id
+    id = 123
+
+    def __init__(self):
+        self.sent = []
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent.append(photo if isinstance(photo, str) else 'upload')
+        return SimpleNamespace(effective_attachment=[SimpleNamespace(file_id='small'),
+                                                     SimpleNamespace(file_id='original')])
+
+
+def test_missing_file_fails_at_startup(tmp_path):
+    media = MediaRegistry(SqliteStorage(str(tmp_path / 'coffee.db')), directory=str(tmp_path))
+    with pytest.raises(FileNotFoundError):
+        media.check()
+
+
+def test_file_is_uploaded_once(tmp_path):
+    (tmp_path / 'registration.png').write_bytes(b'\x89PNG\r\n\x1a\n')
+    media = MediaRegistry(SqliteStorage(str(tmp_path / 'coffee.db')), directory=str(tmp_path))
+    media.check()
+    bot = PhotoBot()
+
+    async def scenario():
+        await asyncio.gather(*(media.send(bot, 'registration', chat_id) for chat_id in range(3)))
+        await media.send(bot, 'registration', 4)
+
+    asyncio.run(scenario())
+    assert bot.sent == ['upload', 'original', 'original', 'original']
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+
+from persistence import StoragePersistence
+from storage import USER_CONTEXT, create_storage
+from write_behind import WriteBehindStorage
+
+
+def open_storage(backend, tmp_path):
+    if backend == 'write_behind':
+        return WriteBehindStorage(create_storage('sqlite', db_path=str(tmp_path / 'coffee.db')), interval=60)
+    return create_storage(backend, directory=str(tmp_path), db_path=str(tmp_path / 'coffee.db'))
+
+
+@pytest.mark.parametrize('backend', ['json', 'sqlite', 'write_behind'])
+def test_conversations_and_user_data_survive_restart(tmp_path, backend):
+    async def before_restart():
+        storage = open_storage(backend, tmp_path)
+        persistence = StoragePersistence(storage)
+        await persistence.update_conversation('registration', (100, 100), 2)
+        await persistence.update_conversation('registration', (200, 200), 1)
+        await persistence.update_conversation('feedback', (100, 100), 0)
+        # Завершенный диалог из хранилища удаляется
+        await persistence.update_conversation('registration', (200, 200), None)
+        await persistence.update_user_data(100, {'email': 'anna@company.com', 'page': [1, 2]})
+        await persistence.update_user_data(200, {'email': 'boris@company.com'})
+        await persistence.drop_user_data(200)
+        await persistence.flush()
+        storage.close()
+
+    async def after_restart():
+        storage = open_storage(backend, tmp_path)
+        persistence = StoragePersistence(storage)
+        conversations = await persistence.get_conversations('registration')
+        user_100, user_200 = {}, {}
+        await persistence.refresh_user_data(100, user_100)
+        await persistence.refresh_user_data(200, user_200)
+        feedback = await persistence.get_conversations('feedback')
+        storage.close()
+        return conversations, feedback, user_100, user_200
+
+    asyncio.run(before_restart())
+    conversations, feedback, user_100, user_200 = asyncio.run(after_restart())
+    assert conversations == {(100, 100): 2}
+    assert feedback == {(100, 100): 0}
+    assert user_100 == {'email': 'anna@company.com', 'page': [1, 2]}
+    assert user_200 == {}
+
+
+def test_user_data_is_read_once_and_not_over_fresh_data(tmp_path):
+    async def scenario():
+        storage = open_storage('sqlite', tmp_path)
+        await StoragePersistence(storage).update_user_data(100, {'state': 'stored'})
+        persistence = StoragePersistence(storage)
+        # PTB уже заполнил context.user_data в этом процессе - хранилище его не перетирает
+        fresh = {'state': 'fresh'}
+        await persistence.refresh_user_data(100, fresh)
+        # Повторные апдейты не читают хранилище заново
+        storage.put(USER_CONTEXT, 100, {'state': 'changed elsewhere'})
+        cleared = {}
+        await persistence.refresh_user_data(100, cleared)
+        storage.close()
+        return fresh, cleared
+
+    fresh, cleared = asyncio.run(scenario())
+    assert fresh == {'state': 'fresh'}
+    assert cleared == {}
@@ -0,0 +1,59 @@
+from roster import MESSAGE_LIMIT, render_page
+from user_repo import UserRepository
+
+
+def make_repo(count, tenant=None):
+    users = {}
+    for i in range(count):
+        users[f'user-{i:03}'] = {'id': i, 'email': f'user{i}@company.com', 'name': f'Имя {i}', 'position': 'dev'}
+        if tenant:
+            users[f'user-{i:03}']['tenant'] = tenant
+    return UserRepository(users)
+
+
+def test_oversized_first_card_is_truncated_not_dropped():
+    repo = make_repo(3)
+    repo.update('user-000', name='x' * 4096, position='y' * 4096)
+    items, _ = repo.page(0, 20)
+    text, shown = render_page(items, 1, None)
+    assert shown >= 1
+    assert len(text) <= MESSAGE_LIMIT
+
+
+def test_paging_moves_forward_past_long_cards():
+    repo = make_repo(5)
+    for i in range(5):
+        repo.update(f'user-{i:03}', name='x' * 4096)
+    seen = []
+    cursor = 0
+    while cursor is not None:
+        items, next_cursor = repo.page(cursor, 20)
+        text, shown = render_page(items, 1, None)
+        assert shown >= 1
+        seen.extend(user_uuid for user_uuid, _ in items[:shown])
+        if shown < len(items):
+            next_cursor = repo.cursor_of(items[shown][0])
+        assert next_cursor is None or next_cursor > cursor
+        cursor = next_cursor
+    assert seen == [f'user-{i:03}' for i in range(5)]
+
+
+def test_cursors_survive_compaction():
+    repo = make_repo(100)
+    first, cursor = repo.page(0, 10)
+    assert cursor is not None
+    # Удаляем больше половины - порядок уплотняется, курсор открытой страницы остается верным
+    for i in range(60):
+        if i >= 10:
+            repo.delete(f'user-{i:03}')
+    items, _ = repo.page(cursor, 10)
+    assert [user_uuid for user_uuid, _ in items] == [f'user-{i:03}' for i in range(60, 70)]
+
+
+def test_tenant_cursors_survive_compaction():
+    repo = make_repo(30, tenant='t1')
+    _, cursor = repo.page(0, 5, tenant='t1')
+    for i in range(5, 25):
+        repo.delete(f'user-{i:03}')
+    items, _ = repo.page(cursor, 5, tenant='t1')
+    assert [user_uuid for user_uuid, _ in items] == [f'user-{i:03}' for i in range(25, 30)]
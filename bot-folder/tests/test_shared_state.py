@@ -0,0 +1,29 @@
+from cycle_registry import CycleRegistry
+from matching import PairHistory, pair_key
+from shared_state import SHARED_DATASETS, SharedState
+from storage import PAIR_HISTORY, SqliteStorage, update_row
+from user_repo import UserRepository
+
+
+def open_worker(db_path):
+    storage = SqliteStorage(db_path, track_changes=SHARED_DATASETS)
+    history = PairHistory(storage.load(PAIR_HISTORY))
+    users = UserRepository()
+    shared = SharedState(storage, users, CycleRegistry(storage, tenant_of=users.tenant_of), pair_history=history)
+    return storage, history, shared
+
+
+def test_pair_history_from_other_worker_is_synced(tmp_path):
+    db_path = str(tmp_path / 'coffee.db')
+    storage_a, history_a, _ = open_worker(db_path)
+    storage_b, history_b, shared_b = open_worker(db_path)
+
+    # Воркер A записал встречу; B до синхронизации ее не видит
+    history_a.set('u1', 'u2', update_row(storage_a, PAIR_HISTORY, pair_key('u1', 'u2'), lambda n: (n or 0) + 1))
+    assert history_b.count('u1', 'u2') == 0
+    shared_b.sync()
+    assert history_b.count('u1', 'u2') == 1
+
+    # Следующая встреча той же пары на B считается от значения в базе, а не от своей копии
+    count = update_row(storage_b, PAIR_HISTORY, pair_key('u2', 'u1'), lambda n: (n or 0) + 1)
+    assert count == 2
@@ -0,0 +1,51 @@
+import os
+
+from snapshot import MAGIC, read_snapshot, storage_fingerprint, write_snapshot
+from storage import USER_DATA, SqliteStorage
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'coffee.snapshot')
+    datasets = {USER_DATA: {'u1': {'id': 501, 'name': 'Аня'}}, 'cycle_users': {'u1': 501}}
+    write_snapshot(path, datasets, {'coffee.db': [1, 2]})
+    assert read_snapshot(path, {'coffee.db': [1, 2]}) == datasets
+
+
+def test_snapshot_is_ignored_after_storage_changed(tmp_path):
+    db_path = str(tmp_path / 'coffee.db')
+    path = str(tmp_path / 'coffee.snapshot')
+    storage = SqliteStorage(db_path)
+    storage.put(USER_DATA, 'u1', {'id': 501})
+    storage.close()
+    fingerprint = storage_fingerprint('sqlite', db_path=db_path)
+    write_snapshot(path, {USER_DATA: {'u1': {'id': 501}}}, fingerprint)
+    assert read_snapshot(path, storage_fingerprint('sqlite', db_path=db_path)) is not None
+
+    # Другой процесс записал в базу после снимка
+    storage = SqliteStorage(db_path)
+    storage.put(USER_DATA, 'u2', {'id': 502})
+    storage.close()
+    assert storage_fingerprint('sqlite', db_path=db_path) != fingerprint
+    assert read_snapshot(path, storage_fingerprint('sqlite', db_path=db_path)) is None
+
+
+def test_json_fingerprint_tracks_each_file(tmp_path):
+    before = storage_fingerprint('json', directory=str(tmp_path))
+    with open(tmp_path / 'user_data.json', 'w', encoding='utf-8') as file:
+        file.write('{}')
+    after = storage_fingerprint('json', directory=str(tmp_path))
+    assert before['user_data'] is None and after['user_data'] is not None
+    assert before['cycle_users'] == after['cycle_users']
+    assert storage_fingerprint('journal') is None
+
+
+def test_broken_or_foreign_snapshot_is_ignored(tmp_path):
+    path = str(tmp_path / 'coffee.snapshot')
+    assert read_snapshot(path, {}) is None
+    with open(path, 'wb') as file:
+        file.write(b'not a snapshot')
+    assert read_snapshot(path, {}) is None
+    with open(path, 'wb') as file:
+        file.write(MAGIC + b'\x00\x01' + b'\xff\xff')
+    assert read_snapshot(path, {}) is None
+    assert not os.path.exists(f'{path}.tmp')
@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from storage import CYCLE_USERS, MATCH_FEEDBACK, USER_DATA, SqliteStorage, migrate_json_to_sqlite
+
+
+def _write_json(directory, dataset, data):
+    with open(directory / f'{dataset}.json', 'w', encoding='utf-8') as file:
+        json.dump(data, file)
+
+
+def test_migration_keeps_tables_without_json_file(tmp_path):
+    db_path = str(tmp_path / 'coffee.db')
+    storage = SqliteStorage(db_path)
+    storage.put(MATCH_FEEDBACK, 'u1', {'rating': 5})
+    storage.close()
+    _write_json(tmp_path, USER_DATA, {'u1': {'name': 'Аня'}})
+
+    migrate_json_to_sqlite(str(tmp_path), db_path)
+
+    storage = SqliteStorage(db_path)
+    assert storage.load(USER_DATA) == {'u1': {'name': 'Аня'}}
+    assert storage.load(MATCH_FEEDBACK) == {'u1': {'rating': 5}}
+    assert storage.load(CYCLE_USERS) == {}
+    storage.close()
+
+
+def test_migration_refuses_to_overwrite_without_force(tmp_path):
+    db_path = str(tmp_path / 'coffee.db')
+    storage = SqliteStorage(db_path)
+    storage.put(USER_DATA, 'u1', {'name': 'Аня'})
+    storage.close()
+    _write_json(tmp_path, USER_DATA, {'u2': {'name': 'Боря'}})
+
+    with pytest.raises(RuntimeError):
+        migrate_json_to_sqlite(str(tmp_path), db_path)
+    storage = SqliteStorage(db_path)
+    assert storage.load(USER_DATA) == {'u1': {'name': 'Аня'}}
+    storage.close()
+
+    migrate_json_to_sqlite(str(tmp_path), db_path, force=True)
+    storage = SqliteStorage(db_path)
+    assert storage.load(USER_DATA) == {'u2': {'name': 'Боря'}}
+    storage.close()
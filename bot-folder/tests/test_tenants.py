@@ -0,0 +1,10 @@
+from tenants import Tenant, TenantRegistry
+
+
+def test_removed_tenant_falls_back_to_default():
+    registry = TenantRegistry([Tenant('default'), Tenant('minsk', timezone='Europe/Minsk')])
+    assert registry.resolve('minsk').id == 'minsk'
+    # Пространство убрали из конфигурации, а его пользователи остались
+    assert registry.get('gone') is None
+    assert registry.resolve('gone').id == 'default'
+    assert registry.resolve('gone').today()
@@ -0,0 +1,34 @@
+from throttle import UserThrottle
+
+
+def test_burst_is_dropped_and_refilled():
+    throttle = UserThrottle(rate=2.0, burst=3)
+    assert [throttle.allow(1, now=0.0) for _ in range(5)] == [True, True, True, False, False]
+    # Другой пользователь не делит ведро с первым
+    assert throttle.allow(2, now=0.0)
+    # За полсекунды при скорости 2 в секунду набирается один токен
+    assert throttle.allow(1, now=0.5)
+    assert not throttle.allow(1, now=0.5)
+    # За долгий простой ведро наполняется не выше burst
+    assert [throttle.allow(1, now=100.0) for _ in range(4)] == [True, True, True, False]
+
+
+def test_repeated_callback_is_duplicate():
+    throttle = UserThrottle(dedup_window=2.0)
+    key = ('join_cycle', 10)
+    assert not throttle.is_duplicate(1, key, now=0.0)
+    assert throttle.is_duplicate(1, key, now=0.5)
+    assert not throttle.is_duplicate(2, key, now=0.5)
+    # После окна то же нажатие снова проходит
+    assert not throttle.is_duplicate(1, key, now=10.0)
+
+
+def test_paging_through_the_same_message_is_not_duplicate():
+    # show_users_page правит одно и то же сообщение, номер страницы в данных кнопки
+    # отличает нажатие "Вперед" на первой странице от нажатия на второй
+    throttle = UserThrottle(dedup_window=2.0)
+    assert not throttle.is_duplicate(1, ('users_next:1', 10), now=0.0)
+    assert not throttle.is_duplicate(1, ('users_next:2', 10), now=0.3)
+    assert not throttle.is_duplicate(1, ('users_prev:3', 10), now=0.6)
+    # Двойное нажатие одной кнопки по-прежнему отсеивается
+    assert throttle.is_duplicate(1, ('users_prev:3', 10), now=0.7)
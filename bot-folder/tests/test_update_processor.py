@@ -0,0 +1,46 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+from update_processor import PerUserUpdateProcessor
+
+
+def make_update(user_id):
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=None)
+
+
+async def handler(log, name, seconds):
+    log.append(('start', name, time.perf_counter()))
+    await asyncio.sleep(seconds)
+    log.append(('end', name, time.perf_counter()))
+
+
+def test_user_backlog_does_not_delay_others():
+    # Восемь апдейтов пользователя A по 0.1 с и четыре слота: B не должен ждать очередь A
+    async def run():
+        processor = PerUserUpdateProcessor(4)
+        log = []
+        started = time.perf_counter()
+        tasks = [asyncio.create_task(processor.process_update(make_update(1), handler(log, f'a{i}', 0.1)))
+                 for i in range(8)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(make_update(2), handler(log, 'b', 0.1))))
+        await asyncio.gather(*tasks)
+        return log, started
+
+    log, started = asyncio.run(run())
+    b_start = next(at for event, name, at in log if event == 'start' and name == 'b')
+    assert b_start - started < 0.05
+
+
+def test_updates_of_one_user_run_in_order():
+    async def run():
+        processor = PerUserUpdateProcessor(4)
+        log = []
+        await asyncio.gather(*(processor.process_update(make_update(1), handler(log, f'a{i}', 0.01))
+                               for i in range(5)))
+        return log
+
+    log = asyncio.run(run())
+    assert [name for _, name, _ in log] == [name for i in range(5) for name in (f'a{i}', f'a{i}')]
+    assert [event for event, _, _ in log] == ['start', 'end'] * 5
@@ -0,0 +1,18 @@
+from user_repo import UserRecord, UserRepository, records_in_place
+
+
+def test_from_dict_matches_constructor_and_keeps_unknown_keys():
+    info = {'id': 1, 'email': 'anna@company.com', 'name': 'Анна', 'position': 'HR',
+            'tenant': 'minsk', 'last_seen': '2026-10-01', 'badge': 'gold'}
+    record = UserRecord.from_dict(info)
+    assert record == UserRecord(**info)
+    assert record.to_dict() == info
+    assert UserRecord.from_dict({'id': 2, 'email': 'без домена'}).email == 'без домена'
+
+
+def test_records_in_place_feeds_repository():
+    rows = {'u1': {'id': 1, 'email': 'a@company.com', 'name': 'А', 'position': 'HR'}}
+    records = records_in_place(rows)
+    assert records is rows and isinstance(rows['u1'], UserRecord)
+    users = UserRepository(rows)
+    assert users.find_by_email('A@company.com') == 'u1'
@@ -0,0 +1,85 @@
+import pytest
+
+from write_behind import WriteBehindStorage
+
+
+class RecordingBackend:
+    # Построчное хранилище в памяти; fail - сколько следующих записей завершатся ошибкой
+    whole_file = False
+
+    def __init__(self, data=None):
+        self.data = {dataset: dict(rows) for dataset, rows in (data or {}).items()}
+        self.writes = []
+        self.fail = 0
+
+    def load(self, dataset):
+        return dict(self.data.get(dataset, {}))
+
+    def get(self, dataset, key, default=None):
+        return self.data.get(dataset, {}).get(key, default)
+
+    def write_changes(self, dataset, upserts, deletes, snapshot=None):
+        if self.fail:
+            self.fail -= 1
+            raise OSError("диск недоступен")
+        self.writes.append((dataset, dict(upserts), list(deletes)))
+        rows = self.data.setdefault(dataset, {})
+        rows.update(upserts)
+        for key in deletes:
+            rows.pop(key, None)
+
+    def replace(self, dataset, data):
+        self.writes.append((dataset, 'replace'))
+        self.data[dataset] = dict(data)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def storage():
+    backend = RecordingBackend({'cycle_users': {'a': 1}})
+    # Интервал большой - сбрасываем вручную через flush()
+    storage = WriteBehindStorage(backend, interval=3600)
+    yield storage
+    storage.close()
+
+
+def test_writes_between_flushes_are_coalesced(storage):
+    for value in range(5):
+        storage.put('cycle_users', 'b', value)
+    storage.put('cycle_users', 'c', 1)
+    storage.delete('cycle_users', 'c')
+    storage.flush()
+
+    backend = storage.backend
+    assert backend.writes == [('cycle_users', {'b': 4}, ['c'])]
+    assert storage.stats.coalesced == 6
+    assert backend.data['cycle_users'] == {'a': 1, 'b': 4}
+
+
+def test_failed_flush_is_retried(storage):
+    backend = storage.backend
+    backend.fail = 1
+    storage.put('cycle_users', 'b', 2)
+    storage.flush()
+    assert storage.stats.errors == 1
+    assert 'b' not in backend.data['cycle_users']
+    # Чтение видит несохраненное значение
+    assert storage.get('cycle_users', 'b') == 2
+
+    storage.put('cycle_users', 'c', 3)
+    storage.flush()
+    assert backend.data['cycle_users'] == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_unloaded_dataset_keeps_rows_after_failure():
+    backend = RecordingBackend()
+    storage = WriteBehindStorage(backend, interval=3600)
+    backend.fail = 1
+    storage.put('deliveries', 'x', {'status': 'pending'})
+    storage.flush()
+    storage.put('deliveries', 'y', {'status': 'sent'})
+    storage.flush()
+    storage.close()
+    assert backend.data['deliveries'] == {'x': {'status': 'pending'}, 'y': {'status': 'sent'}}
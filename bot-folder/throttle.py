@@ -0,0 +1,45 @@
+import time
+
+
+class UserThrottle:
+    # Ограничение частоты апдейтов от одного пользователя: token bucket на пользователя
+    # (rate в секунду, запас burst) и отсев одинаковых callback-запросов в пределах
+    # dedup_window секунд - повторные нажатия и повторы от клиента
+
+    def __init__(self, rate=2.0, burst=5, dedup_window=2.0, max_users=10000):
+        self.rate = rate
+        self.burst = burst
+        self.dedup_window = dedup_window
+        self.max_users = max_users
+        # user_id -> [токены, время обновления]
+        self._buckets = {}
+        # user_id -> (последний callback, время)
+        self._recent = {}
+
+    def allow(self, user_id, now=None):
+        now = time.monotonic() if now is None else now
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) >= self.max_users:
+                self._prune(now)
+            bucket = self._buckets[user_id] = [self.burst, now]
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def is_duplicate(self, user_id, key, now=None):
+        now = time.monotonic() if now is None else now
+        previous = self._recent.get(user_id)
+        self._recent[user_id] = (key, now)
+        return previous is not None and previous[0] == key and now - previous[1] < self.dedup_window
+
+    def _prune(self, now):
+        # Ведро, которое успело наполниться, ничем не отличается от нового - его можно забыть
+        idle = self.burst / self.rate
+        self._buckets = {user_id: bucket for user_id, bucket in self._buckets.items() if now - bucket[1] < idle}
+        self._recent = {user_id: recent for user_id, recent in self._recent.items()
+                        if now - recent[1] < self.dedup_window}
@@ -0,0 +1,74 @@
+import asyncio
+import contextlib
+import time
+
+from telegram.ext import BaseUpdateProcessor
+
+
+# Лимит для семафора PTB: ограничивает сам процессор, после очереди пользователя
+UNLIMITED_UPDATES = 2 ** 30
+
+
+def update_owner(update):
+    # Ключ упорядочивания: пользователь, а если его нет - чат
+    user = getattr(update, 'effective_user', None)
+    if user is not None:
+        return user.id
+    chat = getattr(update, 'effective_chat', None)
+    return chat.id if chat is not None else None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных пользователей обрабатываются параллельно (не больше max_concurrent_updates),
+    # апдейты одного пользователя - строго по очереди, чтобы состояния ConversationHandler не путались.
+    # Семафор PTB занимается до do_process_update, то есть до очереди пользователя: пачка апдейтов
+    # одного пользователя заняла бы все его слоты, ожидая друг друга. Поэтому PTB получает
+    # лимит без ограничения, а свой семафор апдейт берет, когда подошла его очередь.
+    # tracer (profiling.py) - трасса на каждый апдейт, если трассировка включена
+
+    def __init__(self, max_concurrent_updates, tracer=None):
+        super().__init__(UNLIMITED_UPDATES)
+        if max_concurrent_updates < 1:
+            raise ValueError("max_concurrent_updates должен быть положительным")
+        self.tracer = tracer
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+        self._waiters = {}
+
+    async def do_process_update(self, update, coroutine):
+        trace = self.tracer.begin(update) if self.tracer else None
+        try:
+            async with self._turn(update_owner(update), trace):
+                async with self._slots:
+                    await coroutine
+        finally:
+            if trace:
+                self.tracer.finish(trace)
+
+    @contextlib.asynccontextmanager
+    async def _turn(self, owner, trace):
+        if owner is None:
+            yield
+            return
+
+        lock = self._locks.get(owner)
+        if lock is None:
+            lock = self._locks[owner] = asyncio.Lock()
+        self._waiters[owner] = self._waiters.get(owner, 0) + 1
+        try:
+            started = time.perf_counter()
+            async with lock:
+                if trace:
+                    self.tracer.record('user_queue_wait', time.perf_counter() - started)
+                yield
+        finally:
+            self._waiters[owner] -= 1
+            if not self._waiters[owner]:
+                del self._waiters[owner]
+                del self._locks[owner]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
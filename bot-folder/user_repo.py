@@ -0,0 +1,342 @@
+import bisect
+import copy
+import logging
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+# Пространство (tenant), к которому относятся пользователи без поля tenant
+DEFAULT_TENANT = 'default'
+
+
+def normalize_email(email):
+    return (email or '').strip().lower()
+
+
+def tenant_of_info(info):
+    return info.tenant or DEFAULT_TENANT
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class UserRecord:
+    # Профиль пользователя без словаря на каждый объект: поля в __slots__, повторяющиеся
+    # строки (должность, домен почты, пространство, пояс, даты) интернированы и у тысяч
+    # пользователей ссылаются на один экземпляр. На диске профиль - прежний словарь:
+    # from_dict/to_dict, незнакомые ключи переживают цикл чтения-записи в extra
+    __slots__ = ('id', 'email_local', 'email_domain', 'name', 'position', 'tenant', 'timezone', 'window',
+                 'last_seen', 'last_cycle', 'extra')
+
+    # Необязательные поля профиля: None - ключа в словаре нет
+    OPTIONAL = ('tenant', 'timezone', 'window', 'last_seen', 'last_cycle')
+    INTERNED = ('position', 'tenant', 'timezone', 'window', 'last_seen', 'last_cycle')
+    KNOWN = frozenset(('id', 'email', 'name', 'position') + OPTIONAL)
+
+    def __init__(self, id=None, email='', name='', position='', **optional):
+        self.id = id
+        self.email = email
+        self.name = name
+        self.position = _intern(position)
+        self.extra = None
+        for key in self.OPTIONAL:
+            setattr(self, key, _intern(optional.pop(key, None)))
+        if optional:
+            self.extra = optional
+
+    @property
+    def email(self):
+        if self.email_domain is None:
+            return self.email_local
+        return f"{self.email_local}@{self.email_domain}"
+
+    @email.setter
+    def email(self, value):
+        local, at, domain = (value or '').rpartition('@')
+        if at:
+            self.email_local = local
+            self.email_domain = sys.intern(domain)
+        else:
+            self.email_local = value
+            self.email_domain = None
+
+    @classmethod
+    def from_dict(cls, info):
+        # Загрузка - самый частый путь (все профили при старте), поэтому поля заполняются
+        # напрямую, без **kwargs и setattr по списку, как в __init__
+        record = cls.__new__(cls)
+        get = info.get
+        record.id = get('id')
+        email = get('email') or ''
+        local, at, domain = email.rpartition('@')
+        if at:
+            record.email_local = local
+            record.email_domain = sys.intern(domain)
+        else:
+            record.email_local = email
+            record.email_domain = None
+        record.name = get('name', '')
+        record.position = _intern(get('position', ''))
+        record.tenant = _intern(get('tenant'))
+        record.timezone = _intern(get('timezone'))
+        record.window = _intern(get('window'))
+        record.last_seen = _intern(get('last_seen'))
+        record.last_cycle = _intern(get('last_cycle'))
+        record.extra = None
+        if not info.keys() <= cls.KNOWN:
+            record.extra = {key: value for key, value in info.items() if key not in cls.KNOWN}
+        return record
+
+    def to_dict(self):
+        info = {'id': self.id, 'email': self.email, 'name': self.name, 'position': self.position}
+        for key in self.OPTIONAL:
+            value = getattr(self, key)
+            if value is not None:
+                info[key] = value
+        if self.extra:
+            info.update(self.extra)
+        return info
+
+    def replace(self, **fields):
+        # Копия с измененными полями; сама запись не меняется, пока ее сохраняет фоновый поток
+        record = copy.copy(self)
+        for key, value in fields.items():
+            if key in self.INTERNED:
+                value = _intern(value)
+            if key == 'email' or key in self.__slots__:
+                setattr(record, key, value)
+            else:
+                record.extra = dict(record.extra or {}, **{key: value})
+        return record
+
+    def __eq__(self, other):
+        return isinstance(other, UserRecord) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f"UserRecord({self.to_dict()!r})"
+
+
+def records_in_place(rows):
+    # Профили-словари заменяются на UserRecord в том же словаре: каждый словарь освобождается
+    # сразу после замены, и двух полных копий профилей в памяти не бывает. rows не должен
+    # больше никем читаться как словари (годится для свежего json.loads или снимка)
+    for user_uuid, info in rows.items():
+        if isinstance(info, dict):
+            rows[user_uuid] = UserRecord.from_dict(info)
+    return rows
+
+
+class OrderIndex:
+    # Порядок добавления для постраничного обхода. Каждый ключ получает номер из
+    # монотонного счетчика, курсор - такой номер, а не индекс в списке: уплотнение
+    # не меняет номеров, и курсоры уже открытых страниц остаются верными.
+    # Удаленные ключи остаются в списке до уплотнения и пропускаются при обходе
+
+    def __init__(self):
+        self.items = []
+        # Номера ключей из items, по возрастанию - для поиска курсора bisect'ом
+        self.seqs = []
+        self.position = {}
+        self.next_seq = 0
+        self.removed = 0
+
+    def __len__(self):
+        return len(self.position)
+
+    def append(self, key):
+        self.position[key] = self.next_seq
+        self.items.append(key)
+        self.seqs.append(self.next_seq)
+        self.next_seq += 1
+
+    def discard(self, key):
+        if self.position.pop(key, None) is None:
+            return
+        self.removed += 1
+        if self.removed > len(self.items) // 2:
+            live = [(key, seq) for key, seq in zip(self.items, self.seqs) if self.position.get(key) == seq]
+            self.items = [key for key, _ in live]
+            self.seqs = [seq for _, seq in live]
+            self.removed = 0
+
+    def scan(self, cursor=0):
+        # Живые ключи с номером не меньше курсора вместе с курсором следующего за ними
+        for index in range(bisect.bisect_left(self.seqs, cursor), len(self.items)):
+            key, seq = self.items[index], self.seqs[index]
+            if self.position.get(key) == seq:
+                yield key, seq + 1
+
+
+class UserRepository:
+    # Хранилище профилей uuid -> UserRecord (id, email, name, position, tenant...) с вторичными индексами
+    # telegram_id -> uuid и email -> uuid, чтобы не обходить весь словарь на каждый /start.
+    # Порядок обхода ведется и общий, и отдельно по каждому tenant: страница списка одного
+    # пространства не просматривает пользователей остальных
+
+    def __init__(self, data=None):
+        self.data = {}
+        self._by_telegram_id = {}
+        self._by_email = {}
+        self._order = OrderIndex()
+        self._by_tenant = {}
+        if data:
+            self.load(data)
+
+    def load(self, data):
+        self.clear()
+        for user_uuid, info in data.items():
+            if isinstance(info, dict):
+                info = UserRecord.from_dict(info)
+            elif not isinstance(info, UserRecord):
+                logger.error(f"Ожидался словарь, но получен {type(info)} для user_id {user_uuid}")
+                continue
+            self.data[user_uuid] = info
+            self._order.append(user_uuid)
+            self._tenant_order(tenant_of_info(info)).append(user_uuid)
+            self._index(user_uuid, info)
+
+    def _tenant_order(self, tenant):
+        order = self._by_tenant.get(tenant)
+        if order is None:
+            order = self._by_tenant[tenant] = OrderIndex()
+        return order
+
+    def _index(self, user_uuid, info):
+        telegram_id = info.id
+        if telegram_id is not None:
+            self._by_telegram_id[telegram_id] = user_uuid
+        email = normalize_email(info.email)
+        if email:
+            self._by_email[email] = user_uuid
+
+    def _unindex(self, user_uuid, info):
+        telegram_id = info.id
+        if self._by_telegram_id.get(telegram_id) == user_uuid:
+            del self._by_telegram_id[telegram_id]
+        email = normalize_email(info.email)
+        if email and self._by_email.get(email) == user_uuid:
+            del self._by_email[email]
+
+    # Поиск
+
+    def find_by_telegram_id(self, telegram_id):
+        return self._by_telegram_id.get(telegram_id)
+
+    def find_by_email(self, email):
+        return self._by_email.get(normalize_email(email))
+
+    def get_by_telegram_id(self, telegram_id):
+        user_uuid = self._by_telegram_id.get(telegram_id)
+        if user_uuid is None:
+            return None, None
+        return user_uuid, self.data[user_uuid]
+
+    def tenant_of(self, user_uuid):
+        info = self.data.get(user_uuid)
+        return tenant_of_info(info) if info is not None else DEFAULT_TENANT
+
+    def tenant_uuids(self, tenant):
+        order = self._by_tenant.get(tenant)
+        return list(order.position) if order else []
+
+    def tenant_size(self, tenant):
+        order = self._by_tenant.get(tenant)
+        return len(order) if order else 0
+
+    def tenant_ids(self):
+        # Пространства, в которых есть пользователи
+        return [tenant for tenant, order in self._by_tenant.items() if len(order)]
+
+    # Изменения - все мутации идут через эти методы, чтобы индексы не расходились с данными
+
+    def upsert(self, user_uuid, info):
+        # info - UserRecord или словарь в формате хранилища; возвращается сохраненная запись
+        if isinstance(info, dict):
+            info = UserRecord.from_dict(info)
+        old = self.data.get(user_uuid)
+        tenant = tenant_of_info(info)
+        if old is not None:
+            self._unindex(user_uuid, old)
+            old_tenant = tenant_of_info(old)
+            if old_tenant != tenant:
+                self._by_tenant[old_tenant].discard(user_uuid)
+                self._tenant_order(tenant).append(user_uuid)
+        else:
+            self._order.append(user_uuid)
+            self._tenant_order(tenant).append(user_uuid)
+        self.data[user_uuid] = info
+        self._index(user_uuid, info)
+        return info
+
+    def update(self, user_uuid, **fields):
+        old = self.data.get(user_uuid)
+        info = old.replace(**fields) if old is not None else UserRecord(**fields)
+        return self.upsert(user_uuid, info)
+
+    def delete(self, user_uuid):
+        info = self.data.pop(user_uuid, None)
+        if info is not None:
+            self._unindex(user_uuid, info)
+            self._order.discard(user_uuid)
+            self._by_tenant[tenant_of_info(info)].discard(user_uuid)
+        return info
+
+    def clear(self):
+        self.data = {}
+        self._by_telegram_id = {}
+        self._by_email = {}
+        self._order = OrderIndex()
+        self._by_tenant = {}
+
+    # Постраничный обход
+
+    def page(self, cursor=0, limit=20, predicate=None, tenant=None):
+        # Возвращает до limit пар (uuid, info) начиная с курсора и курсор следующей страницы
+        # (None, если дальше ничего нет). Стоимость - O(размер страницы), а не O(N).
+        # Курсор - номер в порядке добавления (см. OrderIndex), с tenant - в порядке этого пространства
+        order = self._order if tenant is None else self._by_tenant.get(tenant)
+        items = []
+        if order is None:
+            return items, None
+        for user_uuid, position in order.scan(cursor):
+            info = self.data[user_uuid]
+            if predicate is None or predicate(user_uuid, info):
+                items.append((user_uuid, info))
+                if len(items) >= limit:
+                    return items, position if position < order.next_seq else None
+        return items, None
+
+    def cursor_of(self, user_uuid, tenant=None):
+        order = self._order if tenant is None else self._by_tenant.get(tenant)
+        return order.position.get(user_uuid) if order else None
+
+    # Интерфейс словаря только для чтения
+
+    def get(self, user_uuid, default=None):
+        return self.data.get(user_uuid, default)
+
+    def __getitem__(self, user_uuid):
+        return self.data[user_uuid]
+
+    def __contains__(self, user_uuid):
+        return user_uuid in self.data
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __bool__(self):
+        return bool(self.data)
+
+    def items(self):
+        return self.data.items()
+
+    def keys(self):
+        return self.data.keys()
+
+    def values(self):
+        return self.data.values()
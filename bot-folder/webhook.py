@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import signal
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+MAX_BODY = 1024 * 1024
+
+
+class WebhookServer:
+    # Встроенный HTTP-сервер на asyncio для приема апдейтов от Telegram.
+    # TLS ожидается на обратном прокси перед ботом, сам сервер слушает обычный HTTP.
+    # on_update получает апдейт в виде словаря из JSON
+
+    def __init__(self, on_update, listen='127.0.0.1', port=8443, path='/telegram', secret_token=None):
+        self.on_update = on_update
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        logger.info(f"Webhook слушает http://{self.listen}:{self.port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _read_request(self, reader):
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY:
+            return parts, headers, None
+        body = await reader.readexactly(length) if length else b''
+        return parts, headers, body
+
+    @staticmethod
+    def _response(writer, status, keep_alive):
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode()
+        )
+
+    async def _serve(self, reader, writer):
+        # Telegram держит соединение открытым, поэтому обрабатываем несколько запросов подряд
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                parts, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                status = await self._handle(parts, headers, body)
+                self._response(writer, status, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Ошибка при обработке запроса webhook: {e}")
+        finally:
+            writer.close()
+
+    async def _handle(self, parts, headers, body):
+        if len(parts) < 2 or parts[0] != 'POST' or parts[1].split('?')[0] != self.path:
+            return '404 Not Found'
+        if self.secret_token and headers.get(SECRET_HEADER) != self.secret_token:
+            logger.warning("Webhook: запрос с неверным секретным токеном")
+            return '403 Forbidden'
+        if body is None:
+            return '413 Payload Too Large'
+        try:
+            await self.on_update(json.loads(body))
+        except Exception as e:
+            logger.error(f"Webhook: не удалось разобрать апдейт: {e}")
+            return '400 Bad Request'
+        return '200 OK'
+
+
+def stop_event():
+    # Событие, которое выставляется по SIGINT/SIGTERM
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    return stop
+
+
+async def run_webhook(application, url, listen='127.0.0.1', port=8443, path='/telegram',
+                      secret_token=None, max_connections=40):
+    # url=None - адрес в Telegram не регистрируется: апдейты присылает диспетчер (dispatcher.py)
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+
+    async def enqueue(data):
+        # Дальше апдейт обрабатывает Application, как и при polling
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = WebhookServer(enqueue, listen, port, path, secret_token)
+    stop = stop_event()
+    try:
+        await application.start()
+        await server.start()
+        if url:
+            await application.bot.set_webhook(
+                url=url.rstrip('/') + path,
+                secret_token=secret_token,
+                allowed_updates=Update.ALL_TYPES,
+                max_connections=max_connections
+            )
+            logger.info(f"Webhook зарегистрирован: {url.rstrip('/') + path}")
+        await stop.wait()
+    finally:
+        await server.stop()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -0,0 +1,199 @@
+import logging
+import threading
+import time
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_DELETED = object()
+
+
+class FlushStats:
+    def __init__(self):
+        self.writes = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+
+    def as_dict(self):
+        return {
+            'writes': self.writes,
+            'coalesced': self.coalesced,
+            'flushes': self.flushes,
+            'errors': self.errors,
+            'last_flush_seconds': self.last_flush_seconds,
+            'max_flush_seconds': self.max_flush_seconds,
+            'avg_flush_seconds': self.total_flush_seconds / self.flushes if self.flushes else 0.0,
+        }
+
+
+class WriteBehindStorage:
+    # Отложенная запись поверх хранилища из storage.py: обработчики меняют данные в памяти
+    # и помечают набор "грязным", а фоновый поток сбрасывает изменения не чаще раза в interval секунд.
+    # Несколько изменений одного набора между сбросами превращаются в одну запись
+
+    def __init__(self, backend, interval=1.0):
+        self.backend = backend
+        self.interval = interval
+        self.stats = FlushStats()
+        self._data = {}
+        self._pending = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def _dataset(self, dataset):
+        if dataset not in self._data:
+            data = self.backend.load(dataset)
+            # Построчные изменения, сделанные до первой загрузки набора, еще могут быть не записаны
+            for batch in (self._inflight.get(dataset), self._pending.get(dataset)):
+                for key, value in (batch['changes'] if batch else {}).items():
+                    if value is _DELETED:
+                        data.pop(key, None)
+                    else:
+                        data[key] = value
+            self._data[dataset] = data
+        return self._data[dataset]
+
+    def _lazy(self, dataset):
+        # Для построчных хранилищ незагруженный набор меняем без чтения целиком
+        return dataset not in self._data and not getattr(self.backend, 'whole_file', False)
+
+    def _mark(self, dataset, key=None, value=None, replaced=False):
+        self.stats.writes += 1
+        pending = self._pending.get(dataset)
+        if pending is None:
+            pending = self._pending[dataset] = {'replaced': False, 'changes': {}}
+        else:
+            self.stats.coalesced += 1
+            metrics.inc('coffee_storage_coalesced_writes_total', dataset=dataset)
+        if replaced:
+            pending['replaced'] = True
+            pending['changes'] = {}
+        else:
+            pending['changes'][key] = value
+
+    def prime(self, datasets):
+        # Заполнить кэш готовыми данными (из бинарного снимка), чтобы не читать хранилище
+        with self._lock:
+            for dataset, data in datasets.items():
+                if dataset not in self._data:
+                    self._data[dataset] = data
+
+    def adopt(self, dataset, data):
+        # Подменить кэш загруженного набора теми же данными в другом представлении (UserRecord
+        # вместо словарей), чтобы профили не держались в памяти дважды. На диск ничего не пишется
+        with self._lock:
+            if dataset in self._data:
+                self._data[dataset] = dict(data)
+        adopt = getattr(self.backend, 'adopt', None)
+        if adopt:
+            adopt(dataset, data)
+
+    # Чтение
+
+    def load(self, dataset):
+        with self._lock:
+            return dict(self._dataset(dataset))
+
+    def count(self, dataset):
+        with self._lock:
+            return len(self._dataset(dataset))
+
+    def get(self, dataset, key, default=None):
+        key = str(key)
+        with self._lock:
+            if not self._lazy(dataset):
+                return self._dataset(dataset).get(key, default)
+            for batch in (self._pending.get(dataset), self._inflight.get(dataset)):
+                if batch and key in batch['changes']:
+                    value = batch['changes'][key]
+                    return default if value is _DELETED else value
+        return self.backend.get(dataset, key, default)
+
+    # Изменения - только в памяти, запись на диск делает фоновый поток
+
+    def put(self, dataset, key, value):
+        key = str(key)
+        with self._lock:
+            if not self._lazy(dataset):
+                self._dataset(dataset)[key] = value
+            self._mark(dataset, key, value)
+
+    def delete(self, dataset, key):
+        key = str(key)
+        with self._lock:
+            if self._lazy(dataset):
+                self._mark(dataset, key, _DELETED)
+            elif self._dataset(dataset).pop(key, None) is not None:
+                self._mark(dataset, key, _DELETED)
+
+    def replace(self, dataset, data):
+        with self._lock:
+            self._data[dataset] = dict(data)
+            self._mark(dataset, replaced=True)
+
+    # Сброс на диск
+
+    def _run(self):
+        while not self._stopped:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = {}
+                self._inflight = pending
+                snapshots = {}
+                if getattr(self.backend, 'whole_file', False):
+                    snapshots = {dataset: dict(self._data[dataset]) for dataset in pending}
+            for dataset, batch in pending.items():
+                upserts = {k: v for k, v in batch['changes'].items() if v is not _DELETED}
+                deletes = [k for k, v in batch['changes'].items() if v is _DELETED]
+                started = time.perf_counter()
+                try:
+                    if batch['replaced']:
+                        with self._lock:
+                            snapshot = snapshots.get(dataset) or dict(self._data[dataset])
+                        self.backend.replace(dataset, snapshot)
+                    else:
+                        self.backend.write_changes(dataset, upserts, deletes, snapshots.get(dataset))
+                except Exception as e:
+                    self.stats.errors += 1
+                    logger.error(f"Не удалось сохранить набор {dataset}, повторим при следующем сбросе: {e}")
+                    with self._lock:
+                        retry = self._pending.setdefault(dataset, {'replaced': False, 'changes': {}})
+                        if dataset in self._data:
+                            retry['replaced'] = True
+                            retry['changes'] = {}
+                        elif not retry['replaced']:
+                            # Набор не загружен целиком - возвращаем несохраненные строки в очередь
+                            retry['changes'] = {**batch['changes'], **retry['changes']}
+                    continue
+                elapsed = time.perf_counter() - started
+                metrics.observe('coffee_storage_flush_seconds', elapsed, dataset=dataset)
+                self.stats.flushes += 1
+                self.stats.last_flush_seconds = elapsed
+                self.stats.max_flush_seconds = max(self.stats.max_flush_seconds, elapsed)
+                self.stats.total_flush_seconds += elapsed
+            with self._lock:
+                self._inflight = {}
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        self._thread.join(timeout=max(self.interval, 1.0) * 5)
+        self.flush()
+        self.backend.close()
+        logger.info(f"Хранилище закрыто, статистика записи: {self.stats.as_dict()}")